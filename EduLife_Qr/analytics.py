@@ -0,0 +1,175 @@
+import os
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+import database
+from api_integration import TTLCache
+
+# Сколько хранить результат, если новых посещений не было (секунды)
+ANALYTICS_CACHE_TTL = int(os.getenv("QR_ANALYTICS_CACHE_TTL", "3600"))
+
+# Результаты аналитики по (период, фильтры, окно): (поколение данных на момент расчета, результат)
+analytics_cache = TTLCache(ttl=ANALYTICS_CACHE_TTL, max_size=256)
+
+# Столбцы выборки: номер дня (дней с 1970-01-01 по локальной дате), день недели, смена, предмет, преподаватель
+DAY, DAY_OF_WEEK, SHIFT, SUBJECT, TEACHER = range(5)
+
+# 1970-01-01 - четверг, сдвиг выравнивает недели по понедельникам
+_WEEK_OFFSET = 3
+
+
+def load_columns(start_date=None, end_date=None, subject_id=None, teacher_id=None) -> np.ndarray:
+    """Загружает нужные столбцы SESSION_DATA за период в массив (n, 5), по одному запросу на раздел"""
+    query = """
+        SELECT CAST(julianday(date(session_time)) - 2440587.5 AS INTEGER),
+               COALESCE(day_of_week, -1), COALESCE(shift_id, -1),
+               COALESCE(subject_id, -1), COALESCE(teacher_id, -1)
+        FROM {schema}.SESSION_DATA WHERE 1=1
+    """
+    params = []
+    start_epoch, end_epoch = database.date_range_to_epoch(start_date, end_date)
+    if start_epoch is not None:
+        query += " AND session_epoch >= ?"
+        params.append(start_epoch)
+    if end_epoch is not None:
+        query += " AND session_epoch < ?"
+        params.append(end_epoch)
+    if subject_id is not None:
+        query += " AND subject_id = ?"
+        params.append(subject_id)
+    if teacher_id is not None:
+        query += " AND teacher_id = ?"
+        params.append(teacher_id)
+
+    conn = database.get_db_connection()
+    conn.row_factory = None
+    rows = []
+    try:
+        # Архивные разделы подключаются, только если пересекаются с периодом
+        for partition in database.session_partitions(conn, start_epoch, end_epoch):
+            with database.attach_partition(conn, partition) as schema:
+                rows.extend(conn.execute(query.format(schema=schema), params).fetchall())
+    finally:
+        conn.close()
+
+    if not rows:
+        return np.empty((0, 5), dtype=np.int64)
+    return np.array(rows, dtype=np.int64)
+
+
+def _heatmap(data: np.ndarray) -> Dict[str, Any]:
+    """
+    Число посещений в разрезе день недели x смена x предмет. Посещения без дня
+    недели (NULL в базе, -1 в выборке) в сетку не попадают, а считаются отдельно
+    """
+    known = data[:, DAY_OF_WEEK] >= 0
+    unknown = int(len(data) - np.count_nonzero(known))
+    data = data[known]
+    shifts, shift_idx = np.unique(data[:, SHIFT], return_inverse=True)
+    subjects, subject_idx = np.unique(data[:, SUBJECT], return_inverse=True)
+    days = data[:, DAY_OF_WEEK] % 7
+
+    flat = (days * len(shifts) + shift_idx) * len(subjects) + subject_idx
+    counts = np.bincount(flat, minlength=7 * len(shifts) * len(subjects))
+    return {
+        "days_of_week": list(range(7)),
+        "shifts": shifts.tolist(),
+        "subjects": subjects.tolist(),
+        "counts": counts.reshape(7, len(shifts), len(subjects)).tolist(),
+        "unknown_day_of_week": unknown
+    }
+
+
+def _lesson_sizes(data: np.ndarray):
+    """Проведенные занятия (день, смена, предмет, преподаватель) и число посещений каждого"""
+    return np.unique(data[:, [DAY, SHIFT, SUBJECT, TEACHER]], axis=0, return_counts=True)
+
+
+def _weekly_trends(data: np.ndarray, lessons: np.ndarray, window: int) -> Dict[str, Any]:
+    """Посещения и среднее число студентов на занятии по неделям, со скользящим средним за window недель"""
+    weeks = (data[:, DAY] + _WEEK_OFFSET) // 7
+    first_week = weeks.min()
+    week_count = weeks.max() - first_week + 1
+
+    attendance = np.bincount(weeks - first_week, minlength=week_count)
+    lesson_weeks = (lessons[:, 0] + _WEEK_OFFSET) // 7 - first_week
+    lesson_count = np.bincount(lesson_weeks, minlength=week_count)
+    rate = np.divide(attendance, lesson_count, out=np.zeros(week_count), where=lesson_count > 0)
+
+    # Скользящее среднее только по неделям, в которые были занятия
+    kernel = np.ones(window)
+    rolling_sum = np.convolve(attendance, kernel)[:week_count]
+    rolling_lessons = np.convolve(lesson_count, kernel)[:week_count]
+    rolling_rate = np.divide(rolling_sum, rolling_lessons, out=np.zeros(week_count), where=rolling_lessons > 0)
+
+    week_starts = (np.arange(week_count) + first_week) * 7 - _WEEK_OFFSET
+    return {
+        "window": window,
+        "weeks": [
+            {
+                "week_start": str(np.datetime64(int(day), "D")),
+                "attendance_count": int(attendance[i]),
+                "lessons": int(lesson_count[i]),
+                "rate": round(float(rate[i]), 2),
+                "rolling_rate": round(float(rolling_rate[i]), 2)
+            }
+            for i, day in enumerate(week_starts)
+        ]
+    }
+
+
+def _teacher_distributions(lessons: np.ndarray, sizes: np.ndarray) -> list:
+    """Распределение числа студентов на занятиях каждого преподавателя"""
+    order = np.argsort(lessons[:, 3], kind="stable")
+    teachers, starts = np.unique(lessons[order, 3], return_index=True)
+    result = []
+    for teacher_id, group in zip(teachers, np.split(sizes[order], starts[1:])):
+        p10, median, p90 = np.percentile(group, [10, 50, 90])
+        result.append({
+            "teacher_id": int(teacher_id),
+            "lessons": int(group.size),
+            "attendance_count": int(group.sum()),
+            "mean": round(float(group.mean()), 2),
+            "median": float(median),
+            "p10": float(p10),
+            "p90": float(p90),
+            "min": int(group.min()),
+            "max": int(group.max())
+        })
+    return result
+
+
+def compute_analytics(data: np.ndarray, window: int = 4) -> Dict[str, Any]:
+    if data.shape[0] == 0:
+        return {"attendance_count": 0, "heatmap": None, "trends": {"window": window, "weeks": []}, "teachers": []}
+
+    lessons, sizes = _lesson_sizes(data)
+    return {
+        "attendance_count": int(data.shape[0]),
+        "heatmap": _heatmap(data),
+        "trends": _weekly_trends(data, lessons, window),
+        "teachers": _teacher_distributions(lessons, sizes)
+    }
+
+
+def get_attendance_analytics(
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    subject_id: Optional[int] = None,
+    teacher_id: Optional[int] = None,
+    window: int = 4
+) -> Dict[str, Any]:
+    """
+    Аналитика посещаемости с кэшированием: результат пересчитывается,
+    только если в SESSION_DATA появились новые записи (изменилось поколение данных)
+    """
+    key = (start_date, end_date, subject_id, teacher_id, window)
+    generation = database.get_sessions_generation()
+    cached = analytics_cache.get(key)
+    if cached is not None and cached[0] == generation:
+        return cached[1]
+
+    result = compute_analytics(load_columns(start_date, end_date, subject_id, teacher_id), window)
+    analytics_cache.set(key, (generation, result))
+    return result
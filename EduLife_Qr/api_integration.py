@@ -1,10 +1,17 @@
 import os
+import threading
+import time
 import requests
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Hashable
 import json
 
 # Конфигурация
 API_TIMEOUT = 10  # Таймаут для API запросов (секунды)
+CACHE_TTL = int(os.getenv("QR_CACHE_TTL", "300"))  # Время жизни локального кэша данных других сервисов (секунды)
+CACHE_MAX_SIZE = 10000
+AUTH_CACHE_TTL = int(os.getenv("QR_AUTH_CACHE_TTL", "30"))  # Время жизни результата проверки токена (секунды)
+SCHEDULE_CACHE_TTL = int(os.getenv("QR_SCHEDULE_CACHE_TTL", "60"))  # Время жизни расписания группы/преподавателя (секунды)
+SCHEDULE_TARGET_TTL = int(os.getenv("QR_SCHEDULE_TARGET_TTL", "86400"))  # Время жизни связи пользователь -> группа/преподаватель
 
 # URL сервисов
 AUTH_API_URL = os.getenv("AUTH_API_URL", "http://localhost:8070")
@@ -65,6 +72,53 @@ def make_api_request(
     except requests.RequestException as e:
         raise APIError(f"Ошибка при выполнении API запроса: {str(e)}")
 
+class TTLCache:
+    """Потокобезопасный кэш с ограниченным временем жизни и размером"""
+    def __init__(self, ttl: float = CACHE_TTL, max_size: int = CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data: Dict[Hashable, tuple] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            if len(self._data) >= self.max_size and key not in self._data:
+                now = time.monotonic()
+                for stale_key in [k for k, (exp, _) in self._data.items() if exp < now]:
+                    del self._data[stale_key]
+                if len(self._data) >= self.max_size:
+                    # Удаляем самую старую запись
+                    del self._data[next(iter(self._data))]
+            self._data[key] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, key: Hashable = None):
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+# Локальные кэши данных из сервисов авторизации и расписания
+user_info_cache = TTLCache()
+lesson_info_cache = TTLCache()
+auth_cache = TTLCache(ttl=AUTH_CACHE_TTL)
+
+# Чье расписание показывать пользователю: ("teacher_id", id), ("group_id", id) или () - никакое
+schedule_target_cache = TTLCache(ttl=SCHEDULE_TARGET_TTL)
+# Расписания по ключу ("teacher_id", id) / ("group_id", id); сбрасываются по уведомлениям сервиса расписания
+schedule_cache = TTLCache(ttl=SCHEDULE_CACHE_TTL)
+
 # API авторизации
 def verify_token(token: str) -> Dict[str, Any]:
     """Проверяет токен пользователя через сервис авторизации"""
@@ -74,6 +128,15 @@ def verify_token(token: str) -> Dict[str, Any]:
     except APIError:
         return {}
 
+def verify_token_cached(token: str) -> Dict[str, Any]:
+    """Проверка токена с кратковременным кэшем - для часто опрашиваемых эндпоинтов"""
+    user = auth_cache.get(token)
+    if user is None:
+        user = verify_token(token)
+        if user:
+            auth_cache.set(token, user)
+    return user
+
 def get_user_info(user_id: int, token: str) -> Dict[str, Any]:
     """Получает информацию о пользователе из сервиса авторизации"""
     url = f"{AUTH_API_URL}/users/{user_id}"
@@ -82,85 +145,165 @@ def get_user_info(user_id: int, token: str) -> Dict[str, Any]:
     except APIError:
         return {}
 
+def get_user_info_cached(user_id: int, token: str) -> Dict[str, Any]:
+    """Информация о пользователе с использованием локального кэша"""
+    user_info = user_info_cache.get(user_id)
+    if user_info is None:
+        user_info = get_user_info(user_id, token)
+        if user_info:
+            user_info_cache.set(user_id, user_info)
+    return user_info
+
+def get_group_students(group_id: int, token: str) -> List[Dict[str, Any]]:
+    """Получает список студентов группы одним запросом к сервису авторизации"""
+    url = f"{AUTH_API_URL}/students/by-group/{group_id}"
+    try:
+        return make_api_request("get", url, token=token)
+    except APIError:
+        return []
+
 # API для взаимодействия с расписанием
+def get_lesson_group_ids(subject_id: int, teacher_id: int, token: str, lesson_date: str) -> List[int]:
+    """Определяет группы, у которых преподаватель ведет предмет в указанный день"""
+    url = f"{RASPIS_API_URL}/schedule"
+    params = {"teacher_id": teacher_id, "date_filter": lesson_date}
+    try:
+        schedules = make_api_request("get", url, token=token, params=params)
+    except (APIError, ValueError):
+        return []
+    return sorted({s["group_id"] for s in schedules if s.get("subject_id") == subject_id and s.get("group_id")})
+
+def resolve_schedule_target(user_id: int, token: str) -> Optional[tuple]:
+    """
+    Определяет, чье расписание относится к пользователю: ("teacher_id", id) для преподавателя,
+    ("group_id", id) для студента, () для остальных. None - если сервис авторизации недоступен.
+    """
+    try:
+        user_info = make_api_request("get", f"{AUTH_API_URL}/users/{user_id}", token=token)
+        role = user_info.get("role_name", "").lower()
+
+        if role == "teacher":
+            teachers = make_api_request("get", f"{AUTH_API_URL}/teachers", token=token, params={"user_id": user_id})
+            if teachers:
+                return ("teacher_id", teachers[0].get("id"))
+        elif role == "student":
+            students = make_api_request("get", f"{AUTH_API_URL}/students", token=token, params={"user_id": user_id})
+            if students and students[0].get("group_id"):
+                return ("group_id", students[0]["group_id"])
+    except APIError as e:
+        if e.status_code is None or e.status_code >= 500:
+            return None
+        print(f"Не удалось определить расписание пользователя {user_id}: {e.message}")
+    return ()
+
 def get_user_schedule(user_id: int, token: str) -> List[Dict[str, Any]]:
-    """Получает расписание для пользователя из сервиса расписания"""
-    # Сначала определяем роль пользователя
-    user_info = get_user_info(user_id, token)
-    if not user_info:
+    """
+    Получает расписание для пользователя. Связь пользователя с группой или преподавателем
+    и само расписание берутся из локального кэша, сервисы вызываются только при промахе.
+    """
+    target = schedule_target_cache.get(user_id)
+    if target is None:
+        target = resolve_schedule_target(user_id, token)
+        if target is None:
+            return []
+        schedule_target_cache.set(user_id, target)
+
+    # Если у пользователя другая роль, расписания у него нет
+    if not target:
         return []
-    
-    role = user_info.get("role_name", "").lower()
-    
-    if role == "teacher":
-        # Получаем сначала ID преподавателя по ID пользователя
-        url = f"{AUTH_API_URL}/teachers?user_id={user_id}"
-        try:
-            teachers = make_api_request("get", url, token=token)
-            if teachers and len(teachers) > 0:
-                teacher_id = teachers[0].get("id")
-                url = f"{RASPIS_API_URL}/schedule"
-                params = {"teacher_id": teacher_id}
-                return make_api_request("get", url, token=token, params=params)
-        except:
-            pass
-    elif role == "student":
-        # Получаем сначала ID студента по ID пользователя
-        url = f"{AUTH_API_URL}/students?user_id={user_id}"
+
+    schedule = schedule_cache.get(target)
+    if schedule is None:
         try:
-            students = make_api_request("get", url, token=token)
-            if students and len(students) > 0:
-                student = students[0]
-                group_id = student.get("group_id")
-                url = f"{RASPIS_API_URL}/schedule"
-                params = {"group_id": group_id}
-                return make_api_request("get", url, token=token, params=params)
-        except:
-            pass
-    
-    # Если не удалось получить расписание специфично для роли,
-    # или у пользователя другая роль, возвращаем пустой список
-    return []
+            schedule = make_api_request("get", f"{RASPIS_API_URL}/schedule", token=token, params={target[0]: target[1]})
+        except APIError as e:
+            print(f"Ошибка при получении расписания {target}: {e.message}")
+            return []
+        schedule_cache.set(target, schedule)
+    return schedule
+
+def invalidate_schedules(group_ids: List[int] = (), teacher_ids: List[int] = ()):
+    """Сбрасывает закэшированные расписания групп и преподавателей; без аргументов - все"""
+    if not group_ids and not teacher_ids:
+        schedule_cache.invalidate()
+        return
+    for group_id in group_ids:
+        schedule_cache.invalidate(("group_id", group_id))
+    for teacher_id in teacher_ids:
+        schedule_cache.invalidate(("teacher_id", teacher_id))
+
+def get_lesson_info(subject_id: int, teacher_id: int, token: str) -> Dict[str, Any]:
+    """Получает занятие по предмету и преподавателю с использованием локального кэша"""
+    key = (subject_id, teacher_id)
+    schedule_info = lesson_info_cache.get(key)
+    if schedule_info is not None:
+        return schedule_info
+
+    schedule_info = {}
+    url = f"{RASPIS_API_URL}/schedule"
+    params = {
+        "subject_id": subject_id,
+        "teacher_id": teacher_id,
+    }
+    try:
+        schedules = make_api_request("get", url, token=token, params=params)
+        if schedules and len(schedules) > 0:
+            schedule_info = schedules[0]
+            lesson_info_cache.set(key, schedule_info)
+    except (APIError, ValueError):
+        pass
+    return schedule_info
+
+def build_attendance_details(
+    user_id: int,
+    token_data: dict,
+    user_info: Dict[str, Any],
+    schedule_info: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Собирает расширенные данные о посещении из уже полученной информации"""
+    return {
+        "user_id": user_id,
+        "user_name": user_info.get("full_name", ""),
+        "subject_id": token_data.get("subject_id"),
+        "subject_name": schedule_info.get("subject_name", ""),
+        "teacher_id": token_data.get("teacher_id"),
+        "teacher_name": schedule_info.get("teacher_name", ""),
+        "day_of_week": token_data.get("day_of_week"),
+        "shift_id": token_data.get("shift_id"),
+        "timestamp": schedule_info.get("time_start", "")
+    }
+
+def get_cached_attendance_details(user_id: int, token_data: dict) -> Optional[Dict[str, Any]]:
+    """
+    Собирает расширенные данные о посещении только из локального кэша,
+    без обращения к другим сервисам. Возвращает None, если данных в кэше нет.
+    """
+    user_info = user_info_cache.get(user_id)
+    schedule_info = lesson_info_cache.get((token_data.get("subject_id"), token_data.get("teacher_id")))
+    if user_info is None or schedule_info is None:
+        return None
+    return build_attendance_details(user_id, token_data, user_info, schedule_info)
 
 # Метод для сохранения посещаемости с дополнительной информацией
-def save_attendance_with_details(user_id: int, token_data: dict, token: str) -> Dict[str, Any]:
+def save_attendance_with_details(
+    user_id: int,
+    token_data: dict,
+    token: str,
+    user_info: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
     """
     Сохраняет информацию о посещаемости с обогащенными данными
     из сервиса расписания и авторизации.
     """
     try:
-        # Получаем информацию о пользователе
-        user_info = get_user_info(user_id, token)
-        
+        # Получаем информацию о пользователе (если её ещё не получили при импорте пользователя)
+        if not user_info:
+            user_info = get_user_info_cached(user_id, token)
+
         # Получаем дополнительную информацию о занятии из сервиса расписания
-        # по ID предмета, учителя и группы
-        schedule_info = {}
-        url = f"{RASPIS_API_URL}/schedule"
-        params = {
-            "subject_id": token_data.get("subject_id"),
-            "teacher_id": token_data.get("teacher_id"),
-        }
-        
-        try:
-            schedules = make_api_request("get", url, token=token, params=params)
-            if schedules and len(schedules) > 0:
-                schedule_info = schedules[0]
-        except:
-            pass
-        
-        # Сохраняем расширенные данные о посещаемости
-        # Это локальное сохранение в базу данных QR сервиса
-        
-        return {
-            "user_id": user_id,
-            "user_name": user_info.get("full_name", ""),
-            "subject_id": token_data.get("subject_id"),
-            "subject_name": schedule_info.get("subject_name", ""),
-            "teacher_id": token_data.get("teacher_id"),
-            "teacher_name": schedule_info.get("teacher_name", ""),
-            "day_of_week": token_data.get("day_of_week"),
-            "shift_id": token_data.get("shift_id"),
-            "timestamp": schedule_info.get("time_start", "")
-        }
+        # по ID предмета и учителя
+        schedule_info = get_lesson_info(token_data.get("subject_id"), token_data.get("teacher_id"), token)
+
+        return build_attendance_details(user_id, token_data, user_info, schedule_info)
     except Exception as e:
-        raise APIError(f"Ошибка при сохранении расширенных данных о посещаемости: {str(e)}")
\ No newline at end of file
+        raise APIError(f"Ошибка при сохранении расширенных данных о посещаемости: {str(e)}")
@@ -0,0 +1,34 @@
+"""
+Перенос закрытых семестров SESSION_DATA в архивные разделы (archive/sessions_<семестр>.db).
+
+Запуск: python archive_sessions.py [--term 2024-fall] [--grace-days 7] [--vacuum]
+        python archive_sessions.py --verify
+"""
+import argparse
+
+import database
+
+parser = argparse.ArgumentParser(description="Архивация закрытых семестров SESSION_DATA")
+parser.add_argument("--term", help="семестр YYYY-fall или YYYY-spring (по умолчанию - все закрытые)")
+parser.add_argument("--grace-days", type=int, default=7, help="сколько дней после конца семестра не трогать его")
+parser.add_argument("--vacuum", action="store_true", help="сжать основную базу после переноса")
+parser.add_argument("--verify", action="store_true", help="только проверить контрольные суммы разделов")
+args = parser.parse_args()
+
+database.create_tables()
+
+if args.verify:
+    failed = 0
+    for term, ok in database.verify_partitions():
+        print(f"{term}: {'ok' if ok else 'CHECKSUM MISMATCH'}")
+        failed += not ok
+    raise SystemExit(1 if failed else 0)
+
+terms = [args.term] if args.term else database.get_closed_terms(args.grace_days)
+for term in terms:
+    rows = database.archive_term(term, args.grace_days)
+    print(f"{term}: archived {rows} rows.")
+
+if args.vacuum:
+    database.vacuum_database()
+    print("Main database vacuumed.")
@@ -0,0 +1,27 @@
+from typing import Iterable, List
+
+# Битовые карты посещаемости: бит i соответствует студенту с плотным индексом i
+# (таблица student_index). Хранятся в SQLite как BLOB в порядке little-endian.
+
+
+def from_indices(indices: Iterable[int]) -> int:
+    bitmap = 0
+    for idx in indices:
+        bitmap |= 1 << idx
+    return bitmap
+
+
+def to_indices(bitmap: int) -> List[int]:
+    return [idx for idx, bit in enumerate(reversed(bin(bitmap)[2:])) if bit == "1"]
+
+
+def count(bitmap: int) -> int:
+    return bin(bitmap).count("1")
+
+
+def to_blob(bitmap: int) -> bytes:
+    return bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+
+
+def from_blob(blob) -> int:
+    return int.from_bytes(blob, "little") if blob else 0
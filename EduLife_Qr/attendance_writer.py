@@ -0,0 +1,248 @@
+import glob
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import database
+
+# Режим записи посещений: "sync" - сразу в запросе, "batch" - через очередь с групповой фиксацией
+WRITE_MODE = os.getenv("QR_ATTENDANCE_WRITE_MODE", "sync")
+
+# Максимальная задержка сброса очереди (мс) и максимальный размер пачки
+FLUSH_INTERVAL_MS = int(os.getenv("QR_ATTENDANCE_FLUSH_INTERVAL_MS", "50"))
+FLUSH_BATCH_SIZE = int(os.getenv("QR_ATTENDANCE_FLUSH_BATCH_SIZE", "500"))
+
+# Повторы записи пачки при ошибке: число попыток и начальная пауза (секунды, удваивается)
+FLUSH_RETRIES = int(os.getenv("QR_ATTENDANCE_FLUSH_RETRIES", "5"))
+FLUSH_RETRY_DELAY = float(os.getenv("QR_ATTENDANCE_FLUSH_RETRY_DELAY", "0.1"))
+
+# Файл для пачек, которые не удалось записать после всех попыток (NDJSON).
+# Писатель дописывает строки из него в базу при запуске и затем каждые
+# DEAD_LETTER_RETRY_INTERVAL секунд
+DEAD_LETTER_PATH = os.getenv("QR_ATTENDANCE_DEAD_LETTER_PATH")
+DEAD_LETTER_RETRY_INTERVAL = float(os.getenv("QR_ATTENDANCE_DEAD_LETTER_RETRY_INTERVAL", "30"))
+# Файл "*.recovering", который не обновлялся дольше этого времени, оставлен
+# упавшим процессом, и его забирает на восстановление любой воркер
+RECOVERING_STALE_SECONDS = 300
+
+_STOP = object()
+
+
+class AttendanceWriter:
+    """
+    Единственный писатель SESSION_DATA для пакетного режима.
+
+    Запросы кладут проверенные сканирования в очередь, а фоновый поток
+    записывает их через executemany одной транзакцией каждые
+    FLUSH_INTERVAL_MS миллисекунд или по достижении FLUSH_BATCH_SIZE строк.
+    Пользователи, которых еще нет в локальной таблице users, добавляются
+    в той же транзакции, поэтому запрос не пишет в базу сам.
+    Клиенты уже получили подтверждение, поэтому пачка с ошибкой записи
+    не отбрасывается: она повторяется с паузой, а затем сохраняется в файл
+    DEAD_LETTER_PATH, который писатель периодически пробует записать снова.
+    """
+
+    def __init__(self, flush_interval_ms: int = FLUSH_INTERVAL_MS, batch_size: int = FLUSH_BATCH_SIZE,
+                 dead_letter_path: Optional[str] = DEAD_LETTER_PATH):
+        self.flush_interval = flush_interval_ms / 1000
+        self.batch_size = batch_size
+        self.dead_letter_path = dead_letter_path or os.path.join(
+            os.path.dirname(os.path.abspath(database.db_path)), "attendance_dead_letter.ndjson"
+        )
+        self._queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._metrics = {
+            "flushes": 0,
+            "rows_written": 0,
+            "rows_failed": 0,
+            "flush_retries": 0,
+            "rows_dead_lettered": 0,
+            "rows_recovered": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+        }
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._recover_dead_letters()
+        self._thread = threading.Thread(target=self._run, name="attendance-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Останавливает писателя, предварительно записав всё из очереди"""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, row: Tuple, user: Optional[Tuple[int, str]] = None):
+        """
+        Ставит строку SESSION_DATA в очередь на запись. user - (id, username)
+        пользователя, которого нужно добавить в локальную таблицу users
+        """
+        self._queue.put((row, user))
+
+    def _run(self):
+        next_recovery = time.monotonic() + DEAD_LETTER_RETRY_INTERVAL
+        stopping = False
+        while not stopping:
+            if time.monotonic() >= next_recovery:
+                self._recover_dead_letters()
+                next_recovery = time.monotonic() + DEAD_LETTER_RETRY_INTERVAL
+            try:
+                item = self._queue.get(timeout=max(0.0, next_recovery - time.monotonic()))
+            except queue.Empty:
+                continue
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+
+    def _write(self, batch):
+        database.record_sessions([row for row, _ in batch], [user for _, user in batch if user is not None])
+
+    def _flush(self, batch) -> int:
+        """Записывает пачку с повторами; возвращает число записанных строк"""
+        start = time.perf_counter()
+        failed = retried = 0
+        delay = FLUSH_RETRY_DELAY
+        for attempt in range(FLUSH_RETRIES + 1):
+            try:
+                self._write(batch)
+                break
+            except Exception as e:
+                if attempt == FLUSH_RETRIES:
+                    failed = len(batch)
+                    print(f"Ошибка записи пачки посещений ({len(batch)} строк), сохраняем в {self.dead_letter_path}: {e}")
+                    self._dead_letter(batch)
+                else:
+                    retried += 1
+                    print(f"Ошибка записи пачки посещений ({len(batch)} строк), повтор через {delay:.1f} с: {e}")
+                    time.sleep(delay)
+                    delay *= 2
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        with self._lock:
+            metrics = self._metrics
+            metrics["flushes"] += 1
+            metrics["rows_written"] += len(batch) - failed
+            metrics["rows_failed"] += failed
+            metrics["flush_retries"] += retried
+            metrics["last_batch_size"] = len(batch)
+            metrics["max_batch_size"] = max(metrics["max_batch_size"], len(batch))
+            metrics["last_flush_ms"] = elapsed_ms
+            metrics["max_flush_ms"] = max(metrics["max_flush_ms"], elapsed_ms)
+            metrics["total_flush_ms"] += elapsed_ms
+        return len(batch) - failed
+
+    def _dead_letter(self, batch: List[Tuple]):
+        """Дописывает строки пачки в файл DEAD_LETTER_PATH"""
+        if not batch:
+            return
+        try:
+            with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+                for row, user in batch:
+                    user_id, session_time, subject_id, shift_id, teacher_id, day_of_week = row
+                    line = [user_id, session_time.isoformat(), subject_id, shift_id, teacher_id, day_of_week]
+                    if user is not None:
+                        line.append(user[1])
+                    f.write(json.dumps(line, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception as e:
+            # Последний шанс не потерять данные - вывести строки в лог
+            print(f"Не удалось сохранить пачку посещений в {self.dead_letter_path}: {e}; строки: {batch}")
+            return
+        with self._lock:
+            self._metrics["rows_dead_lettered"] += len(batch)
+
+    def _claim_dead_letters(self) -> List[str]:
+        """
+        Забирает на восстановление DEAD_LETTER_PATH и брошенные файлы "*.recovering".
+        Файл переименовывается до чтения: так его не заберут сразу два воркера
+        """
+        claimed = []
+        candidates = [self.dead_letter_path] + sorted(glob.glob(glob.escape(self.dead_letter_path) + ".*.recovering"))
+        for number, path in enumerate(candidates):
+            if path != self.dead_letter_path:
+                owner = path[len(self.dead_letter_path) + 1:].split(".")[0]
+                try:
+                    stale = time.time() - os.path.getmtime(path) > RECOVERING_STALE_SECONDS
+                except OSError:
+                    continue
+                # Файл другого процесса, который еще восстанавливает его
+                if owner != str(os.getpid()) and not stale:
+                    continue
+            processing_path = f"{self.dead_letter_path}.{os.getpid()}.{time.time_ns()}-{number}.recovering"
+            try:
+                os.replace(path, processing_path)
+            except FileNotFoundError:
+                continue
+            claimed.append(processing_path)
+        return claimed
+
+    def _recover_dead_letters(self):
+        """
+        Дописывает в базу строки, сохраненные в DEAD_LETTER_PATH при прошлых сбоях записи.
+        Файл удаляется только после записи: строки, которые снова не удалось
+        записать, сохраняются в новый файл и ждут следующей попытки
+        """
+        for processing_path in self._claim_dead_letters():
+            items = []
+            with open(processing_path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        user_id, session_time, subject_id, shift_id, teacher_id, day_of_week, *user = json.loads(line)
+                        row = (user_id, datetime.fromisoformat(session_time), subject_id, shift_id, teacher_id, day_of_week)
+                        items.append((row, (user_id, user[0]) if user else None))
+
+            recovered = 0
+            for start in range(0, len(items), self.batch_size):
+                chunk = items[start:start + self.batch_size]
+                written = self._flush(chunk)
+                recovered += written
+                if written < len(chunk):
+                    # База по-прежнему недоступна - остальное откладываем до следующей попытки,
+                    # не задерживая запись новых посещений
+                    self._dead_letter(items[start + len(chunk):])
+                    break
+                # Отмечаем, что файл еще в работе, чтобы его не забрал другой воркер
+                os.utime(processing_path)
+            os.remove(processing_path)
+
+            with self._lock:
+                self._metrics["rows_recovered"] += recovered
+            print(f"Из {self.dead_letter_path} восстановлено {recovered} посещений из {len(items)}")
+
+    def get_metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            metrics = dict(self._metrics)
+        flushes = metrics["flushes"]
+        metrics["avg_batch_size"] = (metrics["rows_written"] + metrics["rows_failed"]) / flushes if flushes else 0
+        metrics["avg_flush_ms"] = metrics.pop("total_flush_ms") / flushes if flushes else 0
+        metrics["queue_depth"] = self._queue.qsize()
+        metrics["mode"] = WRITE_MODE
+        return metrics
@@ -0,0 +1,390 @@
+"""
+Нагрузочный тест "начало пары": K студентов x L занятий одновременно сканируют QR-код.
+
+Поднимает заглушки сервисов авторизации и расписания, запускает main.py через uvicorn
+на временной базе и отправляет /validate_qr по заданной кривой прихода студентов.
+Настройки сервиса (QR_ATTENDANCE_WRITE_MODE, QR_REPLAY_BACKEND, QR_ENRICHMENT_MODE и т.д.)
+берутся из окружения, поэтому любое изменение пути QR-кода можно сравнить на одном сценарии.
+
+Запуск: python bench_scan_burst.py [--students 300] [--lessons 10] [--curve burst|uniform|ramp|front]
+                                   [--window 10] [--concurrency 64] [--workers 1]
+                                   [--duplicate-rate 0.05] [--stub-latency-ms 20]
+        python bench_scan_burst.py --sweep 1,2,4,8   # масштабирование по числу воркеров
+        QR_ATTENDANCE_WRITE_MODE=batch python bench_scan_burst.py --students 40 --lessons 3 --curve burst
+            --shared-students --duplicate-rate 0.5 --check
+
+Студентов нет в локальной таблице users, поэтому каждый первый скан студента добавляет
+пользователя. С --check прогон завершается с ошибкой, если хотя бы одно подтвержденное
+посещение не попало в SESSION_DATA или было отложено в файл недописанных пачек.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import requests
+
+from token_generator import generate_qr_token
+
+# Смена QR-кода на экране преподавателя (как в push-канале /ws/qr)
+TOKEN_ROTATION_SECONDS = 10
+
+STUDENTS_PER_GROUP = 30
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def arrival_offsets(curve, count, window, rng):
+    """Моменты сканирования (секунды от начала занятия) для count студентов"""
+    if curve == "burst":
+        return [0.0] * count
+    if curve == "uniform":
+        return [rng.uniform(0, window) for _ in range(count)]
+    if curve == "ramp":
+        # Плотность растет линейно к концу окна
+        return [window * math.sqrt(rng.random()) for _ in range(count)]
+    if curve == "front":
+        # Большинство сканирует в первые секунды, хвост тянется до конца окна
+        return [min(window, rng.expovariate(4 / window)) for _ in range(count)]
+    raise ValueError(f"Неизвестная кривая прихода: {curve}")
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Заглушка сервисов авторизации и расписания: отвечает по id из пути и токена"""
+
+    latency = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, payload, status=200):
+        if self.latency:
+            time.sleep(self.latency)
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        query = parse_qs(url.query)
+        token = self.headers.get("Authorization", "").replace("Bearer ", "")
+
+        if url.path == "/auth/me":
+            role, _, user_id = token.partition("-")
+            return self._send({"id": int(user_id or 0), "role": role, "role_name": role})
+        if parts[0] == "users" and len(parts) == 2:
+            user_id = int(parts[1])
+            return self._send({"id": user_id, "username": f"student_{user_id}", "full_name": f"Student {user_id}"})
+        if parts[:2] == ["students", "by-group"]:
+            group_id = int(parts[2])
+            first = (group_id - 1) * STUDENTS_PER_GROUP + 1
+            return self._send([
+                {"user_id": user_id, "username": f"student_{user_id}", "full_name": f"Student {user_id}"}
+                for user_id in range(first, first + STUDENTS_PER_GROUP)
+            ])
+        if url.path == "/schedule":
+            teacher_id = int(query.get("teacher_id", ["1"])[0])
+            subject_id = int(query.get("subject_id", [str(teacher_id)])[0])
+            return self._send([{
+                "subject_id": subject_id,
+                "subject_name": f"Subject {subject_id}",
+                "teacher_id": teacher_id,
+                "teacher_name": f"Teacher {teacher_id}",
+                "group_id": teacher_id,
+                "time_start": "08:00"
+            }])
+        return self._send({"detail": "Not found"}, status=404)
+
+
+def start_stub(latency_ms):
+    StubHandler.latency = latency_ms / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", free_port()), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_service(tmp, stub_url, workers):
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        "AUTH_API_URL": stub_url,
+        "RASPIS_API_URL": stub_url,
+        "DOCK_API_URL": stub_url,
+        "QR_DB_PATH": os.path.join(tmp, "bench.db"),
+        "QR_ARCHIVE_DIR": os.path.join(tmp, "archive"),
+    })
+    # Лимиты по IP рассчитаны на аудитории за NAT; в тесте все запросы идут с одного адреса
+    env.setdefault("QR_RATE_LIMIT_VALIDATE_QR_IP", "0")
+    env.setdefault("QR_RATE_LIMIT_VALIDATE_QR_USER", "0")
+    # Несколько воркеров безопасны только с общим хранилищем использованных токенов
+    env["QR_WORKERS"] = str(workers)
+    if workers > 1:
+        env.setdefault("QR_REPLAY_BACKEND", "sqlite")
+
+    log = open(os.path.join(tmp, "service.log"), "w")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            if requests.get(f"{url}/health", timeout=1).status_code == 200:
+                return process, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.kill()
+    log.close()
+    with open(os.path.join(tmp, "service.log")) as f:
+        print(f.read()[-2000:])
+    raise RuntimeError("Сервис не запустился")
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.statuses = {}
+        self.lock_errors = 0
+        self.transport_errors = 0
+        self.accepted = {}
+
+    def record(self, latency, status, body, replay_key):
+        with self.lock:
+            self.latencies.append(latency)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if status == 500 and "locked" in body:
+                self.lock_errors += 1
+            if status == 200:
+                self.accepted[replay_key] = self.accepted.get(replay_key, 0) + 1
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(math.ceil(p / 100 * len(sorted_values))) - 1)]
+
+
+def run_scenario(args, workers):
+    """Один прогон сценария на свежей базе. Возвращает сводку результатов"""
+    rng = random.Random(args.seed)
+    stub = start_stub(args.stub_latency_ms)
+    stub_url = f"http://127.0.0.1:{stub.server_address[1]}"
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            process, url = start_service(tmp, stub_url, workers)
+            try:
+                # Сканирования: (момент, занятие, студент); студенты занятия - отдельная группа
+                scans = []
+                for lesson in range(args.lessons):
+                    first_student = 1 if args.shared_students else lesson * args.students + 1
+                    offsets = arrival_offsets(args.curve, args.students, args.window, rng)
+                    for student, offset in enumerate(offsets, start=first_student):
+                        at = lesson * args.lesson_stagger + offset
+                        scans.append((at, lesson, student))
+                        if rng.random() < args.duplicate_rate:
+                            scans.append((at + rng.uniform(0, 0.5), lesson, student))
+                scans.sort()
+
+                tokens = {}
+                tokens_lock = threading.Lock()
+
+                def lesson_token(lesson, now):
+                    # Каждое занятие показывает свой QR-код, сменяющийся каждые TOKEN_ROTATION_SECONDS
+                    key = (lesson, int(now // TOKEN_ROTATION_SECONDS))
+                    with tokens_lock:
+                        if key not in tokens:
+                            tokens[key] = generate_qr_token(subject_id=lesson + 1, shift_id=1, teacher_id=lesson + 1)
+                        return tokens[key]
+
+                results = Results()
+                local = threading.local()
+                started = time.monotonic()
+
+                def send(scan):
+                    at, lesson, student = scan
+                    delay = started + at - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    session = getattr(local, "session", None)
+                    if session is None:
+                        session = local.session = requests.Session()
+                    qr_code = lesson_token(lesson, time.monotonic() - started)
+                    request_start = time.perf_counter()
+                    try:
+                        response = session.post(
+                            f"{url}/validate_qr",
+                            json={"user_id": student, "qr_code": qr_code},
+                            headers={"Authorization": f"Bearer student-{student}"},
+                            timeout=60
+                        )
+                    except requests.RequestException:
+                        with results.lock:
+                            results.transport_errors += 1
+                        return
+                    results.record(time.perf_counter() - request_start, response.status_code, response.text,
+                                   (qr_code, student))
+
+                with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                    list(pool.map(send, scans))
+                elapsed = time.monotonic() - started
+                writer_metrics = requests.get(f"{url}/metrics", timeout=10).json()["attendance_writer"]
+            finally:
+                process.terminate()
+                process.wait(timeout=30)
+
+            # Писатель в пакетном режиме дописывает очередь при остановке сервиса
+            dead_letter_rows = 0
+            for name in os.listdir(tmp):
+                if name.startswith("attendance_dead_letter.ndjson"):
+                    with open(os.path.join(tmp, name), encoding="utf-8") as f:
+                        dead_letter_rows += sum(1 for line in f if line.strip())
+
+            conn = sqlite3.connect(os.path.join(tmp, "bench.db"))
+            try:
+                stored_rows = conn.execute("SELECT COUNT(*) FROM SESSION_DATA").fetchone()[0]
+                stored_users = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+                stored_duplicates = conn.execute("""
+                    SELECT COALESCE(SUM(n - 1), 0) FROM (
+                        SELECT COUNT(*) AS n FROM SESSION_DATA
+                        GROUP BY user_id, subject_id, teacher_id, date(session_time)
+                        HAVING n > 1
+                    )
+                """).fetchone()[0]
+            finally:
+                conn.close()
+    finally:
+        stub.shutdown()
+
+    latencies = sorted(results.latencies)
+    return {
+        "workers": workers,
+        "scans": len(scans),
+        "elapsed": elapsed,
+        "throughput": len(latencies) / elapsed,
+        "accepted_per_second": sum(results.accepted.values()) / elapsed,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": latencies[-1] if latencies else 0.0,
+        "statuses": dict(sorted(results.statuses.items())),
+        "transport_errors": results.transport_errors,
+        "lock_errors": results.lock_errors,
+        "duplicate_acceptances": sum(count - 1 for count in results.accepted.values() if count > 1),
+        "accepted": sum(results.accepted.values()),
+        "stored_rows": stored_rows,
+        "stored_users": stored_users,
+        "stored_duplicates": stored_duplicates,
+        "rows_dead_lettered": writer_metrics.get("rows_dead_lettered", 0),
+        "dead_letter_rows": dead_letter_rows,
+    }
+
+
+def print_report(args, summary):
+    print(f"Сканирований: {summary['scans']:,} ({args.lessons} занятий x {args.students} студентов, "
+          f"кривая {args.curve}, окно {args.window:g} с, воркеров {summary['workers']})")
+    print(f"Время: {summary['elapsed']:.2f} с, пропускная способность: {summary['throughput']:,.0f} запросов/с, "
+          f"принято {summary['accepted_per_second']:,.0f} посещений/с")
+    print(f"Задержка: p50 {summary['p50'] * 1000:.1f} мс, p95 {summary['p95'] * 1000:.1f} мс, "
+          f"p99 {summary['p99'] * 1000:.1f} мс, max {summary['max'] * 1000:.1f} мс")
+    print(f"Коды ответов: {summary['statuses']}, ошибок соединения: {summary['transport_errors']}")
+    print(f"Ошибок блокировки SQLite: {summary['lock_errors']}")
+    print(f"Повторно принятых кодов (тот же QR и студент): {summary['duplicate_acceptances']}")
+    print(f"Записей в SESSION_DATA: {summary['stored_rows']:,} из {summary['accepted']:,} подтвержденных, "
+          f"лишних записей студента на занятии: {summary['stored_duplicates']:,}, "
+          f"пользователей: {summary['stored_users']:,}")
+    print(f"Отложено писателем: {summary['rows_dead_lettered']:,}, "
+          f"осталось в файле недописанных пачек: {summary['dead_letter_rows']:,}")
+
+
+def check_summary(summary):
+    """Ошибки сохранности: каждое подтвержденное посещение должно быть в SESSION_DATA"""
+    errors = []
+    if summary["rows_dead_lettered"]:
+        errors.append(f"писатель отложил {summary['rows_dead_lettered']} строк")
+    if summary["dead_letter_rows"]:
+        errors.append(f"в файле недописанных пачек {summary['dead_letter_rows']} строк")
+    if summary["stored_rows"] != summary["accepted"]:
+        errors.append(f"в SESSION_DATA {summary['stored_rows']} строк, подтверждено {summary['accepted']}")
+    if summary["lock_errors"]:
+        errors.append(f"ошибок блокировки SQLite: {summary['lock_errors']}")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест сканирования QR-кодов")
+    parser.add_argument("--students", type=int, default=300, help="студентов на занятии (K)")
+    parser.add_argument("--lessons", type=int, default=10, help="одновременных занятий (L)")
+    parser.add_argument("--curve", choices=["burst", "uniform", "ramp", "front"], default="front")
+    parser.add_argument("--window", type=float, default=10, help="длительность прихода студентов (секунды)")
+    parser.add_argument("--lesson-stagger", type=float, default=0, help="сдвиг начала соседних занятий (секунды)")
+    parser.add_argument("--concurrency", type=int, default=64, help="одновременных клиентских соединений")
+    parser.add_argument("--workers", type=int, default=1, help="воркеров uvicorn")
+    parser.add_argument("--sweep", help="список числа воркеров через запятую, например 1,2,4,8")
+    parser.add_argument("--duplicate-rate", type=float, default=0.05, help="доля повторных сканирований того же кода")
+    parser.add_argument("--stub-latency-ms", type=float, default=20, help="задержка ответов заглушек")
+    parser.add_argument("--shared-students", action="store_true",
+                        help="одни и те же студенты на всех занятиях (одновременные сканы одного студента)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--check", action="store_true", help="завершиться с ошибкой, если посещения потеряны")
+    args = parser.parse_args()
+
+    if not args.sweep:
+        summary = run_scenario(args, args.workers)
+        print_report(args, summary)
+        if args.check:
+            errors = check_summary(summary)
+            if errors:
+                sys.exit("Проверка не пройдена: " + "; ".join(errors))
+            print("Проверка пройдена")
+        return
+
+    summaries = []
+    failures = []
+    for workers in [int(value) for value in args.sweep.split(",")]:
+        summary = run_scenario(args, workers)
+        print_report(args, summary)
+        print()
+        summaries.append(summary)
+        if args.check:
+            failures.extend(f"{workers} воркеров: {error}" for error in check_summary(summary))
+
+    base = summaries[0]["throughput"]
+    print(f"{'воркеров':>8} {'запросов/с':>11} {'ускорение':>10} {'p50, мс':>9} {'p99, мс':>9} "
+          f"{'блокировки':>11} {'дубли':>6}")
+    for summary in summaries:
+        print(f"{summary['workers']:>8} {summary['throughput']:>11,.0f} {summary['throughput'] / base:>9.2f}x "
+              f"{summary['p50'] * 1000:>9.1f} {summary['p99'] * 1000:>9.1f} "
+              f"{summary['lock_errors']:>11} {summary['duplicate_acceptances'] + summary['stored_duplicates']:>6}")
+
+    if failures:
+        sys.exit("Проверка не пройдена: " + "; ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Бенчмарк выборок посещаемости до и после миграции SESSION_DATA
+(целочисленный session_epoch, составные индексы и сводные таблицы).
+
+Создает синтетическую таблицу в старой схеме, замеряет старые запросы,
+выполняет миграцию database.create_tables() и замеряет новые.
+
+Запуск: python bench_sessions.py [--rows 5000000] [--users 5000] [--repeat 20]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import database
+
+LEGACY_SCHEMA = """
+    CREATE TABLE SESSION_DATA (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        session_time TIMESTAMP NOT NULL,
+        subject_id INTEGER,
+        shift_id INTEGER,
+        teacher_id INTEGER,
+        day_of_week INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+LEGACY_STATS_QUERY = """
+    SELECT subject_id, shift_id, teacher_id, day_of_week,
+           COUNT(*) as attendance_count, MAX(created_at) as created_at, MAX(session_time) as session_time
+    FROM SESSION_DATA
+    WHERE 1=1 {filters}
+    GROUP BY subject_id, shift_id, teacher_id, day_of_week
+    ORDER BY attendance_count DESC
+"""
+
+START_DATE, END_DATE = "01.09.2023", "31.12.2023"
+ISO_START, ISO_END = "2023-09-01 00:00:00", "2023-12-31 23:59:59"
+
+
+def fill(conn, rows, users):
+    # Три учебных года: 300 еженедельных занятий, каждое в свой день недели и смену
+    start = int(time.mktime((2022, 9, 5, 0, 0, 0, 0, 0, -1)))
+    weeks = 3 * 52
+    conn.execute(LEGACY_SCHEMA)
+    conn.execute(f"""
+        WITH RECURSIVE seq(n) AS (SELECT 0 UNION ALL SELECT n + 1 FROM seq WHERE n < {rows - 1}),
+        lessons AS (
+            SELECT n % 300 AS lesson, (n / 300) % {weeks} AS week, abs(random()) % {users} + 1 AS user_id
+            FROM seq
+        )
+        INSERT INTO SESSION_DATA (user_id, session_time, subject_id, shift_id, teacher_id, day_of_week)
+        SELECT
+            user_id,
+            datetime({start} + week * 604800 + (lesson % 6) * 86400 + (8 + lesson % 6 * 2) * 3600 + lesson % 600,
+                     'unixepoch', 'localtime') || '.000000',
+            lesson % 40 + 1,
+            lesson % 6 + 1,
+            lesson % 150 + 1,
+            lesson % 6
+        FROM lessons
+    """)
+    conn.commit()
+
+
+def measure(name, func, repeat):
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed_ms = (time.perf_counter() - start) * 1000 / repeat
+    print(f"  {name:<40} {elapsed_ms:>10.2f} мс")
+    return elapsed_ms
+
+
+def run_legacy(conn, user_id, repeat):
+    print("До миграции:")
+    measure("/sessions/{user_id}", lambda: conn.execute(
+        "SELECT * FROM SESSION_DATA WHERE user_id = ? ORDER BY session_time DESC", (user_id,)
+    ).fetchall(), repeat)
+    measure("сессии пользователя за период", lambda: conn.execute(
+        "SELECT COUNT(*) FROM SESSION_DATA WHERE user_id = ? AND session_time >= ? AND session_time <= ?",
+        (user_id, ISO_START, ISO_END)
+    ).fetchall(), repeat)
+    measure("/stats (весь период)", lambda: conn.execute(
+        LEGACY_STATS_QUERY.format(filters="")
+    ).fetchall(), max(1, repeat // 10))
+    measure("/stats (семестр)", lambda: conn.execute(
+        LEGACY_STATS_QUERY.format(filters="AND session_time >= ? AND session_time <= ?"), (ISO_START, ISO_END)
+    ).fetchall(), max(1, repeat // 10))
+    measure("/stats/user/{user_id} (семестр)", lambda: conn.execute(
+        LEGACY_STATS_QUERY.format(filters="AND user_id = ? AND session_time >= ? AND session_time <= ?"),
+        (user_id, ISO_START, ISO_END)
+    ).fetchall(), repeat)
+
+
+def run_migrated(conn, user_id, repeat):
+    start_epoch, end_epoch = database.date_range_to_epoch(START_DATE, END_DATE)
+    print("После миграции:")
+    measure("/sessions/{user_id}", lambda: database.get_user_sessions(user_id), repeat)
+    measure("сессии пользователя за период", lambda: conn.execute(
+        "SELECT COUNT(*) FROM SESSION_DATA WHERE user_id = ? AND session_epoch >= ? AND session_epoch < ?",
+        (user_id, start_epoch, end_epoch)
+    ).fetchall(), repeat)
+    measure("/stats (весь период)", lambda: database.get_session_stats(), max(1, repeat // 10))
+    measure("/stats (семестр)", lambda: database.get_session_stats(START_DATE, END_DATE), max(1, repeat // 10))
+    measure("/stats/user/{user_id} (семестр)",
+            lambda: database.get_user_session_stats(user_id, START_DATE, END_DATE), repeat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк запросов к SESSION_DATA")
+    parser.add_argument("--rows", type=int, default=5000000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.db_path = os.path.join(tmp, "bench.db")
+        conn = database.get_db_connection()
+
+        start = time.perf_counter()
+        fill(conn, args.rows, args.users)
+        print(f"Сгенерировано {args.rows:,} строк за {time.perf_counter() - start:.1f} с")
+
+        run_legacy(conn, 42, args.repeat)
+
+        start = time.perf_counter()
+        database.create_tables()
+        print(f"Миграция (epoch, индексы, сводные таблицы): {time.perf_counter() - start:.1f} с")
+
+        run_migrated(conn, 42, args.repeat)
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
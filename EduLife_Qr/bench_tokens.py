@@ -0,0 +1,35 @@
+"""
+Микро-бенчмарк проверки QR-токенов: сравнивает бинарный подписанный формат v2
+со старым JSON-форматом.
+
+Запуск: python bench_tokens.py [--iterations 200000]
+"""
+import argparse
+import time
+
+import token_generator
+from token_generator import generate_qr_token, generate_legacy_qr_token, validate_qr_token
+
+
+def bench(name, token, iterations):
+    validate = validate_qr_token
+    start = time.perf_counter()
+    for _ in range(iterations):
+        validate(token)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<8} размер={len(token):>4} симв.  {iterations / elapsed:>12,.0f} проверок/с")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк проверки QR-токенов")
+    parser.add_argument("--iterations", type=int, default=200000)
+    args = parser.parse_args()
+
+    # Старый формат по умолчанию отклоняется, для сравнения включаем его явно
+    token_generator.ACCEPT_LEGACY_TOKENS = True
+    bench("legacy", generate_legacy_qr_token(12, 3, 45), args.iterations)
+    bench("v2", generate_qr_token(12, 3, 45), args.iterations)
+
+
+if __name__ == "__main__":
+    main()
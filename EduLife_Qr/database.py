@@ -1,11 +1,24 @@
 import sqlite3
 import os
-from datetime import datetime
+import json
+import hashlib
+import stat
+from contextlib import contextmanager
+from pathlib import Path
+from datetime import datetime, date, time, timedelta
+import attendance_bitmap
 
-db_path = os.path.join(os.path.dirname(__file__), "database.db")
+db_path = os.getenv("QR_DB_PATH", os.path.join(os.path.dirname(__file__), "database.db"))
 
-def get_db_connection():
-    conn = sqlite3.connect(db_path)
+# Каталог с архивными разделами SESSION_DATA (по одному файлу на закрытый семестр)
+archive_dir = os.getenv("QR_ARCHIVE_DIR", os.path.join(os.path.dirname(__file__), "archive"))
+
+# Версия схемы (PRAGMA user_version), начиная с которой session_epoch заполнен у всех записей
+SESSION_EPOCH_SCHEMA_VERSION = 1
+
+def get_db_connection(check_same_thread=True):
+    # URI-режим нужен, чтобы подключать архивные разделы только для чтения (mode=ro)
+    conn = sqlite3.connect(Path(db_path).resolve().as_uri(), uri=True, check_same_thread=check_same_thread)
     conn.row_factory = sqlite3.Row
     return conn
 
@@ -13,6 +26,9 @@ def create_tables():
     conn = get_db_connection()
     cursor = conn.cursor()
 
+    # WAL позволяет читать базу параллельно с записью посещений
+    cursor.execute("PRAGMA journal_mode=WAL")
+
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -32,13 +48,166 @@ def create_tables():
             teacher_id INTEGER,
             day_of_week INTEGER,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            session_epoch INTEGER,
             FOREIGN KEY (user_id) REFERENCES users(id)
         )
     """)
 
+    _migrate_session_epoch(cursor)
+
+    # Использованные QR-токены (общие для всех воркеров при QR_REPLAY_BACKEND=sqlite)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS used_qr_tokens (
+            token_key TEXT PRIMARY KEY,
+            bucket INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_used_qr_tokens_bucket ON used_qr_tokens (bucket)")
+
+    # Расширенные данные о посещении, собранные асинхронно (QR_ENRICHMENT_MODE=async)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS session_details (
+            session_key TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_session_details_created_at ON session_details (created_at)")
+
+    # Сводные таблицы посещаемости, обновляются в той же транзакции, что и SESSION_DATA
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'attendance_rollup'")
+    rollup_exists = cursor.fetchone() is not None
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS attendance_rollup (
+            session_date TEXT NOT NULL,
+            subject_id INTEGER,
+            shift_id INTEGER,
+            teacher_id INTEGER,
+            day_of_week INTEGER,
+            user_id INTEGER NOT NULL,
+            attendance_count INTEGER NOT NULL,
+            session_time TIMESTAMP,
+            created_at TIMESTAMP,
+            PRIMARY KEY (session_date, subject_id, shift_id, teacher_id, day_of_week, user_id)
+        )
+    """)
+
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_attendance_rollup_user ON attendance_rollup (user_id, session_date)"
+    )
+
+    # Та же сводка без разбивки по студентам - для общей статистики /stats
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS attendance_lesson_rollup (
+            session_date TEXT NOT NULL,
+            subject_id INTEGER,
+            shift_id INTEGER,
+            teacher_id INTEGER,
+            day_of_week INTEGER,
+            attendance_count INTEGER NOT NULL,
+            session_time TIMESTAMP,
+            created_at TIMESTAMP,
+            PRIMARY KEY (session_date, subject_id, shift_id, teacher_id, day_of_week)
+        )
+    """)
+
+    # Плотные индексы студентов - номера битов в битовых картах посещаемости
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS student_index (
+            idx INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL UNIQUE
+        )
+    """)
+
+    # Битовая карта отметившихся студентов для каждого проведенного занятия
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'lesson_bitmap'")
+    bitmap_exists = cursor.fetchone() is not None
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS lesson_bitmap (
+            subject_id INTEGER,
+            teacher_id INTEGER,
+            session_date TEXT NOT NULL,
+            shift_id INTEGER,
+            bitmap BLOB NOT NULL,
+            PRIMARY KEY (subject_id, teacher_id, session_date, shift_id)
+        )
+    """)
+
+    # Битовая карта состава группы (из сервиса авторизации)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS group_roster_bitmap (
+            group_id INTEGER PRIMARY KEY,
+            bitmap BLOB NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Поколение данных о посещениях: увеличивается при каждой записи в SESSION_DATA,
+    # по нему сбрасываются кэши статистики во всех воркерах
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sessions_generation (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            generation INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("INSERT OR IGNORE INTO sessions_generation (id, generation) VALUES (1, 0)")
+
+    # Архивные разделы SESSION_DATA: закрытые семестры в отдельных файлах только для чтения
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS session_partitions (
+            term TEXT PRIMARY KEY,
+            file_name TEXT NOT NULL,
+            start_epoch INTEGER NOT NULL,
+            end_epoch INTEGER NOT NULL,
+            row_count INTEGER NOT NULL,
+            checksum TEXT NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
     conn.commit()
     conn.close()
 
+    if not rollup_exists:
+        rebuild_attendance_rollup()
+    elif not bitmap_exists:
+        rebuild_lesson_bitmaps()
+
+def _migrate_session_epoch(cursor):
+    """
+    Добавляет в SESSION_DATA целочисленное время посещения (Unix epoch),
+    заполняет его для старых записей и создает индексы для выборок по диапазону.
+    Заполнение - полный проход по таблице, поэтому выполняется один раз:
+    после него в PRAGMA user_version записывается SESSION_EPOCH_SCHEMA_VERSION
+    """
+    cursor.execute("PRAGMA user_version")
+    if cursor.fetchone()[0] < SESSION_EPOCH_SCHEMA_VERSION:
+        cursor.execute("PRAGMA table_info(SESSION_DATA)")
+        if "session_epoch" not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE SESSION_DATA ADD COLUMN session_epoch INTEGER")
+
+        # session_time хранится в локальном времени сервера
+        cursor.execute("""
+            UPDATE SESSION_DATA
+            SET session_epoch = CAST(strftime('%s', session_time, 'utc') AS INTEGER)
+            WHERE session_epoch IS NULL
+        """)
+        # Версия схемы меняется в той же транзакции, что и заполнение
+        cursor.execute(f"PRAGMA user_version = {SESSION_EPOCH_SCHEMA_VERSION}")
+
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_session_data_user_epoch ON SESSION_DATA (user_id, session_epoch)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_session_data_teacher_subject_epoch "
+        "ON SESSION_DATA (teacher_id, subject_id, session_epoch)"
+    )
+
 def close_db_connection(conn):
     conn.close()
 
@@ -56,123 +225,748 @@ def add_user(username, password):
     finally:
         conn.close()
 
-def get_user_sessions(user_id):
+def insert_sessions(cursor, rows):
+    """
+    Записывает посещения в SESSION_DATA и сводные таблицы в рамках текущей транзакции.
+    Строка: (user_id, session_time, subject_id, shift_id, teacher_id, day_of_week)
+    """
+    params = [_session_params(row) for row in rows]
+    cursor.executemany(
+        """INSERT INTO SESSION_DATA
+           (user_id, session_time, subject_id, shift_id, teacher_id, day_of_week, session_epoch)
+           VALUES (:user_id, :session_time, :subject_id, :shift_id, :teacher_id, :day_of_week, :session_epoch)""",
+        params
+    )
+    cursor.executemany(
+        """INSERT INTO attendance_rollup
+           (session_date, subject_id, shift_id, teacher_id, day_of_week, user_id,
+            attendance_count, session_time, created_at)
+           VALUES (date(:session_time), :subject_id, :shift_id, :teacher_id, :day_of_week, :user_id,
+                   1, :session_time, CURRENT_TIMESTAMP)
+           ON CONFLICT (session_date, subject_id, shift_id, teacher_id, day_of_week, user_id) DO UPDATE SET
+               attendance_count = attendance_count + 1,
+               session_time = MAX(session_time, excluded.session_time),
+               created_at = excluded.created_at""",
+        params
+    )
+    cursor.executemany(
+        """INSERT INTO attendance_lesson_rollup
+           (session_date, subject_id, shift_id, teacher_id, day_of_week,
+            attendance_count, session_time, created_at)
+           VALUES (date(:session_time), :subject_id, :shift_id, :teacher_id, :day_of_week,
+                   1, :session_time, CURRENT_TIMESTAMP)
+           ON CONFLICT (session_date, subject_id, shift_id, teacher_id, day_of_week) DO UPDATE SET
+               attendance_count = attendance_count + 1,
+               session_time = MAX(session_time, excluded.session_time),
+               created_at = excluded.created_at""",
+        params
+    )
+    _update_lesson_bitmaps(cursor, params)
+    bump_sessions_generation(cursor)
+
+def record_sessions(rows, users=()):
+    """
+    Записывает посещения одной транзакцией, добавляя в users пользователей
+    из сервиса авторизации, которых еще нет локально. users: [(id, username), ...]
+    """
     conn = get_db_connection()
     cursor = conn.cursor()
-
     try:
+        if users:
+            cursor.executemany(
+                "INSERT OR IGNORE INTO users (id, username, password) VALUES (?, ?, 'imported_user')", users
+            )
+        insert_sessions(cursor, rows)
+        conn.commit()
+    except Exception:
+        # Курсор закрывается до отката: незавершенный запрос, на который ссылается
+        # трассировка исключения, иначе держит блокировку записи до сборки мусора
+        cursor.close()
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def bump_sessions_generation(cursor):
+    cursor.execute("UPDATE sessions_generation SET generation = generation + 1 WHERE id = 1")
+
+def _student_indices(cursor, user_ids):
+    """Плотные индексы студентов, новым студентам индекс назначается при первом обращении"""
+    user_ids = set(user_ids)
+    cursor.executemany("INSERT OR IGNORE INTO student_index (user_id) VALUES (?)", [(u,) for u in user_ids])
+    indices = {}
+    user_ids = list(user_ids)
+    # Ограничение SQLite на число параметров запроса
+    for start in range(0, len(user_ids), 500):
+        chunk = user_ids[start:start + 500]
         cursor.execute(
-            "SELECT * FROM SESSION_DATA WHERE user_id = ? ORDER BY session_time DESC",
-            (user_id,)
+            f"SELECT user_id, idx FROM student_index WHERE user_id IN ({','.join('?' * len(chunk))})",
+            chunk
         )
-        return [dict(row) for row in cursor.fetchall()]
+        indices.update((row[0], row[1]) for row in cursor.fetchall())
+    return indices
+
+def _update_lesson_bitmaps(cursor, params):
+    """Устанавливает биты отметившихся студентов в картах занятий"""
+    indices = _student_indices(cursor, [p["user_id"] for p in params])
+    lessons = {}
+    for p in params:
+        key = (p["subject_id"], p["teacher_id"], p["session_time"][:10], p["shift_id"])
+        lessons[key] = lessons.get(key, 0) | (1 << indices[p["user_id"]])
+
+    for key, bits in lessons.items():
+        cursor.execute(
+            """SELECT bitmap FROM lesson_bitmap
+               WHERE subject_id IS ? AND teacher_id IS ? AND session_date = ? AND shift_id IS ?""",
+            key
+        )
+        row = cursor.fetchone()
+        if row is not None:
+            cursor.execute(
+                """UPDATE lesson_bitmap SET bitmap = ?
+                   WHERE subject_id IS ? AND teacher_id IS ? AND session_date = ? AND shift_id IS ?""",
+                (attendance_bitmap.to_blob(attendance_bitmap.from_blob(row[0]) | bits),) + key
+            )
+        else:
+            cursor.execute(
+                """INSERT INTO lesson_bitmap (subject_id, teacher_id, session_date, shift_id, bitmap)
+                   VALUES (?, ?, ?, ?, ?)""",
+                key + (attendance_bitmap.to_blob(bits),)
+            )
+
+def _session_params(row):
+    user_id, session_time, subject_id, shift_id, teacher_id, day_of_week = row
+    return {
+        "user_id": user_id,
+        "session_time": str(session_time),
+        "session_epoch": int(session_time.timestamp()),
+        "subject_id": subject_id,
+        "shift_id": shift_id,
+        "teacher_id": teacher_id,
+        "day_of_week": day_of_week,
+    }
+
+_ROLLUP_SELECT = """
+    SELECT
+        date(session_time), subject_id, shift_id, teacher_id, day_of_week, user_id,
+        COUNT(*), MAX(session_time), MAX(created_at)
+    FROM {schema}.SESSION_DATA
+    GROUP BY date(session_time), subject_id, shift_id, teacher_id, day_of_week, user_id
+"""
+
+def rebuild_attendance_rollup():
+    """Пересчитывает сводные таблицы посещаемости по SESSION_DATA и архивным разделам (для заполнения и восстановления)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        # Архивные разделы агрегируем до начала транзакции: внутри нее их нельзя отключить
+        archived = []
+        for partition in session_partitions(conn)[:-1]:
+            with attach_partition(conn, partition) as schema:
+                archived.extend(tuple(row) for row in conn.execute(_ROLLUP_SELECT.format(schema=schema)).fetchall())
+
+        cursor.execute("DELETE FROM attendance_rollup")
+        cursor.execute("DELETE FROM attendance_lesson_rollup")
+        cursor.execute(f"""
+            INSERT INTO attendance_rollup
+                (session_date, subject_id, shift_id, teacher_id, day_of_week, user_id,
+                 attendance_count, session_time, created_at)
+            {_ROLLUP_SELECT.format(schema="main")}
+        """)
+        cursor.executemany(
+            """INSERT INTO attendance_rollup
+                   (session_date, subject_id, shift_id, teacher_id, day_of_week, user_id,
+                    attendance_count, session_time, created_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT (session_date, subject_id, shift_id, teacher_id, day_of_week, user_id) DO UPDATE SET
+                   attendance_count = attendance_count + excluded.attendance_count,
+                   session_time = MAX(session_time, excluded.session_time),
+                   created_at = MAX(created_at, excluded.created_at)""",
+            archived
+        )
+        cursor.execute("""
+            INSERT INTO attendance_lesson_rollup
+                (session_date, subject_id, shift_id, teacher_id, day_of_week,
+                 attendance_count, session_time, created_at)
+            SELECT
+                session_date, subject_id, shift_id, teacher_id, day_of_week,
+                SUM(attendance_count), MAX(session_time), MAX(created_at)
+            FROM attendance_rollup
+            GROUP BY session_date, subject_id, shift_id, teacher_id, day_of_week
+        """)
+        bump_sessions_generation(cursor)
+        conn.commit()
+        cursor.execute("SELECT COUNT(*) FROM attendance_rollup")
+        rows = cursor.fetchone()[0]
+    except Exception:
+        conn.rollback()
+        raise
     finally:
         conn.close()
 
-def get_session_stats(start_date=None, end_date=None):
+    rebuild_lesson_bitmaps()
+    return rows
+
+def rebuild_lesson_bitmaps():
+    """Пересчитывает битовые карты занятий по сводной таблице attendance_rollup"""
     conn = get_db_connection()
     cursor = conn.cursor()
+    try:
+        cursor.execute("DELETE FROM lesson_bitmap")
+        cursor.execute("""
+            SELECT DISTINCT subject_id, teacher_id, session_date, shift_id, user_id
+            FROM attendance_rollup
+        """)
+        rows = cursor.fetchall()
+        indices = _student_indices(cursor, [row["user_id"] for row in rows])
+        lessons = {}
+        for row in rows:
+            key = (row["subject_id"], row["teacher_id"], row["session_date"], row["shift_id"])
+            lessons[key] = lessons.get(key, 0) | (1 << indices[row["user_id"]])
+        cursor.executemany(
+            """INSERT INTO lesson_bitmap (subject_id, teacher_id, session_date, shift_id, bitmap)
+               VALUES (?, ?, ?, ?, ?)""",
+            [key + (attendance_bitmap.to_blob(bits),) for key, bits in lessons.items()]
+        )
+        conn.commit()
+        return len(lessons)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
-    query = """
-        SELECT
-            subject_id,
-            shift_id,
-            teacher_id,
-            day_of_week,
-            COUNT(*) as attendance_count,
-            MAX(created_at) as created_at,
-            MAX(session_time) as session_time
-        FROM SESSION_DATA
-        WHERE 1=1
+def save_session_details(session_key, user_id, details):
+    conn = get_db_connection()
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO session_details (session_key, user_id, data) VALUES (?, ?, ?)",
+            (session_key, user_id, json.dumps(details, ensure_ascii=False))
+        )
+        # Храним детали не дольше суток
+        conn.execute("DELETE FROM session_details WHERE created_at < datetime('now', '-1 day')")
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_session_details(session_key):
+    conn = get_db_connection()
+    try:
+        row = conn.execute(
+            "SELECT user_id, data FROM session_details WHERE session_key = ?",
+            (session_key,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {"user_id": row["user_id"], "session_data": json.loads(row["data"])}
+    finally:
+        conn.close()
+
+def user_exists(user_id):
+    """Есть ли пользователь в локальной таблице users"""
+    conn = get_db_connection()
+    try:
+        return conn.execute("SELECT 1 FROM users WHERE id = ?", (user_id,)).fetchone() is not None
+    finally:
+        conn.close()
+
+def import_users(users):
+    """
+    Добавляет пользователей из сервиса авторизации в локальную таблицу users.
+    Уже существующие записи не изменяются. users: [(id, username), ...]
     """
+    conn = get_db_connection()
+    try:
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (id, username, password) VALUES (?, ?, 'imported_user')",
+            users
+        )
+        conn.commit()
+    finally:
+        conn.close()
 
-    params = []
+def save_group_roster(group_id, user_ids):
+    """Сохраняет состав группы в виде битовой карты плотных индексов студентов"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        indices = _student_indices(cursor, user_ids)
+        cursor.execute(
+            "INSERT OR REPLACE INTO group_roster_bitmap (group_id, bitmap) VALUES (?, ?)",
+            (group_id, attendance_bitmap.to_blob(attendance_bitmap.from_indices(indices.values())))
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_group_roster_bitmap(group_id, max_age_seconds):
+    """Битовая карта состава группы или None, если она не сохранена или устарела"""
+    conn = get_db_connection()
+    try:
+        row = conn.execute(
+            """SELECT bitmap FROM group_roster_bitmap
+               WHERE group_id = ? AND updated_at >= datetime('now', ?)""",
+            (group_id, f"-{int(max_age_seconds)} seconds")
+        ).fetchone()
+        return attendance_bitmap.from_blob(row[0]) if row is not None else None
+    finally:
+        conn.close()
+
+def _index_user_ids(conn, indices):
+    """Соответствие плотных индексов student_index и user_id"""
+    user_ids = {}
+    for start in range(0, len(indices), 500):
+        chunk = indices[start:start + 500]
+        user_ids.update((row[0], row[1]) for row in conn.execute(
+            f"SELECT idx, user_id FROM student_index WHERE idx IN ({','.join('?' * len(chunk))})",
+            chunk
+        ).fetchall())
+    return user_ids
+
+def roster_user_ids(roster):
+    """user_id студентов из битовой карты состава группы"""
+    conn = get_db_connection()
+    try:
+        return sorted(_index_user_ids(conn, attendance_bitmap.to_indices(roster)).values())
+    finally:
+        conn.close()
+
+def get_lesson_attendance(roster, subject_id, teacher_id, shift_id=None, start_date=None, end_date=None):
+    """
+    Посещаемость группы (битовая карта roster) по занятиям предмета преподавателя:
+    для каждого занятия - отметившиеся и отсутствовавшие студенты и процент посещения
+    """
+    query = "SELECT session_date, shift_id, bitmap FROM lesson_bitmap WHERE subject_id = ? AND teacher_id = ?"
+    params = [subject_id, teacher_id]
+    if shift_id is not None:
+        query += " AND shift_id = ?"
+        params.append(shift_id)
     if start_date:
-        # Преобразование даты из формата DD.MM.YYYY в ISO формат YYYY-MM-DD
+        query += " AND session_date >= ?"
+        params.append(parse_date(start_date).isoformat())
+    if end_date:
+        query += " AND session_date <= ?"
+        params.append(parse_date(end_date).isoformat())
+    query += " ORDER BY session_date, shift_id"
+
+    conn = get_db_connection()
+    try:
+        lessons = [
+            (row["session_date"], row["shift_id"], attendance_bitmap.from_blob(row["bitmap"]) & roster)
+            for row in conn.execute(query, params).fetchall()
+        ]
+        user_ids = _index_user_ids(conn, attendance_bitmap.to_indices(roster))
+    finally:
+        conn.close()
+
+    def to_user_ids(bitmap):
+        return [user_ids[idx] for idx in attendance_bitmap.to_indices(bitmap)]
+
+    roster_size = attendance_bitmap.count(roster)
+    result = []
+    attended_total = 0
+    for session_date, lesson_shift_id, attended in lessons:
+        attended_count = attendance_bitmap.count(attended)
+        attended_total += attended_count
+        result.append({
+            "session_date": session_date,
+            "shift_id": lesson_shift_id,
+            "attended": to_user_ids(attended),
+            "absent": to_user_ids(roster & ~attended),
+            "percentage": round(attended_count * 100 / roster_size, 1) if roster_size else 0.0
+        })
+
+    possible = roster_size * len(lessons)
+    return {
+        "roster_size": roster_size,
+        "lessons": result,
+        "percentage": round(attended_total * 100 / possible, 1) if possible else 0.0
+    }
+
+def get_sessions_generation():
+    """Текущее поколение данных о посещениях - меняется при каждой записи в SESSION_DATA"""
+    conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT generation FROM sessions_generation WHERE id = 1").fetchone()
+        return row[0] if row is not None else 0
+    finally:
+        conn.close()
+
+def count_lesson_attendees(subject_id, shift_id, teacher_id, session_date):
+    """Число разных студентов, отметившихся на занятии в указанный день"""
+    conn = get_db_connection()
+    try:
+        return conn.execute(
+            """SELECT COUNT(DISTINCT user_id) FROM attendance_rollup
+               WHERE session_date = ? AND subject_id = ? AND shift_id = ? AND teacher_id = ?""",
+            (parse_date(session_date).isoformat(), subject_id, shift_id, teacher_id)
+        ).fetchone()[0]
+    finally:
+        conn.close()
+
+def _user_sessions_query(schema, user_id, start_epoch=None, end_epoch=None, after=None):
+    query = f"SELECT * FROM {schema}.SESSION_DATA WHERE user_id = ?"
+    params = [user_id]
+
+    if start_epoch is not None:
+        query += " AND session_epoch >= ?"
+        params.append(start_epoch)
+    if end_epoch is not None:
+        query += " AND session_epoch < ?"
+        params.append(end_epoch)
+
+    # Курсор (session_epoch, id) последней строки предыдущей страницы
+    if after is not None:
+        query += " AND (session_epoch, id) < (?, ?)"
+        params.extend(after)
+
+    query += " ORDER BY session_epoch DESC, id DESC"
+    return query, params
+
+def get_user_sessions(user_id, limit=None, after=None, start_date=None, end_date=None):
+    """
+    Посещения пользователя от новых к старым. При заданном limit возвращает одну
+    страницу; следующая страница запрашивается с after=(session_epoch, id) последней строки.
+    """
+    start_epoch, end_epoch = date_range_to_epoch(start_date, end_date)
+    if after is not None:
+        end_epoch = min(end_epoch, after[0] + 1) if end_epoch is not None else after[0] + 1
+
+    conn = get_db_connection()
+    try:
+        sessions = []
+        # Разделы не пересекаются по времени: идем от новых к старым, пока не наберем страницу
+        for partition in reversed(session_partitions(conn, start_epoch, end_epoch)):
+            if limit is not None and len(sessions) >= limit:
+                break
+            with attach_partition(conn, partition) as schema:
+                query, params = _user_sessions_query(schema, user_id, start_epoch, end_epoch, after)
+                if limit is not None:
+                    query += " LIMIT ?"
+                    params.append(limit - len(sessions))
+                sessions.extend(dict(row) for row in conn.execute(query, params).fetchall())
+        return sessions
+    finally:
+        conn.close()
+
+def iter_user_sessions(user_id, start_date=None, end_date=None, chunk_size=500):
+    """Отдает посещения пользователя порциями прямо из курсора, не собирая весь список в памяти"""
+    start_epoch, end_epoch = date_range_to_epoch(start_date, end_date)
+
+    # Генератор может продолжаться в другом потоке пула
+    conn = get_db_connection(check_same_thread=False)
+    try:
+        for partition in reversed(session_partitions(conn, start_epoch, end_epoch)):
+            with attach_partition(conn, partition) as schema:
+                cursor = conn.execute(*_user_sessions_query(schema, user_id, start_epoch, end_epoch))
+                try:
+                    while True:
+                        rows = cursor.fetchmany(chunk_size)
+                        if not rows:
+                            break
+                        yield [dict(row) for row in rows]
+                finally:
+                    cursor.close()
+    finally:
+        conn.close()
+
+SESSION_COLUMNS = (
+    "id", "user_id", "session_time", "subject_id", "shift_id",
+    "teacher_id", "day_of_week", "created_at", "session_epoch"
+)
+
+def iter_sessions(start_date=None, end_date=None, subject_id=None, teacher_id=None, user_ids=None, chunk_size=1000):
+    """
+    Выгрузка SESSION_DATA по фильтру: кортежи в порядке SESSION_COLUMNS, порциями
+    по chunk_size строк прямо из курсора. Разделы читаются от старых к новым,
+    внутри раздела - в порядке записи (id), поэтому SQLite не сортирует выборку.
+    """
+    start_epoch, end_epoch = date_range_to_epoch(start_date, end_date)
+    query = f"SELECT {', '.join(SESSION_COLUMNS)} FROM {{schema}}.SESSION_DATA WHERE 1=1"
+    params = []
+    if start_epoch is not None:
+        query += " AND session_epoch >= ?"
+        params.append(start_epoch)
+    if end_epoch is not None:
+        query += " AND session_epoch < ?"
+        params.append(end_epoch)
+    if subject_id is not None:
+        query += " AND subject_id = ?"
+        params.append(subject_id)
+    if teacher_id is not None:
+        query += " AND teacher_id = ?"
+        params.append(teacher_id)
+    if user_ids is not None:
+        # Список студентов передается одним параметром, без ограничения на число переменных
+        query += " AND user_id IN (SELECT value FROM json_each(?))"
+        params.append(json.dumps(list(user_ids)))
+    query += " ORDER BY id"
+
+    # Генератор может продолжаться в другом потоке пула
+    conn = get_db_connection(check_same_thread=False)
+    conn.row_factory = None
+    try:
+        for partition in session_partitions(conn, start_epoch, end_epoch):
+            with attach_partition(conn, partition) as schema:
+                cursor = conn.execute(query.format(schema=schema), params)
+                try:
+                    while True:
+                        rows = cursor.fetchmany(chunk_size)
+                        if not rows:
+                            break
+                        yield rows
+                finally:
+                    cursor.close()
+    finally:
+        conn.close()
+
+def term_for_date(day):
+    """
+    Учебный семестр, в который попадает дата: (название, первый день, день после последнего).
+    Осенний семестр - с 1 сентября по 31 января, весенний - с 1 февраля по 31 августа.
+    """
+    if day.month >= 9:
+        return f"{day.year}-fall", date(day.year, 9, 1), date(day.year + 1, 2, 1)
+    if day.month == 1:
+        return f"{day.year - 1}-fall", date(day.year - 1, 9, 1), date(day.year, 2, 1)
+    return f"{day.year}-spring", date(day.year, 2, 1), date(day.year, 9, 1)
+
+def _local_epoch(day):
+    return int(datetime.combine(day, time.min).timestamp())
+
+def session_partitions(conn, start_epoch=None, end_epoch=None):
+    """
+    Источники SESSION_DATA, пересекающиеся с полуинтервалом [start_epoch, end_epoch),
+    от старых к новым: файлы архивных разделов, затем None - основная база
+    """
+    rows = conn.execute(
+        """SELECT file_name FROM session_partitions
+           WHERE (? IS NULL OR end_epoch > ?) AND (? IS NULL OR start_epoch < ?)
+           ORDER BY start_epoch""",
+        (start_epoch, start_epoch, end_epoch, end_epoch)
+    ).fetchall()
+    return [os.path.join(archive_dir, row[0]) for row in rows] + [None]
+
+@contextmanager
+def attach_partition(conn, partition):
+    """Подключает архивный раздел к соединению на время запроса; для основной базы ничего не делает"""
+    if partition is None:
+        yield "main"
+        return
+    conn.execute("ATTACH DATABASE ? AS archive", (Path(partition).resolve().as_uri() + "?mode=ro",))
+    try:
+        yield "archive"
+    finally:
+        conn.execute("DETACH DATABASE archive")
+
+def _file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_closed_terms(grace_days=7):
+    """
+    Семестры с записями в основной базе, закончившиеся не менее grace_days дней назад.
+    Семестры без записей пропускаются: следующий семестр берется по первой записи после конца текущего
+    """
+    terms = []
+    conn = get_db_connection()
+    try:
+        next_epoch = conn.execute("SELECT MIN(session_epoch) FROM main.SESSION_DATA").fetchone()[0]
+        while next_epoch is not None:
+            term, term_start, term_end = term_for_date(datetime.fromtimestamp(next_epoch).date())
+            if term_end + timedelta(days=grace_days) > date.today():
+                break
+            terms.append(term)
+            next_epoch = conn.execute(
+                "SELECT MIN(session_epoch) FROM main.SESSION_DATA WHERE session_epoch >= ?",
+                (_local_epoch(term_end),)
+            ).fetchone()[0]
+    finally:
+        conn.close()
+    return terms
+
+def archive_term(term, grace_days=7):
+    """
+    Переносит записи закрытого семестра из SESSION_DATA в отдельный файл раздела:
+    копирует строки, сжимает файл (VACUUM), считает SHA-256, делает файл только
+    для чтения и лишь затем удаляет строки из основной базы. Возвращает число перенесенных строк.
+    """
+    year, _, season = term.partition("-")
+    if season not in ("fall", "spring") or not year.isdigit():
+        raise ValueError(f"Неверное название семестра '{term}': ожидается YYYY-fall или YYYY-spring")
+    _, term_start, term_end = term_for_date(date(int(year), 9 if season == "fall" else 2, 1))
+    if term_end + timedelta(days=grace_days) > date.today():
+        raise ValueError(f"Семестр {term} еще не закрыт")
+    start_epoch, end_epoch = _local_epoch(term_start), _local_epoch(term_end)
+
+    os.makedirs(archive_dir, exist_ok=True)
+    file_name = f"sessions_{term}.db"
+    path = os.path.join(archive_dir, file_name)
+
+    conn = get_db_connection()
+    try:
+        if conn.execute("SELECT 1 FROM session_partitions WHERE term = ?", (term,)).fetchone():
+            raise ValueError(f"Семестр {term} уже перенесен в архив")
+
+        # Файл, оставшийся от прерванного переноса, не зарегистрирован и не используется
+        if os.path.exists(path):
+            os.chmod(path, stat.S_IRUSR | stat.S_IWUSR)
+            os.remove(path)
+
+        conn.execute("ATTACH DATABASE ? AS archive", (Path(path).resolve().as_uri(),))
         try:
-            # Разбиваем строку даты по точкам и переставляем части
-            day, month, year = start_date.split('.')
-            formatted_start_date = f"{year}-{month}-{day} 00:00:00"
-            query += " AND session_time >= ?"
-            params.append(formatted_start_date)
-        except ValueError:
-            # Если дата уже в подходящем формате или формат неверный, 
-            # используем как есть (SQLite вернет пустой результат при несоответствии)
-            query += " AND session_time >= ?"
-            params.append(start_date)
+            conn.execute("""
+                CREATE TABLE archive.SESSION_DATA (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    session_time TIMESTAMP NOT NULL,
+                    subject_id INTEGER,
+                    shift_id INTEGER,
+                    teacher_id INTEGER,
+                    day_of_week INTEGER,
+                    created_at TIMESTAMP,
+                    session_epoch INTEGER
+                )
+            """)
+            cursor = conn.execute(
+                """INSERT INTO archive.SESSION_DATA
+                   SELECT id, user_id, session_time, subject_id, shift_id, teacher_id,
+                          day_of_week, created_at, session_epoch
+                   FROM main.SESSION_DATA
+                   WHERE session_epoch >= ? AND session_epoch < ?""",
+                (start_epoch, end_epoch)
+            )
+            row_count = cursor.rowcount
+            conn.execute(
+                "CREATE INDEX archive.idx_session_data_user_epoch ON SESSION_DATA (user_id, session_epoch)"
+            )
+            conn.execute(
+                "CREATE INDEX archive.idx_session_data_teacher_subject_epoch "
+                "ON SESSION_DATA (teacher_id, subject_id, session_epoch)"
+            )
+            max_id = conn.execute("SELECT MAX(id) FROM archive.SESSION_DATA").fetchone()[0] or 0
+            conn.commit()
+        except Exception:
+            # Откат до DETACH: в открытой транзакции DETACH падает с "database archive is locked"
+            # и скрывает исходную ошибку
+            conn.rollback()
+            raise
+        finally:
+            conn.execute("DETACH DATABASE archive")
 
-    if end_date:
-        # Преобразование даты из формата DD.MM.YYYY в ISO формат YYYY-MM-DD
+        archive_conn = sqlite3.connect(path)
         try:
-            day, month, year = end_date.split('.')
-            formatted_end_date = f"{year}-{month}-{day} 23:59:59"
-            query += " AND session_time <= ?"
-            params.append(formatted_end_date)
-        except ValueError:
-            query += " AND session_time <= ?"
-            params.append(end_date)
+            archive_conn.execute("VACUUM")
+        finally:
+            archive_conn.close()
+        checksum = _file_checksum(path)
+        os.chmod(path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
 
-    query += """
-        GROUP BY subject_id, shift_id, teacher_id, day_of_week
-        ORDER BY attendance_count DESC
-    """
+        # Раздел становится видимым для запросов в той же транзакции, в которой строки удаляются из основной базы
+        cursor = conn.execute(
+            "DELETE FROM main.SESSION_DATA WHERE session_epoch >= ? AND session_epoch < ? AND id <= ?",
+            (start_epoch, end_epoch, max_id)
+        )
+        if cursor.rowcount != row_count:
+            conn.rollback()
+            raise RuntimeError(
+                f"Семестр {term}: скопировано {row_count} строк, к удалению {cursor.rowcount} - перенос отменен"
+            )
+        conn.execute(
+            """INSERT INTO session_partitions (term, file_name, start_epoch, end_epoch, row_count, checksum)
+               VALUES (?, ?, ?, ?, ?, ?)""",
+            (term, file_name, start_epoch, end_epoch, row_count, checksum)
+        )
+        conn.commit()
+        return row_count
+    finally:
+        conn.close()
 
+def verify_partitions():
+    """Сверяет контрольные суммы архивных разделов. Возвращает [(семестр, ok), ...]"""
+    conn = get_db_connection()
     try:
-        cursor.execute(query, params)
-        return [dict(row) for row in cursor.fetchall()]
+        rows = conn.execute("SELECT term, file_name, checksum FROM session_partitions ORDER BY start_epoch").fetchall()
     finally:
         conn.close()
+    results = []
+    for row in rows:
+        path = os.path.join(archive_dir, row["file_name"])
+        results.append((row["term"], os.path.exists(path) and _file_checksum(path) == row["checksum"]))
+    return results
 
-def get_user_session_stats(user_id, start_date=None, end_date=None):
+def vacuum_database():
     conn = get_db_connection()
-    cursor = conn.cursor()
+    try:
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+def parse_date(value):
+    """
+    Разбирает дату фильтра в формате DD.MM.YYYY или YYYY-MM-DD.
+    Выбрасывает ValueError, если дата некорректна.
+    """
+    if isinstance(value, date):
+        return value
+    for date_format in ("%d.%m.%Y", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value.strip(), date_format).date()
+        except ValueError:
+            continue
+    raise ValueError(f"Неверный формат даты '{value}': ожидается DD.MM.YYYY или YYYY-MM-DD")
+
+def date_range_to_epoch(start_date=None, end_date=None):
+    """
+    Переводит границы периода в полуинтервал [start, end) в секундах Unix epoch
+    (по локальному времени сервера). Отсутствующая граница возвращается как None.
+    """
+    start_epoch = end_epoch = None
+    if start_date:
+        start_epoch = int(datetime.combine(parse_date(start_date), time.min).timestamp())
+    if end_date:
+        end_epoch = int(datetime.combine(parse_date(end_date) + timedelta(days=1), time.min).timestamp())
+    return start_epoch, end_epoch
+
+def _rollup_stats(table, where_clauses, params, start_date=None, end_date=None):
+    if start_date:
+        where_clauses.append("session_date >= ?")
+        params.append(parse_date(start_date).isoformat())
+    if end_date:
+        where_clauses.append("session_date <= ?")
+        params.append(parse_date(end_date).isoformat())
 
-    query = """
+    query = f"""
         SELECT
             subject_id,
             shift_id,
             teacher_id,
             day_of_week,
-            COUNT(*) as attendance_count,
+            SUM(attendance_count) as attendance_count,
             MAX(created_at) as created_at,
             MAX(session_time) as session_time
-        FROM SESSION_DATA
-        WHERE user_id = ?
+        FROM {table}
     """
-
-    params = [user_id]
-    if start_date:
-        # Преобразование даты из формата DD.MM.YYYY в ISO формат YYYY-MM-DD
-        try:
-            # Разбиваем строку даты по точкам и переставляем части
-            day, month, year = start_date.split('.')
-            formatted_start_date = f"{year}-{month}-{day} 00:00:00"
-            query += " AND session_time >= ?"
-            params.append(formatted_start_date)
-        except ValueError:
-            # Если дата уже в подходящем формате или формат неверный, 
-            # используем как есть (SQLite вернет пустой результат при несоответствии)
-            query += " AND session_time >= ?"
-            params.append(start_date)
-
-    if end_date:
-        # Преобразование даты из формата DD.MM.YYYY в ISO формат YYYY-MM-DD
-        try:
-            day, month, year = end_date.split('.')
-            formatted_end_date = f"{year}-{month}-{day} 23:59:59"
-            query += " AND session_time <= ?"
-            params.append(formatted_end_date)
-        except ValueError:
-            query += " AND session_time <= ?"
-            params.append(end_date)
-
+    if where_clauses:
+        query += " WHERE " + " AND ".join(where_clauses)
     query += """
         GROUP BY subject_id, shift_id, teacher_id, day_of_week
         ORDER BY attendance_count DESC
     """
 
+    conn = get_db_connection()
     try:
+        cursor = conn.cursor()
         cursor.execute(query, params)
         return [dict(row) for row in cursor.fetchall()]
     finally:
-        conn.close()
\ No newline at end of file
+        conn.close()
+
+def get_session_stats(start_date=None, end_date=None):
+    return _rollup_stats("attendance_lesson_rollup", [], [], start_date, end_date)
+
+def get_user_session_stats(user_id, start_date=None, end_date=None):
+    return _rollup_stats("attendance_rollup", ["user_id = ?"], [user_id], start_date, end_date)
@@ -0,0 +1,111 @@
+import csv
+import io
+import json
+import os
+import zlib
+from typing import Iterable, Iterator, List
+
+import database
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Сколько строк SESSION_DATA читать из курсора и кодировать за один шаг
+EXPORT_CHUNK_SIZE = int(os.getenv("QR_EXPORT_CHUNK_SIZE", "5000"))
+EXPORT_GZIP_LEVEL = int(os.getenv("QR_EXPORT_GZIP_LEVEL", "6"))
+
+# Формат выгрузки: (Content-Type, расширение файла)
+EXPORT_FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+Chunks = Iterable[List[tuple]]
+
+
+def _csv(chunks: Chunks) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(database.SESSION_COLUMNS)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def _ndjson(chunks: Chunks) -> Iterator[bytes]:
+    columns = database.SESSION_COLUMNS
+    for rows in chunks:
+        yield "".join(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in rows).encode()
+
+
+class _ChunkSink(io.RawIOBase):
+    """Файл для ParquetWriter, из которого записанные байты забираются по мере готовности"""
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+def _parquet_schema():
+    int64, text = pyarrow.int64(), pyarrow.string()
+    types = {"session_time": text, "created_at": text}
+    return pyarrow.schema([(name, types.get(name, int64)) for name in database.SESSION_COLUMNS])
+
+
+def _parquet(chunks: Chunks, compression: str) -> Iterator[bytes]:
+    """Каждая порция строк записывается отдельной группой строк (row group) Parquet"""
+    schema = _parquet_schema()
+    sink = _ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema, compression=compression)
+    try:
+        for rows in chunks:
+            columns = [pyarrow.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+            writer.write_table(pyarrow.Table.from_arrays(columns, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def _gzip(parts: Iterator[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(EXPORT_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for part in parts:
+        data = compressor.compress(part)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_sessions(chunks: Chunks, export_format: str, gzip: bool = False) -> Iterator[bytes]:
+    """
+    Кодирует порции строк SESSION_DATA в выбранный формат по мере чтения из курсора.
+    CSV и NDJSON при gzip сжимаются потоково; Parquet сжимается внутри файла (кодек gzip).
+    """
+    if export_format == "parquet":
+        return _parquet(chunks, "gzip" if gzip else "snappy")
+    parts = _csv(chunks) if export_format == "csv" else _ndjson(chunks)
+    return _gzip(parts) if gzip else parts
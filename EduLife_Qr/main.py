@@ -1,17 +1,58 @@
 import os
-from fastapi import FastAPI, Body, HTTPException, Depends, Header
+import sys
+import shlex
+import multiprocessing
+from fastapi import FastAPI, Body, HTTPException, Depends, Header, BackgroundTasks, Query, WebSocket, WebSocketDisconnect, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+import asyncio
+import hashlib
+import json
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import time
 import database
 from datetime import datetime
 from typing import Dict, Optional, List
-from token_generator import generate_qr_token, validate_qr_token
-from api_integration import verify_token, get_user_info, get_user_schedule, save_attendance_with_details
+from token_generator import generate_qr_token, validate_qr_token, check_token_ids
+from replay_store import create_replay_store
+from attendance_writer import AttendanceWriter, WRITE_MODE
+from rate_limiter import create_limiter
+import analytics
+import export
+from api_integration import (
+    verify_token, verify_token_cached, get_user_info_cached, get_user_schedule, save_attendance_with_details,
+    build_attendance_details, get_cached_attendance_details, invalidate_schedules, schedule_target_cache, get_lesson_group_ids, get_group_students,
+    user_info_cache, TTLCache
+)
 
 # Настройка порта
 PORT = int(os.getenv("PORT", "8080"))
 
+# Режим запуска: "dev" - один процесс с автоперезагрузкой, "production" - QR_WORKERS воркеров uvicorn
+RUN_MODE = os.getenv("QR_RUN_MODE", "dev")
+
+# Явное подтверждение, что сервис работает в одном процессе (например, uvicorn --reload).
+# Без него воркер uvicorn/gunicorn с неизвестным числом воркеров считается одним из нескольких
+SINGLE_PROCESS = os.getenv("QR_SINGLE_PROCESS", "0") == "1"
+
+# Обогащение данных о посещении: "sync" - в запросе, "async" - после ответа (из кэша или в фоне)
+ENRICHMENT_MODE = os.getenv("QR_ENRICHMENT_MODE", "sync")
+
+# Предзагрузка списка студентов группы при генерации QR-кода
+PREFETCH_ROSTER = os.getenv("QR_PREFETCH_ROSTER", "1") == "1"
+
+# Интервалы push-канала QR-кода (секунды): смена токена и обновление счетчика отметившихся
+QR_PUSH_TOKEN_INTERVAL = int(os.getenv("QR_PUSH_TOKEN_INTERVAL", "10"))
+QR_PUSH_COUNT_INTERVAL = int(os.getenv("QR_PUSH_COUNT_INTERVAL", "2"))
+
+# Время, в течение которого сохраненный состав группы считается актуальным (секунды)
+ROSTER_MAX_AGE = int(os.getenv("QR_ROSTER_MAX_AGE", "86400"))
+
+# Офлайн-сканирования: максимальный размер пачки и максимальный возраст сканирования (секунды)
+BATCH_MAX_SIZE = int(os.getenv("QR_BATCH_MAX_SIZE", "500"))
+OFFLINE_SCAN_MAX_AGE = int(os.getenv("QR_OFFLINE_SCAN_MAX_AGE", "21600"))
+
 app = FastAPI(
     title="EduLife QR API",
     description="API для генерации и проверки QR-кодов для учета посещаемости",
@@ -27,7 +68,38 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-used_tokens = set()
+# Использованные QR-токены (ключ - токен и пользователь, корзины по времени истечения)
+replay_store = create_replay_store()
+
+# Пакетная запись посещений (QR_ATTENDANCE_WRITE_MODE=batch)
+attendance_writer = AttendanceWriter() if WRITE_MODE == "batch" else None
+
+# Кэш ответов статистики: (поколение данных, результат); сбрасывается при записи посещений
+STATS_CACHE_TTL = int(os.getenv("QR_STATS_CACHE_TTL", "300"))
+stats_cache = TTLCache(ttl=STATS_CACHE_TTL, max_size=1024)
+
+# Ограничение частоты запросов: "<запросов>/<секунд>" отдельно по пользователю (id из токена) и по IP.
+# С одного IP (NAT аудитории) могут сканировать все студенты потока, поэтому лимит по IP выше
+rate_limiters = {
+    "qr": (
+        create_limiter("QR_RATE_LIMIT_QR_USER", "30/60"),
+        create_limiter("QR_RATE_LIMIT_QR_IP", "300/60")
+    ),
+    "validate_qr": (
+        create_limiter("QR_RATE_LIMIT_VALIDATE_QR_USER", "10/60"),
+        create_limiter("QR_RATE_LIMIT_VALIDATE_QR_IP", "600/60")
+    ),
+    "validate_qr_batch": (
+        create_limiter("QR_RATE_LIMIT_VALIDATE_QR_BATCH_USER", "5/60"),
+        create_limiter("QR_RATE_LIMIT_VALIDATE_QR_BATCH_IP", "60/60")
+    ),
+}
+
+# Занятия, для которых список студентов уже загружен: (subject_id, teacher_id, дата).
+# Каждое занятие предзагружается один раз в день: дата входит в ключ, запись живет сутки
+prefetched_lessons = TTLCache(ttl=86400)
+# Пользователи, которые уже есть в локальной таблице users (или поставлены в очередь на запись)
+known_users = TTLCache(ttl=86400)
 
 class QRRequest(BaseModel):
     subject_id: int
@@ -46,9 +118,33 @@ class ValidateResponse(BaseModel):
     message: str
     session_data: Optional[Dict] = None
 
+class BatchScan(BaseModel):
+    user_id: int
+    qr_code: str
+    scanned_at: datetime
+
+class BatchValidateRequest(BaseModel):
+    scans: List[BatchScan]
+
+class BatchScanResult(BaseModel):
+    index: int
+    success: bool
+    message: str
+    session_key: Optional[str] = None
+
+class BatchValidateResponse(BaseModel):
+    accepted: int
+    results: List[BatchScanResult]
+
+class ScheduleInvalidateRequest(BaseModel):
+    group_ids: List[int] = []
+    teacher_ids: List[int] = []
+    user_ids: List[int] = []
+
 class UserSessionsResponse(BaseModel):
     user_id: int
     sessions: List[Dict]
+    next_cursor: Optional[str] = None
 
 # Функции для проверки авторизации
 async def get_current_user(authorization: str = Header(None)):
@@ -63,122 +159,544 @@ async def get_current_user(authorization: str = Header(None)):
     
     return user
 
+async def get_current_user_cached(authorization: str = Header(None)):
+    """Как get_current_user, но результат проверки токена кратковременно кэшируется"""
+    if authorization is None or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Не предоставлен токен авторизации")
+
+    user = verify_token_cached(authorization.replace("Bearer ", ""))
+    if not user:
+        raise HTTPException(status_code=401, detail="Недействительный токен авторизации")
+
+    return user
+
+def cached_stats_response(key: tuple, if_none_match: Optional[str], compute):
+    """
+    Отдает результат compute() из кэша, пока не изменилось поколение данных о посещениях.
+    ETag строится по ключу и поколению: если он совпал с If-None-Match - ответ 304 без тела
+    """
+    generation = database.get_sessions_generation()
+    etag = f'"{generation}-{hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:16]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+    if if_none_match and etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    cached = stats_cache.get(key)
+    if cached is None or cached[0] != generation:
+        cached = (generation, compute())
+        stats_cache.set(key, cached)
+    return JSONResponse(cached[1], headers=headers)
+
+def normalize_date(value: Optional[str]) -> Optional[str]:
+    """Приводит дату фильтра к YYYY-MM-DD, чтобы разные записи одной даты давали один ключ кэша"""
+    if not value:
+        return None
+    try:
+        return database.parse_date(value).isoformat()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def rate_limit(endpoint: str):
+    """
+    Зависимость, отклоняющая лишние запросы с кодом 429. Объявляется первой
+    среди зависимостей эндпоинта: лимит по IP проверяется до проверки токена и работы с БД,
+    лимит по пользователю - по id из проверенного токена (проверка кэшируется), а не по
+    заголовку Authorization, который клиент может менять в каждом запросе
+    """
+    user_limiter, ip_limiter = rate_limiters[endpoint]
+
+    def check(request: Request, authorization: str = Header(None)):
+        retry_after = 0
+        if ip_limiter is not None and request.client is not None:
+            retry_after = ip_limiter.acquire(request.client.host)
+        if not retry_after and user_limiter is not None:
+            user = None
+            if authorization and authorization.startswith("Bearer "):
+                user = verify_token_cached(authorization.replace("Bearer ", ""))
+            if not user:
+                raise HTTPException(status_code=401, detail="Недействительный токен авторизации")
+            retry_after = user_limiter.acquire(f"user:{user['id']}")
+        if retry_after:
+            raise HTTPException(
+                status_code=429,
+                detail="Слишком много запросов, попробуйте позже",
+                headers={"Retry-After": str(int(retry_after) + 1)}
+            )
+
+    return check
+
+def _workers_from_args(args: List[str]) -> Optional[int]:
+    """Значение --workers/-w из аргументов командной строки uvicorn или gunicorn"""
+    for i, arg in enumerate(args):
+        for flag in ("--workers", "-w"):
+            if arg == flag and i + 1 < len(args) and args[i + 1].isdigit():
+                return int(args[i + 1])
+            if arg.startswith(flag + "=") and arg[len(flag) + 1:].isdigit():
+                return int(arg[len(flag) + 1:])
+        if arg.startswith("-w") and arg[2:].isdigit():
+            return int(arg[2:])
+    return None
+
+def get_worker_count() -> Optional[int]:
+    """
+    Число воркеров сервиса: QR_WORKERS, WEB_CONCURRENCY или --workers/-w из командной строки
+    (воркеры uvicorn и gunicorn получают argv родителя) и GUNICORN_CMD_ARGS.
+    None - процесс запущен менеджером воркеров, но их число определить не удалось
+    """
+    explicit = os.getenv("QR_WORKERS") or os.getenv("WEB_CONCURRENCY")
+    if explicit:
+        return int(explicit)
+    workers = _workers_from_args(sys.argv[1:]) or _workers_from_args(shlex.split(os.getenv("GUNICORN_CMD_ARGS", "")))
+    if workers:
+        return workers
+    # Воркеры uvicorn (и процесс с --reload) порождаются через multiprocessing, воркеры gunicorn - fork мастера
+    if not SINGLE_PROCESS and (multiprocessing.parent_process() is not None or "gunicorn" in sys.modules):
+        return None
+    return 1
+
+def check_deployment(workers: Optional[int]):
+    """
+    Самопроверка перед запуском нескольких воркеров: защита от повторного использования
+    QR-кодов должна быть общей для всех процессов, иначе один код примут несколько воркеров.
+    workers=None - число воркеров неизвестно, считаем, что их несколько
+    """
+    if workers is not None and workers <= 1:
+        return
+    described = f"{workers} воркеров" if workers is not None else "воркеров под управлением uvicorn/gunicorn"
+    if not replay_store.shared:
+        raise RuntimeError(
+            f"Запуск {described} с хранилищем использованных токенов в памяти процесса небезопасен: "
+            "установите QR_REPLAY_BACKEND=sqlite "
+            "(или QR_SINGLE_PROCESS=1, если процесс действительно один, например uvicorn --reload)"
+        )
+    if any(limiter is not None for limiters in rate_limiters.values() for limiter in limiters):
+        print(f"Внимание: лимиты запросов считаются в каждом воркере отдельно (до {workers or 'N'}x от заданных)")
+    print(f"Внимание: кэш расписаний сбрасывается уведомлением только в одном воркере, "
+          f"остальные обновятся через QR_SCHEDULE_CACHE_TTL")
+
 @app.on_event("startup")
 def startup_event():
+    check_deployment(get_worker_count())
     database.create_tables()
+    if attendance_writer is not None:
+        attendance_writer.start()
+
+@app.on_event("shutdown")
+def shutdown_event():
+    if attendance_writer is not None:
+        attendance_writer.stop()
 
 @app.get("/health")
 def health_check():
     return {"status": "ok", "service": "qr", "timestamp": datetime.now().isoformat()}
 
-@app.post("/qr", response_model=QRResponse)
-def qr_code(request: QRRequest, current_user: dict = Depends(get_current_user)):
+@app.get("/metrics")
+def metrics():
+    return {
+        "attendance_writer": attendance_writer.get_metrics() if attendance_writer is not None else {"mode": WRITE_MODE},
+        "rate_limits": {
+            endpoint: {
+                "user": user_limiter.get_metrics() if user_limiter is not None else None,
+                "ip": ip_limiter.get_metrics() if ip_limiter is not None else None
+            }
+            for endpoint, (user_limiter, ip_limiter) in rate_limiters.items()
+        }
+    }
+
+def prefetch_roster(subject_id: int, teacher_id: int, token: str):
+    """
+    Загружает студентов групп занятия в локальную таблицу users, чтобы при
+    сканировании не обращаться к сервису авторизации за каждым пользователем
+    """
+    lesson_key = (subject_id, teacher_id, datetime.now().date().isoformat())
+    if prefetched_lessons.get(lesson_key):
+        return
+    prefetched_lessons.set(lesson_key, True)
+
+    try:
+        users = []
+        for group_id in get_lesson_group_ids(subject_id, teacher_id, token, lesson_key[2]):
+            students = get_group_students(group_id, token)
+            for student in students:
+                user_id = student["user_id"]
+                users.append((user_id, student.get("username") or f"user_{user_id}"))
+                if user_info_cache.get(user_id) is None:
+                    user_info_cache.set(user_id, {"id": user_id, "full_name": student.get("full_name", "")})
+            if students:
+                database.save_group_roster(group_id, [student["user_id"] for student in students])
+        if users:
+            database.import_users(users)
+            for user_id, _ in users:
+                known_users.set(user_id, True)
+    except Exception as e:
+        prefetched_lessons.invalidate(lesson_key)
+        print(f"Ошибка при предзагрузке студентов занятия {lesson_key}: {e}")
+
+@app.post("/qr", response_model=QRResponse, dependencies=[Depends(rate_limit("qr"))])
+def qr_code(
+    request: QRRequest,
+    background_tasks: BackgroundTasks,
+    current_user: dict = Depends(get_current_user),
+    authorization: str = Header(None)
+):
     # Проверяем, что у пользователя есть права на создание QR-кода
     if current_user.get("role", "") not in ["admin", "teacher"]:
         raise HTTPException(status_code=403, detail="Недостаточно прав для создания QR-кода")
     
-    token = generate_qr_token(
-        subject_id=request.subject_id,
-        shift_id=request.shift_id,
-        teacher_id=request.teacher_id
-    )
+    try:
+        token = generate_qr_token(
+            subject_id=request.subject_id,
+            shift_id=request.shift_id,
+            teacher_id=request.teacher_id
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if PREFETCH_ROSTER:
+        background_tasks.add_task(
+            prefetch_roster, request.subject_id, request.teacher_id, authorization.replace("Bearer ", "")
+        )
 
     return {"qr_code": token}
 
-@app.post("/validate_qr", response_model=ValidateResponse)
+def enrich_session_details(session_key: str, user_id: int, token_data: dict, token: str, session_data: Optional[Dict] = None):
+    """Собирает расширенные данные о посещении в фоне и сохраняет их для /sessions/details"""
+    try:
+        if session_data is None:
+            session_data = save_attendance_with_details(user_id, token_data, token)
+        database.save_session_details(session_key, user_id, session_data)
+    except Exception as e:
+        print(f"Ошибка при обогащении данных о посещении {session_key}: {e}")
+
+@app.websocket("/ws/qr")
+async def qr_channel(
+    websocket: WebSocket,
+    subject_id: int,
+    shift_id: int,
+    teacher_id: int,
+    token: Optional[str] = None
+):
+    """
+    Push-канал для экрана преподавателя: авторизация проверяется один раз при подключении,
+    затем сервер сам присылает новый QR-код каждые QR_PUSH_TOKEN_INTERVAL секунд
+    и число отметившихся студентов каждые QR_PUSH_COUNT_INTERVAL секунд.
+    Токен авторизации передается в параметре token или в заголовке Authorization.
+    """
+    if token is None:
+        authorization = websocket.headers.get("authorization", "")
+        token = authorization.replace("Bearer ", "") if authorization.startswith("Bearer ") else None
+
+    current_user = await run_in_threadpool(verify_token, token) if token else {}
+    if not current_user:
+        await websocket.close(code=1008, reason="Недействительный токен авторизации")
+        return
+    if current_user.get("role", "") not in ["admin", "teacher"]:
+        await websocket.close(code=1008, reason="Недостаточно прав для создания QR-кода")
+        return
+    try:
+        check_token_ids(subject_id, shift_id, teacher_id)
+    except ValueError as e:
+        await websocket.close(code=1008, reason=str(e))
+        return
+
+    await websocket.accept()
+
+    if PREFETCH_ROSTER:
+        asyncio.get_running_loop().run_in_executor(None, prefetch_roster, subject_id, teacher_id, token)
+
+    next_token_at = 0.0
+    try:
+        while True:
+            message = {}
+            if time.monotonic() >= next_token_at:
+                message["qr_code"] = generate_qr_token(subject_id=subject_id, shift_id=shift_id, teacher_id=teacher_id)
+                next_token_at = time.monotonic() + QR_PUSH_TOKEN_INTERVAL
+            message["scanned"] = await run_in_threadpool(
+                database.count_lesson_attendees, subject_id, shift_id, teacher_id, datetime.now().date()
+            )
+            await websocket.send_json(message)
+            await asyncio.sleep(QR_PUSH_COUNT_INTERVAL)
+    except WebSocketDisconnect:
+        pass
+
+def replay_expiry(exp: float) -> float:
+    """
+    До какого момента хранить ключ токена в replay_store: токен может прийти
+    в офлайн-пачке спустя OFFLINE_SCAN_MAX_AGE секунд после истечения
+    """
+    return exp + OFFLINE_SCAN_MAX_AGE
+
+@app.post("/validate_qr", response_model=ValidateResponse, dependencies=[Depends(rate_limit("validate_qr"))])
 def validate_qr_code(
     request: ValidateRequest,
+    background_tasks: BackgroundTasks,
+    current_user: dict = Depends(get_current_user_cached),
     authorization: str = Header(None)
 ):
-    # Проверяем токен авторизации
-    if authorization is None or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Не предоставлен токен авторизации")
-    
     token = authorization.replace("Bearer ", "")
     
     try:
         # Проверяем QR-код
         token_data = validate_qr_token(request.qr_code)
 
-        token_id = token_data.get("token_id")
-        if token_id in used_tokens:
+        # Один токен отмечает каждого студента только один раз
+        replay_key = f"{token_data.get('token_id')}:{request.user_id}"
+        if not replay_store.add(replay_key, replay_expiry(token_data["exp"])):
             raise HTTPException(status_code=400, detail="QR-код уже использован")
 
-        used_tokens.add(token_id)
-
-        # Ограничиваем размер set
-        current_time = time.time()
-        if len(used_tokens) > 1000:
-            used_tokens.clear()
-
-        conn = database.get_db_connection()
+        recorded = False
         try:
-            cursor = conn.cursor()
-
-            # Проверяем, существует ли пользователь
-            cursor.execute("SELECT * FROM users WHERE id = ?", (request.user_id,))
-            user = cursor.fetchone()
-            if user is None:
-                # Пробуем получить информацию о пользователе через API
-                user_info = get_user_info(request.user_id, token)
-                if not user_info:
-                    raise HTTPException(status_code=404, detail="Пользователь не найден")
-                
-                # Создаем пользователя в локальной БД
-                cursor.execute(
-                    "INSERT INTO users (id, username, password) VALUES (?, ?, ?)",
-                    (request.user_id, user_info.get("username", f"user_{request.user_id}"), "imported_user")
-                )
-                conn.commit()
+            # Пользователя, которого нет в локальной БД, получаем из сервиса авторизации;
+            # он добавляется в users той же транзакцией, что и посещение
+            user_info = None
+            new_user = None
+            if not known_users.get(request.user_id):
+                if database.user_exists(request.user_id):
+                    known_users.set(request.user_id, True)
+                else:
+                    user_info = get_user_info_cached(request.user_id, token)
+                    if not user_info:
+                        raise HTTPException(status_code=404, detail="Пользователь не найден")
+                    new_user = (request.user_id, user_info.get("username", f"user_{request.user_id}"))
 
             # Сохраняем данные о посещаемости
-            cursor.execute(
-                """INSERT INTO SESSION_DATA
-                   (user_id, session_time, subject_id, shift_id, teacher_id, day_of_week)
-                   VALUES (?, ?, ?, ?, ?, ?)""",
-                (
-                    request.user_id,
-                    datetime.now(),
-                    token_data["subject_id"],
-                    token_data["shift_id"],
-                    token_data["teacher_id"],
-                    token_data["day_of_week"]
-                )
+            session_row = (
+                request.user_id,
+                datetime.now(),
+                token_data["subject_id"],
+                token_data["shift_id"],
+                token_data["teacher_id"],
+                token_data["day_of_week"]
             )
-
-            conn.commit()
+            if attendance_writer is not None:
+                attendance_writer.submit(session_row, new_user)
+            else:
+                database.record_sessions([session_row], [new_user] if new_user else ())
+            recorded = True
+            if new_user:
+                known_users.set(request.user_id, True)
             
-            # Получаем расширенные данные с информацией из других сервисов
-            session_data = save_attendance_with_details(request.user_id, token_data, token)
+            if ENRICHMENT_MODE == "async":
+                # Подтверждаем посещение сразу: расширенные данные берем из локального кэша,
+                # а если их там нет - собираем после ответа
+                cached_data = get_cached_attendance_details(request.user_id, token_data)
+                background_tasks.add_task(
+                    enrich_session_details, replay_key, request.user_id, token_data, token, cached_data
+                )
+                session_data = dict(cached_data or build_attendance_details(request.user_id, token_data, {}, {}))
+                session_data["session_key"] = replay_key
+                session_data["details_status"] = "ready" if cached_data else "pending"
+            else:
+                # Получаем расширенные данные с информацией из других сервисов
+                session_data = save_attendance_with_details(request.user_id, token_data, token, user_info)
             
             return {
                 "success": True,
                 "message": "Посещение успешно зафиксировано",
                 "session_data": session_data
             }
-        finally:
-            conn.close()
+        except Exception:
+            # Посещение не записано - освобождаем ключ, чтобы QR-код можно было отсканировать снова
+            if not recorded:
+                replay_store.discard_many([(replay_key, replay_expiry(token_data["exp"]))])
+            raise
+    except HTTPException:
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка обработки запроса: {str(e)}")
 
+@app.post(
+    "/validate_qr/batch",
+    response_model=BatchValidateResponse,
+    dependencies=[Depends(rate_limit("validate_qr_batch"))]
+)
+def validate_qr_batch(
+    request: BatchValidateRequest,
+    current_user: dict = Depends(get_current_user),
+    authorization: str = Header(None)
+):
+    """
+    Пачка сканирований, накопленных клиентом без связи. Каждый токен проверяется
+    на момент сканирования scanned_at, все принятые посещения записываются одной транзакцией.
+    """
+    if len(request.scans) > BATCH_MAX_SIZE:
+        raise HTTPException(status_code=400, detail=f"В пачке не больше {BATCH_MAX_SIZE} сканирований")
+
+    token = authorization.replace("Bearer ", "")
+    can_scan_for_others = current_user.get("role", "") in ["admin", "teacher"]
+    now = time.time()
+
+    results = [None] * len(request.scans)
+    pending = []
+    for index, scan in enumerate(request.scans):
+        if scan.user_id != current_user.get("id") and not can_scan_for_others:
+            results[index] = BatchScanResult(index=index, success=False, message="Недостаточно прав для отметки другого пользователя")
+            continue
+
+        scanned_at = scan.scanned_at
+        if scanned_at.tzinfo is not None:
+            scanned_at = scanned_at.astimezone().replace(tzinfo=None)
+        scanned_epoch = scanned_at.timestamp()
+        if scanned_epoch > now or scanned_epoch < now - OFFLINE_SCAN_MAX_AGE:
+            results[index] = BatchScanResult(index=index, success=False, message="Недопустимое время сканирования")
+            continue
+
+        try:
+            token_data = validate_qr_token(scan.qr_code, now=scanned_epoch)
+        except ValueError as e:
+            results[index] = BatchScanResult(index=index, success=False, message=str(e))
+            continue
+        pending.append((index, scan.user_id, scanned_at, token_data))
+
+    # Пользователей, которых нет в локальной БД, получаем из сервиса авторизации
+    # до открытия транзакции записи, чтобы не держать блокировку SQLite во время HTTP-запросов
+    user_ids = sorted({user_id for _, user_id, _, _ in pending})
+    known = set()
+    conn = database.get_db_connection()
+    try:
+        cursor = conn.cursor()
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            cursor.execute(f"SELECT id FROM users WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+            known.update(row[0] for row in cursor.fetchall())
+    finally:
+        conn.close()
+    imported_users = []
+    missing = set()
+    for user_id in user_ids:
+        if user_id in known:
+            continue
+        user_info = get_user_info_cached(user_id, token)
+        if user_info:
+            imported_users.append((user_id, user_info.get("username", f"user_{user_id}")))
+        else:
+            missing.add(user_id)
+
+    resolved = []
+    for item in pending:
+        if item[1] in missing:
+            results[item[0]] = BatchScanResult(index=item[0], success=False, message="Пользователь не найден")
+        else:
+            resolved.append(item)
+
+    # Проверяем повторное использование токенов одним обращением к хранилищу.
+    # Ключи резервируются только для сканирований, которые будут записаны
+    replay_items = [
+        (f"{token_data.get('token_id')}:{user_id}", replay_expiry(token_data["exp"]))
+        for _, user_id, _, token_data in resolved
+    ]
+    added = replay_store.add_many(replay_items)
+    fresh, reserved = [], []
+    for item, replay_item, is_new in zip(resolved, replay_items, added):
+        if is_new:
+            fresh.append(item)
+            reserved.append(replay_item)
+        else:
+            results[item[0]] = BatchScanResult(index=item[0], success=False, message="QR-код уже использован")
+
+    session_rows = []
+    for index, user_id, scanned_at, token_data in fresh:
+        session_rows.append((
+            user_id,
+            scanned_at,
+            token_data["subject_id"],
+            token_data["shift_id"],
+            token_data["teacher_id"],
+            token_data["day_of_week"]
+        ))
+        results[index] = BatchScanResult(
+            index=index,
+            success=True,
+            message="Посещение успешно зафиксировано",
+            session_key=f"{token_data.get('token_id')}:{user_id}"
+        )
+
+    try:
+        database.record_sessions(session_rows, imported_users)
+    except Exception as e:
+        # Посещения не записаны - освобождаем ключи, чтобы пачку можно было отправить повторно
+        replay_store.discard_many(reserved)
+        raise HTTPException(status_code=500, detail=f"Ошибка обработки запроса: {str(e)}")
+
+    return {"accepted": len(session_rows), "results": results}
+
+def decode_sessions_cursor(cursor: str):
+    """Курсор страницы: "<session_epoch>:<id>" последней полученной строки"""
+    try:
+        session_epoch, session_id = cursor.split(":")
+        return int(session_epoch), int(session_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректный курсор")
+
 @app.get("/sessions/{user_id}", response_model=UserSessionsResponse)
 def get_user_sessions(
     user_id: int, 
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to")
 ):
     # Проверяем права доступа (пользователь может видеть только свои данные, а админ - любые)
     if current_user["id"] != user_id and current_user["role_name"] != "admin":
         raise HTTPException(status_code=403, detail="Недостаточно прав для просмотра данных другого пользователя")
     
-    sessions = database.get_user_sessions(user_id)
-    return {"user_id": user_id, "sessions": sessions}
+    after = decode_sessions_cursor(cursor) if cursor else None
+    try:
+        sessions = database.get_user_sessions(user_id, limit, after, date_from, date_to)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    next_cursor = None
+    if limit is not None and len(sessions) == limit:
+        last = sessions[-1]
+        next_cursor = f"{last['session_epoch']}:{last['id']}"
+
+    return {"user_id": user_id, "sessions": sessions, "next_cursor": next_cursor}
+
+@app.get("/sessions/{user_id}/stream")
+def stream_user_sessions(
+    user_id: int,
+    current_user: dict = Depends(get_current_user),
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to")
+):
+    """Вся история посещений пользователя в формате NDJSON (одна строка - одно посещение)"""
+    if current_user["id"] != user_id and current_user["role_name"] != "admin":
+        raise HTTPException(status_code=403, detail="Недостаточно прав для просмотра данных другого пользователя")
+
+    try:
+        database.date_range_to_epoch(date_from, date_to)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    def generate():
+        for rows in database.iter_user_sessions(user_id, date_from, date_to):
+            yield "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+@app.get("/sessions/details/{session_key}", response_model=Dict)
+def get_session_details(
+    session_key: str,
+    current_user: dict = Depends(get_current_user)
+):
+    details = database.get_session_details(session_key)
+    if details is None:
+        raise HTTPException(status_code=404, detail="Данные о посещении не найдены или ещё обрабатываются")
+
+    if current_user["id"] != details["user_id"] and current_user["role_name"] != "admin":
+        raise HTTPException(status_code=403, detail="Недостаточно прав для просмотра данных другого пользователя")
+
+    return details
 
 @app.get("/schedule/{user_id}")
 def get_schedule_for_user(
     user_id: int, 
-    current_user: dict = Depends(get_current_user),
+    current_user: dict = Depends(get_current_user_cached),
     authorization: str = Header(None)
 ):
     # Проверяем права доступа
@@ -190,35 +708,167 @@ def get_schedule_for_user(
     
     token = authorization.replace("Bearer ", "")
     
-    # Получаем расписание пользователя из сервиса расписания
+    # Расписание пользователя из локального кэша (при промахе - из сервиса расписания)
     schedule = get_user_schedule(user_id, token)
     return {"user_id": user_id, "schedule": schedule}
 
+@app.post("/schedule/invalidate", response_model=Dict)
+def invalidate_schedule_cache(
+    request: ScheduleInvalidateRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Уведомление от сервиса расписания об изменении занятий: сбрасывает расписания
+    перечисленных групп и преподавателей (без параметров - все) и связи пользователей user_ids
+    """
+    if current_user.get("role", "") not in ["admin", "teacher"]:
+        raise HTTPException(status_code=403, detail="Недостаточно прав для сброса кэша расписания")
+
+    invalidate_schedules(request.group_ids, request.teacher_ids)
+    for user_id in request.user_ids:
+        schedule_target_cache.invalidate(user_id)
+    return {"message": "Кэш расписания сброшен"}
+
 @app.get("/stats", response_model=Dict)
 def get_attendance_stats(
-    current_user: dict = Depends(get_current_user),
+    current_user: dict = Depends(get_current_user_cached),
     start_date: Optional[str] = None,
-    end_date: Optional[str] = None
+    end_date: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None)
 ):
     # Проверяем, что пользователь имеет права на просмотр статистики
     if current_user.get("role", "") not in ["admin", "teacher"]:
         raise HTTPException(status_code=403, detail="Недостаточно прав для просмотра статистики")
     
-    stats = database.get_session_stats(start_date, end_date)
-    return {"stats": stats}
+    start_date, end_date = normalize_date(start_date), normalize_date(end_date)
+    return cached_stats_response(
+        ("stats", current_user.get("role"), start_date, end_date),
+        if_none_match,
+        lambda: {"stats": database.get_session_stats(start_date, end_date)}
+    )
 
 
 @app.get("/stats/user/{user_id}", response_model=Dict)
 def get_user_attendance_stats(
     user_id: int,
+    current_user: dict = Depends(get_current_user_cached),
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None)
+):
+    start_date, end_date = normalize_date(start_date), normalize_date(end_date)
+    return cached_stats_response(
+        ("stats_user", current_user.get("role"), user_id, start_date, end_date),
+        if_none_match,
+        lambda: {"user_id": user_id, "stats": database.get_user_session_stats(user_id, start_date, end_date)}
+    )
+
+@app.get("/analytics/attendance", response_model=Dict)
+def get_attendance_analytics(
     current_user: dict = Depends(get_current_user),
     start_date: Optional[str] = None,
-    end_date: Optional[str] = None
+    end_date: Optional[str] = None,
+    subject_id: Optional[int] = None,
+    teacher_id: Optional[int] = None,
+    window: int = Query(4, ge=1, le=52)
 ):
-    stats = database.get_user_session_stats(user_id, start_date, end_date)
-    return {"user_id": user_id, "stats": stats}
+    """
+    Тепловая карта посещений (день недели x смена x предмет), недельная динамика
+    со скользящим средним за window недель и распределения по преподавателям
+    """
+    if current_user.get("role", "") != "admin":
+        raise HTTPException(status_code=403, detail="Недостаточно прав для просмотра аналитики")
+
+    try:
+        return analytics.get_attendance_analytics(start_date, end_date, subject_id, teacher_id, window)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def load_group_roster(group_id: int, authorization: str) -> int:
+    """Битовая карта состава группы; устаревший или отсутствующий состав запрашивается в сервисе авторизации"""
+    roster = database.get_group_roster_bitmap(group_id, ROSTER_MAX_AGE)
+    if roster is None:
+        students = get_group_students(group_id, authorization.replace("Bearer ", ""))
+        if not students:
+            raise HTTPException(status_code=404, detail="Группа не найдена или в ней нет студентов")
+        database.save_group_roster(group_id, [student["user_id"] for student in students])
+        roster = database.get_group_roster_bitmap(group_id, ROSTER_MAX_AGE)
+    return roster
+
+@app.get("/attendance/group/{group_id}", response_model=Dict)
+def get_group_lesson_attendance(
+    group_id: int,
+    subject_id: int,
+    teacher_id: int,
+    shift_id: Optional[int] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    current_user: dict = Depends(get_current_user),
+    authorization: str = Header(None)
+):
+    """
+    Кто из группы был и кого не было на занятиях предмета преподавателя за период.
+    Считается пересечением битовых карт занятий с битовой картой состава группы.
+    """
+    if current_user.get("role", "") not in ["admin", "teacher"]:
+        raise HTTPException(status_code=403, detail="Недостаточно прав для просмотра статистики")
+
+    roster = load_group_roster(group_id, authorization)
+    try:
+        attendance = database.get_lesson_attendance(roster, subject_id, teacher_id, shift_id, start_date, end_date)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"group_id": group_id, "subject_id": subject_id, "teacher_id": teacher_id, **attendance}
+
+@app.get("/export/sessions")
+def export_sessions(
+    current_user: dict = Depends(get_current_user),
+    authorization: str = Header(None),
+    export_format: str = Query("csv", alias="format", pattern="^(csv|ndjson|parquet)$"),
+    gzip: bool = False,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    subject_id: Optional[int] = None,
+    teacher_id: Optional[int] = None,
+    group_id: Optional[int] = None
+):
+    """
+    Выгрузка посещений за период для внешних систем. Строки читаются из курсора
+    порциями по QR_EXPORT_CHUNK_SIZE и сразу отдаются клиенту, результат целиком
+    в памяти не собирается. Группа фильтруется по сохраненному составу.
+    """
+    if current_user.get("role", "") != "admin":
+        raise HTTPException(status_code=403, detail="Недостаточно прав для выгрузки посещений")
+    if export_format == "parquet" and export.pyarrow is None:
+        raise HTTPException(status_code=501, detail="Выгрузка в Parquet недоступна: не установлен pyarrow")
+
+    start_date, end_date = normalize_date(start_date), normalize_date(end_date)
+    user_ids = None
+    if group_id is not None:
+        user_ids = database.roster_user_ids(load_group_roster(group_id, authorization))
+
+    chunks = database.iter_sessions(start_date, end_date, subject_id, teacher_id, user_ids, export.EXPORT_CHUNK_SIZE)
+    media_type, extension = export.EXPORT_FORMATS[export_format]
+    file_name = f"attendance_{start_date or 'begin'}_{end_date or 'now'}.{extension}"
+    if gzip and export_format != "parquet":
+        media_type, file_name = "application/gzip", file_name + ".gz"
+
+    return StreamingResponse(
+        export.export_sessions(chunks, export_format, gzip),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{file_name}"'}
+    )
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=PORT, reload=True)
\ No newline at end of file
+    if RUN_MODE == "production":
+        workers = int(os.getenv("QR_WORKERS") or os.cpu_count() or 1)
+        check_deployment(workers)
+        # Воркеры наследуют окружение и повторяют самопроверку при старте
+        os.environ["QR_WORKERS"] = str(workers)
+        uvicorn.run("main:app", host="0.0.0.0", port=PORT, workers=workers)
+    else:
+        # Процесс с --reload порождается через multiprocessing, но он один
+        os.environ["QR_SINGLE_PROCESS"] = "1"
+        uvicorn.run("main:app", host="0.0.0.0", port=PORT, reload=True)
\ No newline at end of file
@@ -0,0 +1,88 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+# Максимальное число отслеживаемых ключей в одном ограничителе
+RATE_LIMIT_MAX_KEYS = int(os.getenv("QR_RATE_LIMIT_MAX_KEYS", "100000"))
+
+
+def parse_limit(value: str) -> Optional[Tuple[int, float]]:
+    """
+    Разбирает лимит вида "<запросов>/<секунд>", например "10/60".
+    "0" или пустая строка отключают ограничение.
+    """
+    if not value or value.strip() == "0":
+        return None
+    requests, _, seconds = value.partition("/")
+    return int(requests), float(seconds or 1)
+
+
+class TokenBucketLimiter:
+    """
+    Ограничитель запросов "token bucket" в памяти процесса.
+
+    Для каждого ключа хранится корзина емкостью capacity, которая пополняется
+    со скоростью capacity / period токенов в секунду. Корзина, простоявшая
+    без запросов дольше period, полностью пополнилась и ничем не отличается
+    от отсутствующей - такие записи удаляются, поэтому память ограничена
+    числом ключей, активных за последний period (и не больше max_keys).
+    Записи хранятся в порядке последнего обращения, поэтому простаивающие
+    удаляются с начала словаря без полного обхода.
+    """
+
+    def __init__(self, capacity: int, period: float, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.capacity = capacity
+        self.period = period
+        self.rate = capacity / period
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[Hashable, list]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def _evict(self, now: float):
+        idle_since = now - self.period
+        while self._buckets:
+            key, (_, last) = next(iter(self._buckets.items()))
+            if last >= idle_since and len(self._buckets) < self.max_keys:
+                break
+            del self._buckets[key]
+
+    def acquire(self, key: Hashable) -> float:
+        """
+        Забирает токен из корзины ключа. Возвращает 0, если запрос разрешен,
+        иначе - через сколько секунд появится следующий токен
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                self._buckets[key] = [self.capacity - 1, now]
+                return 0
+            self._buckets.move_to_end(key)
+
+            tokens = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0
+            bucket[0] = tokens
+            self.rejected += 1
+            return (1 - tokens) / self.rate
+
+    def get_metrics(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "limit": self.capacity,
+                "period": self.period,
+                "tracked_keys": len(self._buckets),
+                "rejected": self.rejected,
+            }
+
+
+def create_limiter(env_name: str, default: str) -> Optional[TokenBucketLimiter]:
+    limit = parse_limit(os.getenv(env_name, default))
+    return TokenBucketLimiter(*limit) if limit else None
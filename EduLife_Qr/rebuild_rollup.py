@@ -0,0 +1,7 @@
+import database
+
+# Пересчет сводных таблиц посещаемости по SESSION_DATA
+database.create_tables()
+rows = database.rebuild_attendance_rollup()
+
+print(f"Rollup rebuilt: {rows} rows.")
@@ -0,0 +1,158 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Set, Tuple
+
+import database
+
+# Бэкенд хранилища использованных токенов: "memory" (один процесс) или "sqlite" (общий для воркеров)
+REPLAY_BACKEND = os.getenv("QR_REPLAY_BACKEND", "memory")
+
+# Ширина временной корзины (секунды)
+BUCKET_SECONDS = int(os.getenv("QR_REPLAY_BUCKET_SECONDS", "10"))
+
+
+class MemoryReplayStore:
+    """
+    Хранилище использованных токенов в памяти процесса.
+
+    Ключи раскладываются по корзинам по времени истечения токена (exp).
+    Корзина удаляется целиком, когда истекли все токены в ней, поэтому
+    память ограничена числом токенов, живых в данный момент.
+    """
+
+    shared = False
+
+    def __init__(self, bucket_seconds: int = BUCKET_SECONDS):
+        self.bucket_seconds = bucket_seconds
+        self._buckets: Dict[int, Set[str]] = {}
+        self._oldest_bucket = None
+        self._lock = threading.Lock()
+
+    def _prune(self, now: float):
+        # Корзина idx содержит exp из [idx * w, (idx + 1) * w) - она пуста для проверки, когда now >= (idx + 1) * w
+        expired_before = int(now // self.bucket_seconds)
+        if self._oldest_bucket is None or self._oldest_bucket >= expired_before:
+            return
+        for idx in [idx for idx in self._buckets if idx < expired_before]:
+            del self._buckets[idx]
+        self._oldest_bucket = min(self._buckets) if self._buckets else None
+
+    def _add(self, key: str, exp: float) -> bool:
+        idx = int(exp // self.bucket_seconds)
+        bucket = self._buckets.get(idx)
+        if bucket is None:
+            bucket = self._buckets[idx] = set()
+            if self._oldest_bucket is None or idx < self._oldest_bucket:
+                self._oldest_bucket = idx
+        elif key in bucket:
+            return False
+        bucket.add(key)
+        return True
+
+    def add(self, key: str, exp: float) -> bool:
+        """Добавляет ключ. Возвращает False, если ключ уже был использован"""
+        with self._lock:
+            self._prune(time.time())
+            return self._add(key, exp)
+
+    def add_many(self, items: Iterable[Tuple[str, float]]) -> List[bool]:
+        """Добавляет пары (ключ, exp) за одну блокировку. Для каждой - False, если ключ уже был использован"""
+        with self._lock:
+            self._prune(time.time())
+            return [self._add(key, exp) for key, exp in items]
+
+    def discard_many(self, items: Iterable[Tuple[str, float]]):
+        """Освобождает ключи (ключ, exp), если посещение по ним не удалось записать"""
+        with self._lock:
+            for key, exp in items:
+                bucket = self._buckets.get(int(exp // self.bucket_seconds))
+                if bucket is not None:
+                    bucket.discard(key)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(bucket) for bucket in self._buckets.values())
+
+
+class SQLiteReplayStore:
+    """
+    Хранилище использованных токенов в общей таблице SQLite.
+
+    Подходит для запуска нескольких воркеров uvicorn: уникальность ключа
+    гарантирует первичный ключ таблицы, а истекшие корзины удаляются
+    не чаще одного раза за ширину корзины.
+    """
+
+    shared = True
+
+    def __init__(self, bucket_seconds: int = BUCKET_SECONDS, path: str = None):
+        self.bucket_seconds = bucket_seconds
+        self.path = path or database.db_path
+        self._local = threading.local()
+        self._pruned_bucket = 0
+
+    def _get_connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _prune(self, conn):
+        current_bucket = int(time.time() // self.bucket_seconds)
+        if current_bucket > self._pruned_bucket:
+            self._pruned_bucket = current_bucket
+            conn.execute(
+                "DELETE FROM used_qr_tokens WHERE bucket < ?",
+                (current_bucket,)
+            )
+
+    def add(self, key: str, exp: float) -> bool:
+        """Добавляет ключ. Возвращает False, если ключ уже был использован"""
+        conn = self._get_connection()
+        self._prune(conn)
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO used_qr_tokens (token_key, bucket) VALUES (?, ?)",
+            (key, int(exp // self.bucket_seconds))
+        )
+        return cursor.rowcount == 1
+
+    def add_many(self, items: Iterable[Tuple[str, float]]) -> List[bool]:
+        """Добавляет пары (ключ, exp) одной транзакцией. Для каждой - False, если ключ уже был использован"""
+        conn = self._get_connection()
+        self._prune(conn)
+        results = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for key, exp in items:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO used_qr_tokens (token_key, bucket) VALUES (?, ?)",
+                    (key, int(exp // self.bucket_seconds))
+                )
+                results.append(cursor.rowcount == 1)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return results
+
+    def discard_many(self, items: Iterable[Tuple[str, float]]):
+        """Освобождает ключи (ключ, exp), если посещение по ним не удалось записать"""
+        self._get_connection().executemany(
+            "DELETE FROM used_qr_tokens WHERE token_key = ?",
+            [(key,) for key, _ in items]
+        )
+
+    def __len__(self):
+        return self._get_connection().execute("SELECT COUNT(*) FROM used_qr_tokens").fetchone()[0]
+
+
+def create_replay_store():
+    if REPLAY_BACKEND == "sqlite":
+        return SQLiteReplayStore()
+    if REPLAY_BACKEND == "memory":
+        return MemoryReplayStore()
+    raise ValueError(f"Неизвестный бэкенд хранилища токенов: {REPLAY_BACKEND}")
@@ -1,13 +1,76 @@
+import os
 import json
 import base64
+import hashlib
+import hmac
+import struct
 import time
 import uuid
 import datetime
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+
+# Время жизни QR-токена (секунды)
+TOKEN_TTL = 30
+
+# Секрет для подписи QR-токенов (должен совпадать у всех воркеров сервиса)
+QR_TOKEN_SECRET = os.getenv("QR_TOKEN_SECRET", "default_qr_secret_for_development")
+
+# Принимать ли старые JSON-токены на время миграции. Они не подписаны и могут быть подделаны,
+# поэтому по умолчанию отключены, а их exp ограничивается TOKEN_TTL от текущего момента
+ACCEPT_LEGACY_TOKENS = os.getenv("QR_ACCEPT_LEGACY_TOKENS", "0") == "1"
+
+# Бинарный формат v2:
+# версия (1) | exp (4) | subject_id (4) | shift_id (4) | teacher_id (4) | day_of_week (1) | nonce (6) | HMAC (10)
+TOKEN_VERSION = 2
+NONCE_SIZE = 6
+MAC_SIZE = 10
+_PAYLOAD = struct.Struct(">BIIIIB6s")
+_TOKEN_SIZE = _PAYLOAD.size + MAC_SIZE
+
+# Идентификаторы занимают в токене по 4 байта без знака
+MAX_TOKEN_ID = 2 ** 32 - 1
+
+_mac_template = hmac.new(QR_TOKEN_SECRET.encode("utf-8"), digestmod=hashlib.sha256)
+
+
+def _sign(payload: bytes) -> bytes:
+    mac = _mac_template.copy()
+    mac.update(payload)
+    return mac.digest()[:MAC_SIZE]
+
+
+def check_token_ids(subject_id: int, shift_id: int, teacher_id: int):
+    """ValueError, если идентификатор не помещается в поле токена"""
+    for name, value in (("subject_id", subject_id), ("shift_id", shift_id), ("teacher_id", teacher_id)):
+        if not 0 <= value <= MAX_TOKEN_ID:
+            raise ValueError(f"{name} должен быть от 0 до {MAX_TOKEN_ID}")
+
 
 def generate_qr_token(subject_id: int, shift_id: int, teacher_id: int) -> str:
+    check_token_ids(subject_id, shift_id, teacher_id)
+    current_time = time.time()
+    expiration_time = int(current_time + TOKEN_TTL)
+
+    day_of_week = datetime.datetime.now().weekday()
+
+    payload = _PAYLOAD.pack(
+        TOKEN_VERSION,
+        expiration_time,
+        subject_id,
+        shift_id,
+        teacher_id,
+        day_of_week,
+        os.urandom(NONCE_SIZE)
+    )
+
+    token_bytes = payload + _sign(payload)
+    return base64.urlsafe_b64encode(token_bytes).rstrip(b"=").decode("ascii")
+
+
+def generate_legacy_qr_token(subject_id: int, shift_id: int, teacher_id: int) -> str:
+    """Старый формат токена (base64 от JSON), оставлен для миграции и бенчмарков"""
     current_time = time.time()
-    expiration_time = current_time + 30
+    expiration_time = current_time + TOKEN_TTL
 
     day_of_week = datetime.datetime.now().weekday()
 
@@ -27,15 +90,51 @@ def generate_qr_token(subject_id: int, shift_id: int, teacher_id: int) -> str:
 
     return token_base64
 
-def validate_qr_token(token_base64: str) -> Dict[str, Any]:
+
+def _decode_binary_token(token_bytes: bytes) -> Dict[str, Any]:
+    payload = token_bytes[:_PAYLOAD.size]
+    if not hmac.compare_digest(_sign(payload), token_bytes[_PAYLOAD.size:]):
+        raise ValueError("Signature mismatch")
+
+    _, exp, subject_id, shift_id, teacher_id, day_of_week, nonce = _PAYLOAD.unpack(payload)
+    return {
+        "day_of_week": day_of_week,
+        "subject_id": subject_id,
+        "shift_id": shift_id,
+        "teacher_id": teacher_id,
+        "exp": exp,
+        "token_id": nonce.hex(),
+        "version": TOKEN_VERSION
+    }
+
+
+def _decode_legacy_token(token_bytes: bytes) -> Dict[str, Any]:
+    token_data = json.loads(token_bytes.decode('utf-8'))
+    # Подписи нет - срок действия не может быть дольше обычного токена
+    token_data["exp"] = min(float(token_data.get("exp", 0)), time.time() + TOKEN_TTL)
+    token_data["version"] = 1
+    return token_data
+
+
+def validate_qr_token(token_base64: str, now: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Проверяет подпись и срок действия токена. now - момент сканирования
+    (Unix time), по умолчанию текущее время; задается для офлайн-сканирований.
+    """
     try:
-        token_bytes = base64.urlsafe_b64decode(token_base64)
-        token_json = token_bytes.decode('utf-8')
-        token_data = json.loads(token_json)
+        # Бинарные токены передаются без выравнивания "="
+        token_bytes = base64.urlsafe_b64decode(token_base64 + "=" * (-len(token_base64) % 4))
+
+        if len(token_bytes) == _TOKEN_SIZE and token_bytes[0] == TOKEN_VERSION:
+            token_data = _decode_binary_token(token_bytes)
+        elif ACCEPT_LEGACY_TOKENS and token_bytes[:1] == b"{":
+            token_data = _decode_legacy_token(token_bytes)
+        else:
+            raise ValueError("Unsupported token format")
 
-        current_time = time.time()
+        current_time = time.time() if now is None else now
         if current_time > token_data.get("exp", 0):
             raise ValueError("Token has expired")
         return token_data
     except Exception as e:
-        raise ValueError(f"Invalid token: {str(e)}")
\ No newline at end of file
+        raise ValueError(f"Invalid token: {str(e)}")
@@ -663,11 +663,15 @@ def get_students_by_group(group_id):
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute("""
-        SELECT 
-            s.id, s.user_id, s.student_id, s.enrollment_year,
-            u.full_name, u.email
+        SELECT
+            s.id, s.user_id, s.group_id, s.student_id, s.enrollment_year,
+            u.username, u.full_name, u.email,
+            g.name as group_name, g.year as group_year,
+            f.id as faculty_id, f.name as faculty_name
         FROM students s
         JOIN users u ON s.user_id = u.id
+        JOIN groups g ON s.group_id = g.id
+        JOIN faculties f ON g.faculty_id = f.id
         WHERE s.group_id = ?
         ORDER BY u.full_name
     """, (group_id,))
@@ -24,6 +24,7 @@ class StudentUpdate(BaseModel):
 class StudentResponse(BaseModel):
     id: int
     user_id: int
+    username: str | None = None
     full_name: str
     email: str
     group_id: int
@@ -1,10 +1,20 @@
 import os
+import threading
+import time
 import requests
-from typing import Dict, Any, Optional, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, List, Hashable, Iterable
 import json
 # Конфигурация
 API_TIMEOUT = 10  # Таймаут для API запросов (секунды)
 
+# Сколько хранить сведения о преподавателях и группах для обогащения расписания (секунды)
+ENRICH_CACHE_TTL = int(os.getenv("RASPIS_ENRICH_CACHE_TTL", "300"))
+# Сколько запросов к сервису авторизации выполнять параллельно
+ENRICH_CONCURRENCY = int(os.getenv("RASPIS_ENRICH_CONCURRENCY", "8"))
+# Начиная с этого числа неизвестных id весь список запрашивается одним запросом
+ENRICH_BULK_THRESHOLD = int(os.getenv("RASPIS_ENRICH_BULK_THRESHOLD", "10"))
+
 # URL сервисов
 AUTH_API_URL = os.getenv("AUTH_API_URL", "http://localhost:8070")
 QR_API_URL = os.getenv("QR_API_URL", "http://localhost:8080")
@@ -64,6 +74,50 @@ def make_api_request(
     except requests.RequestException as e:
         raise APIError(f"Ошибка при выполнении API запроса: {str(e)}")
 
+class TTLCache:
+    """Потокобезопасный кэш с ограниченным временем жизни и размером"""
+    def __init__(self, ttl: float, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data: Dict[Hashable, tuple] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            if len(self._data) >= self.max_size and key not in self._data:
+                # Удаляем самую старую запись
+                del self._data[next(iter(self._data))]
+            self._data[key] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, key: Hashable = None):
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+# Сведения о преподавателях и группах из сервиса авторизации для обогащения расписания
+teacher_info_cache = TTLCache(ttl=ENRICH_CACHE_TTL)
+group_info_cache = TTLCache(ttl=ENRICH_CACHE_TTL)
+
+def enrichment_generation() -> int:
+    """
+    Номер окна длиной ENRICH_CACHE_TTL. Имена преподавателей и групп меняются в сервисе
+    авторизации без уведомлений, поэтому ответы с ними считаются устаревшими при смене окна
+    """
+    return int(time.time() // ENRICH_CACHE_TTL)
+
 # API авторизации
 def verify_token(token: str) -> Dict[str, Any]:
     """Проверяет токен пользователя через сервис авторизации"""
@@ -108,28 +162,114 @@ def get_student_by_user_id(user_id: int, token: str) -> Dict[str, Any]:
         return {}
 
 # Методы для обогащения данных расписания
+def _resolve_many(ids: Iterable[int], cache: TTLCache, item_url: str, list_url: str, token: str) -> Dict[int, Dict[str, Any]]:
+    """
+    Сведения о записях справочника сервиса авторизации по набору id.
+    Сначала берутся из кэша; если неизвестных id много, весь список загружается
+    одним запросом, остальные запрашиваются по одному параллельно.
+    Ненайденные и неудачные запросы дают пустые сведения.
+    """
+    resolved = {}
+    missing = []
+    for item_id in ids:
+        info = cache.get(item_id)
+        if info is None:
+            missing.append(item_id)
+        else:
+            resolved[item_id] = info
+
+    if len(missing) >= ENRICH_BULK_THRESHOLD:
+        try:
+            for info in make_api_request("get", list_url, token=token):
+                cache.set(info["id"], info)
+                resolved[info["id"]] = info
+        except APIError as e:
+            print(f"Не удалось загрузить список {list_url}: {e.message}")
+        missing = [item_id for item_id in missing if item_id not in resolved]
+
+    def fetch(item_id):
+        try:
+            return item_id, make_api_request("get", item_url.format(item_id), token=token)
+        except APIError as e:
+            # Удаленная запись кэшируется как пустая, сбой сервиса - нет
+            return item_id, {} if e.status_code == 404 else None
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(ENRICH_CONCURRENCY, len(missing))) as pool:
+            for item_id, info in pool.map(fetch, missing):
+                if info is not None:
+                    cache.set(item_id, info)
+                resolved[item_id] = info or {}
+    return resolved
+
+def enrich_schedules(schedules: List[Dict[str, Any]], token: str) -> List[Dict[str, Any]]:
+    """
+    Обогащает строки расписания информацией о преподавателях и группах.
+    Каждый различный преподаватель и группа запрашивается не больше одного раза
+    на ответ (и не чаще раза в ENRICH_CACHE_TTL секунд между ответами).
+    """
+    teacher_ids = {item["teacher_id"] for item in schedules if item.get("teacher_id") is not None}
+    group_ids = {item["group_id"] for item in schedules if item.get("group_id") is not None}
+    teachers = _resolve_many(teacher_ids, teacher_info_cache, f"{AUTH_API_URL}/teachers/{{}}", f"{AUTH_API_URL}/teachers/", token)
+    groups = _resolve_many(group_ids, group_info_cache, f"{AUTH_API_URL}/groups/{{}}", f"{AUTH_API_URL}/groups/", token)
+
+    result = []
+    for schedule_item in schedules:
+        item = schedule_item.copy()
+        if "teacher_id" in schedule_item:
+            teacher_info = teachers.get(schedule_item["teacher_id"], {})
+            item["teacher_name"] = teacher_info.get("full_name", "")
+            item["teacher_department"] = teacher_info.get("department_name", "")
+        if "group_id" in schedule_item:
+            group_info = groups.get(schedule_item["group_id"], {})
+            item["group_name"] = group_info.get("name", "")
+            item["faculty_name"] = group_info.get("faculty_name", "")
+        result.append(item)
+    return result
+
 def enrich_schedule_data(schedule_item: Dict[str, Any], token: str) -> Dict[str, Any]:
     """
     Обогащает данные о расписании информацией о преподавателе и группе
     из сервиса авторизации
     """
-    result = schedule_item.copy()
-    
-    # Добавляем информацию о преподавателе
-    if "teacher_id" in schedule_item:
-        teacher_info = get_teacher_info(schedule_item["teacher_id"], token)
-        result["teacher_name"] = teacher_info.get("full_name", "")
-        result["teacher_department"] = teacher_info.get("department_name", "")
-    
-    # Добавляем информацию о группе
-    if "group_id" in schedule_item:
-        group_info = get_group_info(schedule_item["group_id"], token)
-        result["group_name"] = group_info.get("name", "")
-        result["faculty_name"] = group_info.get("faculty_name", "")
-    
-    return result
+    return enrich_schedules([schedule_item], token)[0]
 
 # Методы для уведомлений о расписании
+def notify_qr_schedule_change(notifications: List[Dict[str, Any]], token: str) -> bool:
+    """
+    Сообщает сервису QR, расписания каких групп и преподавателей изменились,
+    чтобы он сбросил их в своем кэше
+    """
+    group_ids, teacher_ids = set(), set()
+    for notification in notifications:
+        for key in ("previous_data", "new_data"):
+            data = notification.get(key)
+            if isinstance(data, str):
+                try:
+                    data = json.loads(data)
+                except json.JSONDecodeError:
+                    data = None
+            if isinstance(data, dict):
+                if data.get("group_id"):
+                    group_ids.add(data["group_id"])
+                if data.get("teacher_id"):
+                    teacher_ids.add(data["teacher_id"])
+                # Сводное уведомление импорта перечисляет всех преподавателей группы
+                teacher_ids.update(data.get("teacher_ids") or [])
+
+    # Пустые списки (затронутые группы не определены) сбрасывают весь кэш расписаний
+    try:
+        make_api_request(
+            "post",
+            f"{QR_API_URL}/schedule/invalidate",
+            token=token,
+            data={"group_ids": sorted(group_ids), "teacher_ids": sorted(teacher_ids)}
+        )
+        return True
+    except APIError as e:
+        print(f"Не удалось уведомить сервис QR об изменении расписания: {e.message}")
+        return False
+
 def send_schedule_notifications(notification_data: Dict[str, Any], token: str) -> bool:
     """
     Отправляет уведомления об изменениях в расписании студентам и преподавателям
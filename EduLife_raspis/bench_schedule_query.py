@@ -0,0 +1,159 @@
+"""
+Бенчмарк выборок расписания на синтетическом расписании за несколько лет.
+
+Создает временную базу, заполняет ее занятиями (группы x учебные дни x пары)
+и сравнивает типичные запросы клиентов: раньше - вся история группы/преподавателя
+с фильтрацией на клиенте, теперь - query_schedule с периодом по составным индексам.
+Для сравнения те же запросы выполняются на копии базы без индексов.
+
+Запуск: python bench_schedule_query.py [--years 4] [--groups 60] [--teachers 120]
+                                       [--lessons-per-day 4] [--repeat 50]
+"""
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import date, timedelta
+
+import database
+
+PAIR_STARTS = ["08:30:00", "10:10:00", "11:50:00", "13:50:00", "15:30:00", "17:10:00"]
+CLASSROOMS = 80
+SUBJECTS = 150
+
+
+def fill_database(args, rng):
+    database.create_tables()
+    conn = database.get_db_connection()
+    conn.executemany("INSERT INTO subjects (name) VALUES (?)", [(f"Предмет {i}",) for i in range(1, SUBJECTS + 1)])
+    conn.executemany("INSERT INTO classrooms (name) VALUES (?)", [(f"Ауд. {i}",) for i in range(1, CLASSROOMS + 1)])
+    lesson_types = conn.execute("SELECT COUNT(*) FROM lesson_types").fetchone()[0]
+
+    first_day = args.first_day
+    rows = []
+    day = first_day
+    while day < first_day + timedelta(days=365 * args.years):
+        if day.weekday() < 6:
+            for group_id in range(1, args.groups + 1):
+                for pair in rng.sample(range(len(PAIR_STARTS)), args.lessons_per_day):
+                    start = PAIR_STARTS[pair]
+                    end = f"{int(start[:2]) + 1:02d}{start[2:]}"
+                    rows.append((
+                        day.isoformat(), start, end,
+                        rng.randint(1, SUBJECTS), rng.randint(1, args.teachers), group_id,
+                        rng.randint(1, CLASSROOMS), rng.randint(1, lesson_types)
+                    ))
+        day += timedelta(days=1)
+
+    conn.executemany("""
+        INSERT INTO schedule (
+            date, time_start, time_end, subject_id, teacher_id,
+            group_id, classroom_id, lesson_type_id
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    return len(rows)
+
+
+def random_week(rng, args):
+    """Случайная учебная неделя из синтетического расписания: фильтры date_from/date_to"""
+    first_monday = args.first_day - timedelta(days=args.first_day.weekday())
+    monday = first_monday + timedelta(weeks=rng.randint(1, 52 * args.years - 1))
+    return {"date_from": monday.isoformat(), "date_to": (monday + timedelta(days=6)).isoformat()}
+
+
+def client_side_week(fetch, rng, args):
+    """Как раньше: вся история, неделя выбирается на клиенте"""
+    week = random_week(rng, args)
+    return [row for row in fetch() if week["date_from"] <= row["date"] <= week["date_to"]]
+
+
+def scenarios(args, rng):
+    def group_id():
+        return rng.randint(1, args.groups)
+
+    def teacher_id():
+        return rng.randint(1, args.teachers)
+
+    return [
+        ("group week, client-side filter",
+         lambda: client_side_week(lambda: database.get_schedule_by_group(group_id()), rng, args)),
+        ("group week, date_from/date_to",
+         lambda: database.query_schedule(group_id=group_id(), **random_week(rng, args))),
+        ("teacher week, client-side filter",
+         lambda: client_side_week(lambda: database.get_schedule_by_teacher(teacher_id()), rng, args)),
+        ("teacher week, date_from/date_to",
+         lambda: database.query_schedule(teacher_id=teacher_id(), **random_week(rng, args))),
+        ("classroom week",
+         lambda: database.query_schedule(classroom_id=rng.randint(1, CLASSROOMS), **random_week(rng, args))),
+        ("group mondays, term",
+         lambda: database.query_schedule(group_id=group_id(), weekday=1, date_from=random_week(rng, args)["date_from"], limit=100)),
+        ("group history, page of 50",
+         lambda: database.query_schedule(group_id=group_id(), limit=50)),
+    ]
+
+
+def run(args, label):
+    rng = random.Random(args.seed)
+    print(f"\n{label}")
+    print(f"{'scenario':<36}{'p50 ms':>10}{'p95 ms':>10}{'rows':>8}")
+    for name, query in scenarios(args, rng):
+        timings = []
+        rows = 0
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            rows = len(query())
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        print(f"{name:<36}{statistics.median(timings):>10.2f}{p95:>10.2f}{rows:>8}")
+
+
+def drop_indexes(path):
+    conn = sqlite3.connect(path)
+    for (name,) in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'schedule' AND sql IS NOT NULL"
+    ).fetchall():
+        conn.execute(f"DROP INDEX {name}")
+    conn.commit()
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк выборок расписания")
+    parser.add_argument("--years", type=int, default=4)
+    parser.add_argument("--groups", type=int, default=60)
+    parser.add_argument("--teachers", type=int, default=120)
+    parser.add_argument("--lessons-per-day", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    args.first_day = date(date.today().year - args.years, 9, 1)
+
+    tmp_dir = tempfile.mkdtemp(prefix="bench_schedule_")
+    try:
+        database.db_path = os.path.join(tmp_dir, "schedule.db")
+        started = time.perf_counter()
+        count = fill_database(args, random.Random(args.seed))
+        print(f"Synthetic timetable: {count} lessons, {args.years} years, {args.groups} groups "
+              f"({time.perf_counter() - started:.1f}s to build)")
+
+        run(args, "With composite indexes")
+
+        unindexed = os.path.join(tmp_dir, "schedule_unindexed.db")
+        shutil.copyfile(database.db_path, unindexed)
+        drop_indexes(unindexed)
+        database.db_path = unindexed
+        run(args, "Without indexes")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
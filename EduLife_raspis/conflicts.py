@@ -0,0 +1,207 @@
+"""
+Поиск накладок в расписании: преподаватель, группа или аудитория
+заняты двумя занятиями в одно и то же время.
+
+Поточное занятие (один предмет у одного преподавателя в одной аудитории
+в одно время для нескольких групп) накладкой для преподавателя и аудитории
+не считается.
+"""
+from bisect import bisect_left, bisect_right
+from heapq import heappop, heappush
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+# Ресурсы, которые не могут быть заняты двумя занятиями одновременно
+RESOURCES = ("teacher_id", "group_id", "classroom_id")
+
+# Поля занятия в отчете о накладках
+LESSON_FIELDS = ("id", "date", "time_start", "time_end", "subject_id", "teacher_id", "group_id", "classroom_id")
+
+
+class ScheduleConflictError(ValueError):
+    """Занятие пересекается с уже существующими"""
+    def __init__(self, conflicts: List[Dict[str, Any]]):
+        self.conflicts = conflicts
+        super().__init__(f"Занятие пересекается с существующими: {len(conflicts)}")
+
+
+def _seconds(value) -> int:
+    """Время "HH:MM[:SS]" или datetime.time в секундах от начала дня"""
+    if hasattr(value, "hour"):
+        return value.hour * 3600 + value.minute * 60 + value.second
+    parts = [int(part) for part in str(value).split(":")]
+    return parts[0] * 3600 + parts[1] * 60 + (parts[2] if len(parts) > 2 else 0)
+
+
+def _iso(value) -> str:
+    """Дата или время в ISO-строке"""
+    return value.isoformat() if hasattr(value, "isoformat") else str(value)
+
+
+def _interval(lesson: Dict[str, Any]):
+    return _seconds(lesson["time_start"]), _seconds(lesson["time_end"])
+
+
+def is_shared_lesson(a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+    """Поточное занятие: тот же предмет, преподаватель, аудитория и время"""
+    return (
+        all(a.get(field) == b.get(field) for field in ("subject_id", "teacher_id", "classroom_id"))
+        and _interval(a) == _interval(b)
+    )
+
+
+def _is_conflict(resource: str, a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+    return resource == "group_id" or not is_shared_lesson(a, b)
+
+
+def _lesson_summary(lesson: Dict[str, Any]) -> Dict[str, Any]:
+    summary = {field: _iso(lesson[field]) if field in ("date", "time_start", "time_end") else lesson.get(field)
+               for field in LESSON_FIELDS}
+    # Строка файла для еще не сохраненных занятий из импорта
+    if "row" in lesson:
+        summary["row"] = lesson["row"]
+    return summary
+
+
+class _DayIntervals:
+    """
+    Занятия одного ресурса за день, отсортированные по началу, и дерево
+    отрезков над ними с максимумом времени окончания в каждом узле
+    """
+    def __init__(self, items: Iterable[tuple] = ()):
+        # items: (начало, окончание, занятие); сортировка устойчивая, как и вставка через bisect_right
+        items = sorted(items, key=lambda item: item[0])
+        self.starts: List[int] = [start for start, _, _ in items]
+        self.lessons: List[tuple] = [(end, lesson) for _, end, lesson in items]
+        self._build()
+
+    def _build(self):
+        """Дерево строится снизу вверх за O(n)"""
+        size = 1
+        while size < len(self.lessons):
+            size *= 2
+        tree = [-1] * (2 * size)
+        for j, (lesson_end, _) in enumerate(self.lessons):
+            tree[size + j] = lesson_end
+        for node in range(size - 1, 0, -1):
+            tree[node] = max(tree[2 * node], tree[2 * node + 1])
+        self._tree, self._size = tree, size
+
+    def add(self, start: int, end: int, lesson: Dict[str, Any]):
+        """
+        Добавляет одно занятие за O(n). Только для единичных проверок:
+        наборы занятий индексируются сразу через конструктор
+        """
+        i = bisect_right(self.starts, start)
+        self.starts.insert(i, start)
+        self.lessons.insert(i, (end, lesson))
+        self._build()
+
+    def overlapping(self, start: int, end: int) -> List[Dict[str, Any]]:
+        """
+        Занятия, пересекающиеся с [start, end): O((k + 1) log n).
+        Спуск идет только в поддеревья с занятиями, начавшимися до end,
+        в которых хотя бы одно занятие заканчивается позже start
+        """
+        last = bisect_left(self.starts, end) - 1
+        result = []
+        stack = [(1, 0, self._size - 1)] if last >= 0 else []
+        while stack:
+            node, lo, hi = stack.pop()
+            if lo > last or self._tree[node] <= start:
+                continue
+            if lo == hi:
+                result.append(self.lessons[lo][1])
+                continue
+            mid = (lo + hi) // 2
+            stack.append((2 * node + 1, mid + 1, hi))
+            stack.append((2 * node, lo, mid))
+        return result
+
+
+class ConflictIndex:
+    """Интервальные индексы занятий по дням для каждого преподавателя, группы и аудитории"""
+
+    def __init__(self, lessons: Iterable[Dict[str, Any]] = ()):
+        # Занятия раскладываются по ресурсам и дням, и каждый индекс строится один раз:
+        # O(n log n) вместо перестройки дерева на каждое занятие
+        days: Dict[tuple, List[tuple]] = {}
+        for lesson in lessons:
+            start, end = _interval(lesson)
+            for key in self._keys(lesson):
+                days.setdefault(key, []).append((start, end, lesson))
+        self._days: Dict[tuple, _DayIntervals] = {key: _DayIntervals(items) for key, items in days.items()}
+
+    @staticmethod
+    def _keys(lesson: Dict[str, Any]):
+        day = _iso(lesson["date"])
+        for resource in RESOURCES:
+            if lesson.get(resource) is not None:
+                yield resource, lesson[resource], day
+
+    def add(self, lesson: Dict[str, Any]):
+        start, end = _interval(lesson)
+        for key in self._keys(lesson):
+            self._days.setdefault(key, _DayIntervals()).add(start, end, lesson)
+
+    def find(self, lesson: Dict[str, Any], exclude_id: Optional[int] = None,
+             exclude: Optional[Callable[[Dict[str, Any]], bool]] = None) -> List[Dict[str, Any]]:
+        """
+        Накладки предлагаемого занятия с занятиями индекса, кроме занятия
+        exclude_id и занятий, для которых exclude(занятие) истинно
+        """
+        start, end = _interval(lesson)
+        day = _iso(lesson["date"])
+        conflicts = []
+        for resource in RESOURCES:
+            intervals = self._days.get((resource, lesson.get(resource), day))
+            if intervals is None:
+                continue
+            for other in intervals.overlapping(start, end):
+                if exclude_id is not None and other.get("id") == exclude_id:
+                    continue
+                if exclude is not None and exclude(other):
+                    continue
+                if _is_conflict(resource, lesson, other):
+                    conflicts.append({
+                        "resource": resource[:-3],
+                        "resource_id": lesson[resource],
+                        "date": day,
+                        "lesson": _lesson_summary(other)
+                    })
+        return conflicts
+
+
+def find_all_conflicts(lessons: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Все попарные накладки в наборе занятий за один проход сканирующей прямой:
+    события (ресурс, день, начало) сортируются один раз, активные занятия
+    ресурса за день хранятся в куче по времени окончания
+    """
+    events = []
+    for seq, lesson in enumerate(lessons):
+        start, end = _interval(lesson)
+        day = _iso(lesson["date"])
+        for resource in RESOURCES:
+            if lesson.get(resource) is not None:
+                events.append((resource, lesson[resource], day, start, end, seq, lesson))
+    events.sort(key=lambda event: event[:6])
+
+    conflicts = []
+    active: List[tuple] = []
+    current = None
+    for resource, resource_id, day, start, end, seq, lesson in events:
+        if (resource, resource_id, day) != current:
+            current = (resource, resource_id, day)
+            active = []
+        while active and active[0][0] <= start:
+            heappop(active)
+        for _, _, other in active:
+            if _is_conflict(resource, other, lesson):
+                conflicts.append({
+                    "resource": resource[:-3],
+                    "resource_id": resource_id,
+                    "date": day,
+                    "lessons": [_lesson_summary(other), _lesson_summary(lesson)]
+                })
+        heappush(active, (end, seq, lesson))
+    return conflicts
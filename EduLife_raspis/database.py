@@ -1,9 +1,23 @@
 import sqlite3
 import os
+import threading
 from datetime import datetime
+from conflicts import ConflictIndex, ScheduleConflictError
 
 db_path = os.path.join(os.path.dirname(__file__), "seconddata.db")
 
+# Справочники в памяти процесса: загружаются при первом обращении и сбрасываются
+# функциями этого модуля, изменяющими subjects, classrooms и lesson_types
+_dimensions = None
+_dimensions_lock = threading.Lock()
+
+# Справочник -> (поле id в строке расписания, поле названия)
+DIMENSION_FIELDS = {
+    "subjects": ("subject_id", "subject_name"),
+    "classrooms": ("classroom_id", "classroom_name"),
+    "lesson_types": ("lesson_type_id", "lesson_type"),
+}
+
 def get_db_connection():
     conn = sqlite3.connect(db_path)
     conn.row_factory = sqlite3.Row
@@ -74,6 +88,8 @@ def create_tables():
         )
     """)
     
+    _migrate_schedule(cursor)
+
     # Заполнение таблицы типов занятий, если она пуста
     cursor.execute("SELECT COUNT(*) FROM lesson_types")
     if cursor.fetchone()[0] == 0:
@@ -91,150 +107,392 @@ def create_tables():
 
     conn.commit()
     conn.close()
+    invalidate_dimensions()
 
 
-def get_schedule(filters=None):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def _migrate_schedule(cursor):
+    """
+    Добавляет недостающие столбцы в старые базы и составные индексы для выборок
+    расписания группы, преподавателя и аудитории за период
+    """
+    cursor.execute("PRAGMA table_info(notifications)")
+    if "target_group_id" not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE notifications ADD COLUMN target_group_id INTEGER DEFAULT NULL")
 
-    query = """
-        SELECT
-            s.id, s.date, s.time_start, s.time_end,
-            s.subject_id, subj.name as subject_name,
-            s.teacher_id, s.group_id,
-            s.classroom_id, c.name as classroom_name,
-            s.lesson_type_id, lt.name as lesson_type
-        FROM schedule s
-        JOIN subjects subj ON s.subject_id = subj.id
-        JOIN classrooms c ON s.classroom_id = c.id
-        JOIN lesson_types lt ON s.lesson_type_id = lt.id
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_schedule_group_date ON schedule (group_id, date, time_start)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_schedule_teacher_date ON schedule (teacher_id, date, time_start)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_schedule_classroom_date ON schedule (classroom_id, date, time_start)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_schedule_date ON schedule (date, time_start)")
+
+    _migrate_schedule_versions(cursor)
+
+def _migrate_schedule_versions(cursor):
     """
+    Версии расписания для ETag: по группе, по преподавателю, всего расписания ('all')
+    и справочников ('dimensions'). Поддерживаются триггерами в той же транзакции,
+    что и изменение: каждое изменение занятия пишет строку в notifications,
+    из нее берутся старые и новые группа и преподаватель
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schedule_versions (
+            scope TEXT NOT NULL,
+            scope_id INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            PRIMARY KEY (scope, scope_id)
+        ) WITHOUT ROWID
+    """)
 
-    where_clauses = []
-    params = []
+    affected = " UNION ".join(
+        f"SELECT '{scope}', CASE WHEN json_valid(NEW.{column}) THEN json_extract(NEW.{column}, '$.{field}') END"
+        for scope, field in (("group", "group_id"), ("teacher", "teacher_id"))
+        for column in ("previous_data", "new_data")
+    )
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_notifications_schedule_versions
+        AFTER INSERT ON notifications
+        BEGIN
+            INSERT INTO schedule_versions (scope, scope_id, version)
+            SELECT scope, scope_id, 1 FROM (
+                SELECT 'group' AS scope, NEW.target_group_id AS scope_id
+                UNION {affected}
+                UNION SELECT 'all', 0
+            ) WHERE scope_id IS NOT NULL
+            ON CONFLICT (scope, scope_id) DO UPDATE SET version = version + 1;
+        END
+    """)
 
-    if filters:
-        if filters.get('date'):
-            where_clauses.append("s.date = ?")
-            params.append(filters['date'])
+    # Переименование и удаление предметов и аудиторий меняют названия в ответах
+    for table in ("subjects", "classrooms"):
+        for event in ("UPDATE", "DELETE"):
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_schedule_versions
+                AFTER {event} ON {table}
+                BEGIN
+                    INSERT INTO schedule_versions (scope, scope_id, version) VALUES ('dimensions', 0, 1)
+                    ON CONFLICT (scope, scope_id) DO UPDATE SET version = version + 1;
+                END
+            """)
+
+def get_schedule_version(scope, scope_id=0):
+    """Версия расписания (scope, scope_id) и версия справочников; 0 - изменений еще не было"""
+    conn = get_db_connection()
+    try:
+        row = conn.execute("""
+            SELECT
+                COALESCE(MAX(CASE WHEN scope = ? AND scope_id = ? THEN version END), 0),
+                COALESCE(MAX(CASE WHEN scope = 'dimensions' THEN version END), 0)
+            FROM schedule_versions
+            WHERE (scope = ? AND scope_id = ?) OR (scope = 'dimensions' AND scope_id = 0)
+        """, (scope, scope_id, scope, scope_id)).fetchone()
+        return row[0], row[1]
+    finally:
+        conn.close()
 
-        if filters.get('teacher_id'):
-            where_clauses.append("s.teacher_id = ?")
-            params.append(filters['teacher_id'])
+_SCHEDULE_SELECT = """
+    SELECT
+        s.id, s.date, s.time_start, s.time_end,
+        s.subject_id, subj.name as subject_name,
+        s.teacher_id, s.group_id,
+        s.classroom_id, c.name as classroom_name,
+        s.lesson_type_id, lt.name as lesson_type
+    FROM schedule s
+    JOIN subjects subj ON s.subject_id = subj.id
+    JOIN classrooms c ON s.classroom_id = c.id
+    JOIN lesson_types lt ON s.lesson_type_id = lt.id
+"""
+
+# Фильтры на равенство: параметр query_schedule -> столбец
+_SCHEDULE_EQUAL_FILTERS = {
+    "schedule_id": "s.id",
+    "group_id": "s.group_id",
+    "teacher_id": "s.teacher_id",
+    "classroom_id": "s.classroom_id",
+    "lesson_type_id": "s.lesson_type_id",
+    "subject_id": "s.subject_id",
+    "date": "s.date",
+}
+
+def encode_schedule_cursor(row):
+    """Курсор страницы: "<date>,<time_start>,<id>" последнего полученного занятия"""
+    return f"{row['date']},{row['time_start']},{row['id']}"
+
+def decode_schedule_cursor(cursor):
+    try:
+        lesson_date, time_start, schedule_id = cursor.split(",")
+        return lesson_date, time_start, int(schedule_id)
+    except ValueError:
+        raise ValueError("Некорректный курсор")
 
-        if filters.get('group_id'):
-            where_clauses.append("s.group_id = ?")
-            params.append(filters['group_id'])
+def query_schedule(date_from=None, date_to=None, weekday=None, limit=None, cursor=None, **filters):
+    """
+    Занятия по фильтрам в порядке (дата, время начала, id).
+
+    filters - равенство по schedule_id, group_id, teacher_id, classroom_id,
+    lesson_type_id, subject_id, date; date_from/date_to - период включительно;
+    weekday - день недели (1 - понедельник, 7 - воскресенье).
+    При заданном limit возвращается одна страница, следующая запрашивается
+    с cursor=encode_schedule_cursor(последняя строка).
+    Выборки группы, преподавателя и аудитории за период идут по составным
+    индексам (..., date, time_start) и не требуют сортировки.
+    """
+    where_clauses = []
+    params = []
 
+    for name, value in filters.items():
+        if name not in _SCHEDULE_EQUAL_FILTERS:
+            raise TypeError(f"Unknown schedule filter: {name}")
+        if value is not None:
+            where_clauses.append(f"{_SCHEDULE_EQUAL_FILTERS[name]} = ?")
+            params.append(value)
+
+    if date_from is not None:
+        where_clauses.append("s.date >= ?")
+        params.append(date_from)
+    if date_to is not None:
+        where_clauses.append("s.date <= ?")
+        params.append(date_to)
+    if weekday is not None:
+        # strftime('%w'): 0 - воскресенье
+        where_clauses.append("(CAST(strftime('%w', s.date) AS INTEGER) + 6) % 7 + 1 = ?")
+        params.append(weekday)
+    if cursor is not None:
+        where_clauses.append("(s.date, s.time_start, s.id) > (?, ?, ?)")
+        params.extend(decode_schedule_cursor(cursor))
+
+    query = _SCHEDULE_SELECT
     if where_clauses:
         query += " WHERE " + " AND ".join(where_clauses)
+    query += " ORDER BY s.date, s.time_start, s.id"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
 
-    query += " ORDER BY s.date, s.time_start"
-
-    cursor.execute(query, params)
-    result = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    conn = get_db_connection()
+    try:
+        return [dict(row) for row in conn.execute(query, params).fetchall()]
+    finally:
+        conn.close()
 
-    return result
+def get_schedule(filters=None):
+    filters = filters or {}
+    return query_schedule(
+        date=filters.get('date') or None,
+        teacher_id=filters.get('teacher_id') or None,
+        group_id=filters.get('group_id') or None
+    )
 
 def get_schedule_by_id(group_id):
+    result = query_schedule(group_id=group_id, limit=1)
+    return result[0] if result else None
+
+def _schedule_values(schedule_data):
+    """Копия данных занятия с датой и временем в виде строк (для SQLite и JSON)"""
+    values = dict(schedule_data)
+    for field in ('date', 'time_start', 'time_end'):
+        value = values.get(field)
+        if hasattr(value, 'strftime'):
+            values[field] = value.isoformat() if field == 'date' else value.strftime('%H:%M:%S')
+    return values
+
+_LESSON_COLUMNS = """
+    id, date, time_start, time_end, subject_id, teacher_id,
+    group_id, classroom_id, lesson_type_id
+"""
+
+def find_lesson_conflicts(cursor, lesson, exclude_id=None):
+    """
+    Накладки предлагаемого занятия: занятия того же дня с тем же преподавателем,
+    группой или аудиторией (по индексам (..., date)) складываются в ConflictIndex
+    """
+    cursor.execute(f"""
+        SELECT {_LESSON_COLUMNS} FROM schedule
+        WHERE date = ? AND (teacher_id = ? OR group_id = ? OR classroom_id = ?)
+    """, (lesson['date'], lesson['teacher_id'], lesson['group_id'], lesson['classroom_id']))
+    return ConflictIndex(dict(row) for row in cursor.fetchall()).find(lesson, exclude_id)
+
+def get_schedule_lessons(date_from=None, date_to=None):
+    """Занятия за период без справочников - для поиска накладок"""
+    query = f"SELECT {_LESSON_COLUMNS} FROM schedule WHERE 1=1"
+    params = []
+    if date_from is not None:
+        query += " AND date >= ?"
+        params.append(date_from)
+    if date_to is not None:
+        query += " AND date <= ?"
+        params.append(date_to)
+
+    conn = get_db_connection()
+    try:
+        return [dict(row) for row in conn.execute(query, params).fetchall()]
+    finally:
+        conn.close()
+
+def create_schedule(schedule_data, allow_conflicts=False):
     conn = get_db_connection()
     cursor = conn.cursor()
+    # Проверка накладок и вставка в одной транзакции с блокировкой записи:
+    # иначе два параллельных запроса могут занять одно и то же время
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("SELECT id FROM subjects WHERE id = ?", (schedule_data['subject_id'],))
+        if not cursor.fetchone():
+            raise ValueError(f"Subject with id {schedule_data['subject_id']} does not exist")
 
-    query = """
-        SELECT
-            s.id, s.date, s.time_start, s.time_end,
-            s.subject_id, subj.name as subject_name,
-            s.teacher_id, s.group_id,
-            s.classroom_id, c.name as classroom_name,
-            s.lesson_type_id, lt.name as lesson_type
-        FROM schedule s
-        JOIN subjects subj ON s.subject_id = subj.id
-        JOIN classrooms c ON s.classroom_id = c.id
-        JOIN lesson_types lt ON s.lesson_type_id = lt.id
-        WHERE s.group_id = ?
-    """
+        cursor.execute("SELECT id FROM classrooms WHERE id = ?", (schedule_data['classroom_id'],))
+        if not cursor.fetchone():
+            raise ValueError(f"Classroom with id {schedule_data['classroom_id']} does not exist")
 
-    cursor.execute(query, (group_id,))
-    result = cursor.fetchone()
-    conn.close()
+        cursor.execute("SELECT id FROM lesson_types WHERE id = ?", (schedule_data['lesson_type_id'],))
+        if not cursor.fetchone():
+            raise ValueError(f"Lesson type with id {schedule_data['lesson_type_id']} does not exist")
 
-    if result:
-        return dict(result)
-    return None
+        # Дата и время занятия в виде строк
+        json_data = _schedule_values(schedule_data)
 
-def create_schedule(schedule_data):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+        if not allow_conflicts:
+            conflicts = find_lesson_conflicts(cursor, json_data)
+            if conflicts:
+                raise ScheduleConflictError(conflicts)
 
-    cursor.execute("SELECT id FROM subjects WHERE id = ?", (schedule_data['subject_id'],))
-    if not cursor.fetchone():
-        conn.close()
-        raise ValueError(f"Subject with id {schedule_data['subject_id']} does not exist")
+        cursor.execute("""
+            INSERT INTO schedule (
+                date, time_start, time_end, subject_id, teacher_id,
+                group_id, classroom_id, lesson_type_id
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            json_data['date'],
+            json_data['time_start'],
+            json_data['time_end'],
+            schedule_data['subject_id'],
+            schedule_data['teacher_id'],
+            schedule_data['group_id'],
+            schedule_data['classroom_id'],
+            schedule_data['lesson_type_id']
+        ))
+
+        schedule_id = cursor.lastrowid
+
+        import json
+        cursor.execute("""
+            INSERT INTO notifications (
+                schedule_id, change_type, new_data, target_group_id
+            ) VALUES (?, ?, ?, ?)
+        """, (
+            schedule_id,
+            'create',
+            json.dumps(json_data),
+            schedule_data['group_id']  # Сохраняем ID группы
+        ))
 
-    cursor.execute("SELECT id FROM classrooms WHERE id = ?", (schedule_data['classroom_id'],))
-    if not cursor.fetchone():
-        conn.close()
-        raise ValueError(f"Classroom with id {schedule_data['classroom_id']} does not exist")
+        conn.commit()
 
-    cursor.execute("SELECT id FROM lesson_types WHERE id = ?", (schedule_data['lesson_type_id'],))
-    if not cursor.fetchone():
+        return schedule_id
+    finally:
+        # Без commit транзакция откатывается при закрытии соединения
         conn.close()
-        raise ValueError(f"Lesson type with id {schedule_data['lesson_type_id']} does not exist")
 
-    # Преобразуем time объекты в строки, если они таковыми являются
-    time_start = schedule_data['time_start']
-    time_end = schedule_data['time_end']
-    
-    # Проверяем, являются ли объекты типом datetime.time и преобразуем их в строки
-    if hasattr(time_start, 'strftime'):
-        time_start = time_start.strftime('%H:%M:%S')
-    if hasattr(time_end, 'strftime'):
-        time_end = time_end.strftime('%H:%M:%S')
+_IMPORT_FIELDS = (
+    'date', 'time_start', 'time_end', 'subject_id', 'teacher_id',
+    'group_id', 'classroom_id', 'lesson_type_id'
+)
 
-    cursor.execute("""
-        INSERT INTO schedule (
-            date, time_start, time_end, subject_id, teacher_id,
-            group_id, classroom_id, lesson_type_id
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        schedule_data['date'],
-        time_start,  # Используем строку вместо объекта datetime.time
-        time_end,    # Используем строку вместо объекта datetime.time
-        schedule_data['subject_id'],
-        schedule_data['teacher_id'],
-        schedule_data['group_id'],
-        schedule_data['classroom_id'],
-        schedule_data['lesson_type_id']
-    ))
+def import_schedule(lessons, allow_conflicts=False, progress=None, chunk_size=500):
+    """
+    Добавляет проверенные занятия (даты и время - строки) одной транзакцией.
 
-    schedule_id = cursor.lastrowid
+    Накладки ищутся по ConflictIndex, построенному один раз по существующим занятиям
+    за период импорта и строкам файла: каждая строка сверяется с существующими
+    занятиями и предыдущими строками. Вставка идет executemany порциями по chunk_size,
+    затем пишется одно уведомление на каждую затронутую группу.
+    progress(stage, done) вызывается после каждой порции.
+    """
+    if not lessons:
+        return {"inserted": 0, "groups": []}
 
-    # Для json.dumps нам тоже нужно обновить данные в строковый формат
-    json_data = schedule_data.copy()
-    if hasattr(schedule_data['time_start'], 'strftime'):
-        json_data['time_start'] = time_start
-    if hasattr(schedule_data['time_end'], 'strftime'):
-        json_data['time_end'] = time_end
-    if hasattr(schedule_data['date'], 'isoformat'):
-        json_data['date'] = schedule_data['date'].isoformat()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        # Блокировка записи до конца импорта: проверка накладок и вставка видят одни данные
+        cursor.execute("BEGIN IMMEDIATE")
+
+        if not allow_conflicts:
+            dates = [lesson['date'] for lesson in lessons]
+            cursor.execute(
+                f"SELECT {_LESSON_COLUMNS} FROM schedule WHERE date >= ? AND date <= ?",
+                (min(dates), max(dates))
+            )
+            # Индекс строится один раз по существующим занятиям и всему файлу; строка
+            # сверяется только с существующими и предыдущими строками файла
+            index = ConflictIndex([*(dict(row) for row in cursor.fetchall()), *lessons])
+            pending = {id(lesson) for lesson in lessons}
+            conflicts = []
+            for done, lesson in enumerate(lessons, 1):
+                conflicts.extend(
+                    {"row": lesson.get("row"), **conflict}
+                    for conflict in index.find(lesson, exclude=lambda other: id(other) in pending)
+                )
+                pending.discard(id(lesson))
+                if progress and (done % chunk_size == 0 or done == len(lessons)):
+                    progress("checking_conflicts", done)
+            if conflicts:
+                raise ScheduleConflictError(conflicts)
+
+        last_id = cursor.execute("SELECT COALESCE(MAX(id), 0) FROM schedule").fetchone()[0]
+        for start in range(0, len(lessons), chunk_size):
+            chunk = lessons[start:start + chunk_size]
+            cursor.executemany(f"""
+                INSERT INTO schedule ({', '.join(_IMPORT_FIELDS)})
+                VALUES ({', '.join('?' * len(_IMPORT_FIELDS))})
+            """, [tuple(lesson[field] for field in _IMPORT_FIELDS) for lesson in chunk])
+            if progress:
+                progress("inserting", start + len(chunk))
+
+        # Одно уведомление на группу вместо уведомления на каждое занятие
+        groups = {}
+        for lesson in lessons:
+            group = groups.setdefault(lesson['group_id'], {"teacher_ids": set(), "dates": set(), "lessons": 0})
+            group["teacher_ids"].add(lesson['teacher_id'])
+            group["dates"].add(lesson['date'])
+            group["lessons"] += 1
+        first_ids = dict(cursor.execute(
+            "SELECT group_id, MIN(id) FROM schedule WHERE id > ? GROUP BY group_id", (last_id,)
+        ).fetchall())
+
+        import json
+        cursor.executemany("""
+            INSERT INTO notifications (
+                schedule_id, change_type, new_data, target_group_id
+            ) VALUES (?, ?, ?, ?)
+        """, [
+            (
+                first_ids[group_id],
+                'import',
+                json.dumps({
+                    "group_id": group_id,
+                    "teacher_ids": sorted(group["teacher_ids"]),
+                    "lessons": group["lessons"],
+                    "date_from": min(group["dates"]),
+                    "date_to": max(group["dates"])
+                }),
+                group_id
+            )
+            for group_id, group in groups.items()
+        ])
+
+        # Триггер уведомлений знает только одного преподавателя, версии остальных - здесь
+        teacher_ids = set().union(*(group["teacher_ids"] for group in groups.values()))
+        cursor.executemany("""
+            INSERT INTO schedule_versions (scope, scope_id, version) VALUES ('teacher', ?, 1)
+            ON CONFLICT (scope, scope_id) DO UPDATE SET version = version + 1
+        """, [(teacher_id,) for teacher_id in teacher_ids])
 
-    import json
-    cursor.execute("""
-        INSERT INTO notifications (
-            schedule_id, change_type, new_data, target_group_id
-        ) VALUES (?, ?, ?, ?)
-    """, (
-        schedule_id,
-        'create',
-        json.dumps(json_data),
-        schedule_data['group_id']  # Сохраняем ID группы
-    ))
-    
-    conn.commit()
-    conn.close()
-    
-    return schedule_id
+        conn.commit()
+        return {"inserted": len(lessons), "groups": sorted(groups)}
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
 def delete_schedule(schedule_id):
     conn = get_db_connection()
@@ -274,130 +532,132 @@ def delete_schedule(schedule_id):
     conn.close()
     return True
 
-def update_schedule(schedule_id, schedule_data):
+def update_schedule(schedule_id, schedule_data, allow_conflicts=False):
     conn = get_db_connection()
     cursor = conn.cursor()
+    # Как в create_schedule: проверка накладок и изменение - одна транзакция с блокировкой записи
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        schedule_data = _schedule_values(schedule_data)
 
-    cursor.execute("""
-        SELECT
-            date, time_start, time_end, subject_id, teacher_id,
-            group_id, classroom_id, lesson_type_id
-        FROM schedule
-        WHERE id = ?
-    """, (schedule_id,))
-
-    current_data = cursor.fetchone()
-    if not current_data:
-        conn.close()
-        raise ValueError(f"Schedule with id {schedule_id} does not exist")
-    
-    # Получаем target_group_id
-    # Если в обновлении меняется группа, используем новую group_id
-    # Иначе используем текущую group_id из расписания
-    target_group_id = schedule_data.get('group_id', current_data['group_id'])
-    
-    if 'subject_id' in schedule_data:
-        cursor.execute("SELECT id FROM subjects WHERE id = ?", (schedule_data['subject_id'],))
-        if not cursor.fetchone():
-            conn.close()
-            raise ValueError(f"Subject with id {schedule_data['subject_id']} does not exist")
-
-    if 'classroom_id' in schedule_data:
-        cursor.execute("SELECT id FROM classrooms WHERE id = ?", (schedule_data['classroom_id'],))
-        if not cursor.fetchone():
-            conn.close()
-            raise ValueError(f"Classroom with id {schedule_data['classroom_id']} does not exist")
-
-    if 'lesson_type_id' in schedule_data:
-        cursor.execute("SELECT id FROM lesson_types WHERE id = ?", (schedule_data['lesson_type_id'],))
-        if not cursor.fetchone():
-            conn.close()
-            raise ValueError(f"Lesson type with id {schedule_data['lesson_type_id']} does not exist")
-
-    update_fields = []
-    update_values = []
-
-    for field in ['date', 'time_start', 'time_end', 'subject_id', 'teacher_id',
-                  'group_id', 'classroom_id', 'lesson_type_id']:
-        if field in schedule_data:
-            update_fields.append(f"{field} = ?")
-            update_values.append(schedule_data[field])
+        cursor.execute("""
+            SELECT
+                date, time_start, time_end, subject_id, teacher_id,
+                group_id, classroom_id, lesson_type_id
+            FROM schedule
+            WHERE id = ?
+        """, (schedule_id,))
+
+        current_data = cursor.fetchone()
+        if not current_data:
+            raise ValueError(f"Schedule with id {schedule_id} does not exist")
+
+        # Получаем target_group_id
+        # Если в обновлении меняется группа, используем новую group_id
+        # Иначе используем текущую group_id из расписания
+        target_group_id = schedule_data.get('group_id', current_data['group_id'])
+
+        if 'subject_id' in schedule_data:
+            cursor.execute("SELECT id FROM subjects WHERE id = ?", (schedule_data['subject_id'],))
+            if not cursor.fetchone():
+                raise ValueError(f"Subject with id {schedule_data['subject_id']} does not exist")
+
+        if 'classroom_id' in schedule_data:
+            cursor.execute("SELECT id FROM classrooms WHERE id = ?", (schedule_data['classroom_id'],))
+            if not cursor.fetchone():
+                raise ValueError(f"Classroom with id {schedule_data['classroom_id']} does not exist")
+
+        if 'lesson_type_id' in schedule_data:
+            cursor.execute("SELECT id FROM lesson_types WHERE id = ?", (schedule_data['lesson_type_id'],))
+            if not cursor.fetchone():
+                raise ValueError(f"Lesson type with id {schedule_data['lesson_type_id']} does not exist")
+
+        if not allow_conflicts:
+            conflicts = find_lesson_conflicts(cursor, {**dict(current_data), **schedule_data}, exclude_id=schedule_id)
+            if conflicts:
+                raise ScheduleConflictError(conflicts)
+
+        update_fields = []
+        update_values = []
+
+        for field in ['date', 'time_start', 'time_end', 'subject_id', 'teacher_id',
+                      'group_id', 'classroom_id', 'lesson_type_id']:
+            if field in schedule_data:
+                update_fields.append(f"{field} = ?")
+                update_values.append(schedule_data[field])
+
+        update_fields.append("updated_at = CURRENT_TIMESTAMP")
+
+        if not update_fields:
+            return schedule_id
+
+        cursor.execute(f"""
+            UPDATE schedule
+            SET {', '.join(update_fields)}
+            WHERE id = ?
+        """, update_values + [schedule_id])
+
+        import json
+        cursor.execute("""
+            INSERT INTO notifications (
+                schedule_id, change_type, previous_data, new_data, target_group_id
+            ) VALUES (?, ?, ?, ?, ?)
+        """, (
+            schedule_id,
+            'update',
+            json.dumps(dict(current_data)),
+            json.dumps(schedule_data),
+            target_group_id  # Сохраняем ID группы в target_group_id
+        ))
 
-    update_fields.append("updated_at = CURRENT_TIMESTAMP")
+        conn.commit()
 
-    if not update_fields:
-        conn.close()
         return schedule_id
-    
-    cursor.execute(f"""
-        UPDATE schedule
-        SET {', '.join(update_fields)}
-        WHERE id = ?
-    """, update_values + [schedule_id])
-
-    import json
-    cursor.execute("""
-        INSERT INTO notifications (
-            schedule_id, change_type, previous_data, new_data, target_group_id
-        ) VALUES (?, ?, ?, ?, ?)
-    """, (
-        schedule_id,
-        'update',
-        json.dumps(dict(current_data)),
-        json.dumps(schedule_data),
-        target_group_id  # Сохраняем ID группы в target_group_id
-    ))
-
-    conn.commit()
-    conn.close()
-
-    return schedule_id
-
-def get_schedule_by_teacher(teacher_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        SELECT
-            s.id, s.date, s.time_start, s.time_end,
-            s.subject_id, subj.name as subject_name,
-            s.teacher_id, s.group_id,
-            s.classroom_id, c.name as classroom_name,
-            s.lesson_type_id, lt.name as lesson_type
-        FROM schedule s
-        JOIN subjects subj ON s.subject_id = subj.id
-        JOIN classrooms c ON s.classroom_id = c.id
-        JOIN lesson_types lt ON s.lesson_type_id = lt.id
-        WHERE s.teacher_id = ?
-    """, (teacher_id,))
-
-    result = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-
-    return result
-
-def get_schedule_by_group(group_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        SELECT
-            s.id, s.date, s.time_start, s.time_end,
-            s.subject_id, subj.name as subject_name,
-            s.teacher_id, s.group_id,
-            s.classroom_id, c.name as classroom_name,
-            s.lesson_type_id, lt.name as lesson_type
-        FROM schedule s
-        JOIN subjects subj ON s.subject_id = subj.id
-        JOIN classrooms c ON s.classroom_id = c.id
-        JOIN lesson_types lt ON s.lesson_type_id = lt.id
-        WHERE s.group_id = ?
-    """, (group_id,))
-
-    result = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    finally:
+        # Без commit транзакция откатывается при закрытии соединения
+        conn.close()
 
-    return result
+def get_schedule_by_teacher(teacher_id, date_from=None, date_to=None):
+    return query_schedule(teacher_id=teacher_id, date_from=date_from, date_to=date_to)
+
+def get_schedule_by_group(group_id, date_from=None, date_to=None):
+    return query_schedule(group_id=group_id, date_from=date_from, date_to=date_to)
+
+def get_dimensions():
+    """{справочник: {"by_id": {id: название}, "by_name": {название: id}}}"""
+    global _dimensions
+    dimensions = _dimensions
+    if dimensions is None:
+        with _dimensions_lock:
+            if _dimensions is None:
+                conn = get_db_connection()
+                try:
+                    loaded = {}
+                    for table in DIMENSION_FIELDS:
+                        rows = conn.execute(f"SELECT id, name FROM {table}").fetchall()
+                        loaded[table] = {
+                            "by_id": {row["id"]: row["name"] for row in rows},
+                            "by_name": {row["name"]: row["id"] for row in rows},
+                        }
+                finally:
+                    conn.close()
+                _dimensions = loaded
+            dimensions = _dimensions
+    return dimensions
+
+def invalidate_dimensions():
+    global _dimensions
+    with _dimensions_lock:
+        _dimensions = None
+
+def fill_dimension_fields(schedule, dimensions):
+    """Дополняет строку расписания недостающими id или названиями справочников"""
+    for table, (id_field, name_field) in DIMENSION_FIELDS.items():
+        if schedule.get(id_field) is None and name_field in schedule:
+            schedule[id_field] = dimensions[table]["by_name"].get(schedule[name_field], 1)
+        elif schedule.get(name_field) is None and id_field in schedule:
+            schedule[name_field] = dimensions[table]["by_id"].get(schedule[id_field])
+    return schedule
 
 def get_pending_notifications():
     conn = get_db_connection()
@@ -475,6 +735,7 @@ def delete_subject(subject_id):
     cursor.execute("DELETE FROM subjects WHERE id = ?", (subject_id,))
     conn.commit()
     conn.close()
+    invalidate_dimensions()
     return True
 
 def update_subject(subject_id, new_name):
@@ -494,6 +755,7 @@ def update_subject(subject_id, new_name):
     cursor.execute("UPDATE subjects SET name = ? WHERE id = ?", (new_name, subject_id))
     conn.commit()
     conn.close()
+    invalidate_dimensions()
     return True
 
 
@@ -504,6 +766,7 @@ def create_subject(name):
         cursor.execute("INSERT INTO subjects (name) VALUES (?)", (name,))
         subject_id = cursor.lastrowid
         conn.commit()
+        invalidate_dimensions()
         return subject_id
     except sqlite3.IntegrityError:
         conn.rollback()
@@ -529,6 +792,7 @@ def create_classroom(name):
         cursor.execute("INSERT INTO classrooms (name) VALUES (?)", (name,))
         classroom_id = cursor.lastrowid
         conn.commit()
+        invalidate_dimensions()
         return classroom_id
     except sqlite3.IntegrityError:
         conn.rollback()
@@ -558,6 +822,7 @@ def delete_classroom(classroom_id):
     cursor.execute("DELETE FROM classrooms WHERE id = ?", (classroom_id,))
     conn.commit()
     conn.close()
+    invalidate_dimensions()
     return True
 
 def update_classroom(classroom_id, new_name):
@@ -577,6 +842,7 @@ def update_classroom(classroom_id, new_name):
     cursor.execute("UPDATE classrooms SET name = ? WHERE id = ?", (new_name, classroom_id))
     conn.commit()
     conn.close()
+    invalidate_dimensions()
     return True
 
 #управление типами занятий
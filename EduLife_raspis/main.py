@@ -1,19 +1,28 @@
 import os
 import database
-from fastapi import FastAPI, Body, HTTPException, Depends, Header, Query, BackgroundTasks
+import schedule_import
+from conflicts import ScheduleConflictError, find_all_conflicts
+from fastapi import FastAPI, Body, HTTPException, Depends, Header, Query, BackgroundTasks, Response, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter
 from typing import Optional, List, Dict, Any
 from datetime import date, time, datetime
+import datetime as dt
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.gzip import GZipMiddleware
 import json
-from api_integration import verify_token, get_teacher_info, get_group_info, send_schedule_notifications, enrich_schedule_data,get_student_by_user_id
+import hashlib
+from api_integration import verify_token, get_teacher_info, get_group_info, send_schedule_notifications, enrich_schedule_data, enrich_schedules, get_student_by_user_id, notify_qr_schedule_change, TTLCache, ENRICH_CACHE_TTL, enrichment_generation
 from database import get_schedule_by_group, get_schedule_by_teacher
 
 # Настройка порта
 PORT = int(os.getenv("PORT", "8090"))
 
+# Готовые тела ответов со списком занятий по версии расписания (секунды).
+# Не дольше кэша сведений о преподавателях и группах, иначе их изменения не будут видны
+SCHEDULE_CACHE_TTL = int(os.getenv("RASPIS_SCHEDULE_CACHE_TTL", str(ENRICH_CACHE_TTL)))
+schedule_response_cache = TTLCache(ttl=SCHEDULE_CACHE_TTL, max_size=1024)
+
 app = FastAPI(
     title="EduLife Расписание API", 
     description="API для управления расписанием занятий", 
@@ -45,7 +54,8 @@ class ScheduleCreate(ScheduleBase):
 
 
 class ScheduleUpdate(BaseModel):
-    date: Optional[date] = None
+    # Имя поля совпадает с типом date, поэтому тип указан через модуль
+    date: Optional[dt.date] = None
     time_start: Optional[time] = None
     time_end: Optional[time] = None
     subject_id: Optional[int] = None
@@ -105,6 +115,8 @@ class ScheduleRead(BaseModel):
     group_name: Optional[str] = None
     faculty_name: Optional[str] = None
 
+schedule_list_adapter = TypeAdapter(List[ScheduleRead])
+
 # Функция для проверки авторизации
 async def get_current_user(authorization: str = Header(None)):
     if authorization is None or not authorization.startswith("Bearer "):
@@ -141,6 +153,9 @@ async def send_notifications(background_tasks: BackgroundTasks, token: str):
         print(f"Отправка уведомления #{notification['id']}: {notification['change_type']} для расписания #{notification['schedule_id']}")
         send_schedule_notifications(notification, token)
 
+    # Сбрасываем кэш расписаний в сервисе QR
+    notify_qr_schedule_change(notifications, token)
+
     # Отмечаем уведомления как отправленные
     notification_ids = [n['id'] for n in notifications]
     database.mark_notifications_as_sent(notification_ids)
@@ -148,6 +163,42 @@ async def send_notifications(background_tasks: BackgroundTasks, token: str):
     print(f"Успешно отправлено {len(notifications)} уведомлений")
 
 
+def cached_schedule_response(key: tuple, scope: str, scope_id: int, if_none_match: Optional[str], compute):
+    """
+    Отдает список занятий из кэша, пока не изменилась версия расписания scope
+    (группы, преподавателя или всего расписания), справочников и окно обогащения
+    (имена преподавателей и групп из сервиса авторизации перечитываются раз в ENRICH_CACHE_TTL).
+    compute() возвращает (занятия, дополнительные заголовки).
+    ETag строится по ключу запроса и версиям: если он совпал с If-None-Match - ответ 304 без тела
+    """
+    version = (*database.get_schedule_version(scope, scope_id), enrichment_generation())
+    etag = f'"{scope}-{scope_id}-{".".join(map(str, version))}-{hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:16]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+    if if_none_match and etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    cached = schedule_response_cache.get(key)
+    if cached is None or cached[0] != version:
+        schedules, extra_headers = compute()
+        body = schedule_list_adapter.dump_json(schedule_list_adapter.validate_python(schedules))
+        cached = (version, body, extra_headers)
+        schedule_response_cache.set(key, cached)
+    return Response(content=cached[1], media_type="application/json", headers={**headers, **cached[2]})
+
+def build_schedule_list(schedules: List[Dict[str, Any]], authorization: Optional[str]) -> List[Dict[str, Any]]:
+    # Недостающие поля справочников берутся из карты в памяти, без обращений к базе
+    dimensions = database.get_dimensions()
+    for schedule in schedules:
+        database.fill_dimension_fields(schedule, dimensions)
+
+    # Обогащаем данные расписания информацией о преподавателях и группах
+    if authorization and authorization.startswith("Bearer "):
+        token = authorization.replace("Bearer ", "")
+        return enrich_schedules(schedules, token)
+    return schedules
+
+
 @app.on_event("startup")
 def startup_event():
     database.create_tables()
@@ -167,78 +218,116 @@ def get_schedule(
     date_filter: Optional[date] = None,
     teacher_id: Optional[int] = None,
     group_id: Optional[int] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    weekday: Optional[int] = Query(None, ge=1, le=7, description="1 - понедельник, 7 - воскресенье"),
+    classroom_id: Optional[int] = None,
+    lesson_type_id: Optional[int] = None,
+    subject_id: Optional[int] = None,
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user),
-    authorization: str = Header(None)
+    authorization: str = Header(None),
+    if_none_match: Optional[str] = Header(None)
 ):
-    filters = {}
-    if date_filter:
-        filters['date'] = date_filter
-    if teacher_id:
-        filters['teacher_id'] = teacher_id
+    """
+    Расписание по фильтрам. При заданном limit следующая страница запрашивается
+    с cursor из заголовка X-Next-Cursor (его нет на последней странице).
+    Поддерживает If-None-Match: ETag меняется при изменении расписания группы
+    (или преподавателя, если группа не задана).
+    """
+    filters = {
+        "date": date_filter,
+        "teacher_id": teacher_id,
+        "group_id": group_id,
+        "date_from": date_from,
+        "date_to": date_to,
+        "weekday": weekday,
+        "classroom_id": classroom_id,
+        "lesson_type_id": lesson_type_id,
+        "subject_id": subject_id,
+        "limit": limit,
+        "cursor": cursor,
+    }
     if group_id:
-        filters['group_id'] = group_id
-    
-    schedules = database.get_schedule(filters)
-    
-    # Add the missing fields required by the response model
-    for schedule in schedules:
-        # Ensure subject_id is present
-        if 'subject_id' not in schedule and 'subject_name' in schedule:
-            # Get subject_id from database or use a default
-            try:
-                conn = database.get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute("SELECT id FROM subjects WHERE name = ?", (schedule['subject_name'],))
-                result = cursor.fetchone()
-                if result:
-                    schedule['subject_id'] = result['id']
-                else:
-                    schedule['subject_id'] = 1  # Default value
-                conn.close()
-            except:
-                schedule['subject_id'] = 1  # Default value
-        
-        # Ensure classroom_id is present
-        if 'classroom_id' not in schedule and 'classroom_name' in schedule:
-            # Get classroom_id from database or use a default
-            try:
-                conn = database.get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute("SELECT id FROM classrooms WHERE name = ?", (schedule['classroom_name'],))
-                result = cursor.fetchone()
-                if result:
-                    schedule['classroom_id'] = result['id']
-                else:
-                    schedule['classroom_id'] = 1  # Default value
-                conn.close()
-            except:
-                schedule['classroom_id'] = 1  # Default value
-        
-        # Ensure lesson_type_id is present
-        if 'lesson_type_id' not in schedule and 'lesson_type' in schedule:
-            # Get lesson_type_id from database or use a default
-            try:
-                conn = database.get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute("SELECT id FROM lesson_types WHERE name = ?", (schedule['lesson_type'],))
-                result = cursor.fetchone()
-                if result:
-                    schedule['lesson_type_id'] = result['id']
-                else:
-                    schedule['lesson_type_id'] = 1  # Default value
-                conn.close()
-            except:
-                schedule['lesson_type_id'] = 1  # Default value
-    
-    # Obogaschaem dannye raspisaniya informaciej o prepodavatelyah i gruppah
+        scope, scope_id = "group", group_id
+    elif teacher_id:
+        scope, scope_id = "teacher", teacher_id
+    else:
+        scope, scope_id = "all", 0
+
+    def compute():
+        try:
+            schedules = database.query_schedule(**filters)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        headers = {}
+        if limit is not None and len(schedules) == limit:
+            headers["X-Next-Cursor"] = database.encode_schedule_cursor(schedules[-1])
+        return build_schedule_list(schedules, authorization), headers
+
+    return cached_schedule_response(("schedule", tuple(filters.items())), scope, scope_id, if_none_match, compute)
+
+
+@app.get("/schedule/conflicts", response_model=dict)
+def get_schedule_conflicts(
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    current_user: dict = Depends(get_admin_or_teacher)
+):
+    """Все накладки преподавателей, групп и аудиторий за период (например, семестр)"""
+    lessons = database.get_schedule_lessons(date_from, date_to)
+    conflicts = find_all_conflicts(lessons)
+    return {
+        "date_from": date_from,
+        "date_to": date_to,
+        "lessons": len(lessons),
+        "count": len(conflicts),
+        "conflicts": conflicts
+    }
+
+
+def check_allow_conflicts(allow_conflicts: bool, current_user: dict):
+    if allow_conflicts and current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Сохранить занятие с накладками может только администратор")
+
+
+def conflict_error(e: ScheduleConflictError) -> HTTPException:
+    return HTTPException(status_code=409, detail={"message": str(e), "conflicts": e.conflicts})
+
+
+@app.post("/schedule/import", status_code=202, response_model=dict)
+async def import_schedule(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    allow_conflicts: bool = False,
+    current_user: dict = Depends(get_admin_user),
+    authorization: str = Header(None)
+):
+    """
+    Массовый импорт расписания из JSON или CSV. Файл проверяется и загружается
+    в фоне одной транзакцией; ход и результат - GET /schedule/import/{job_id}
+    """
+    content = await file.read()
+    if not content:
+        raise HTTPException(status_code=400, detail="Файл пуст")
+
+    job = schedule_import.create_job(file.filename or "", len(content))
+    background_tasks.add_task(schedule_import.run_import, job, content, file.content_type or "", allow_conflicts)
     if authorization and authorization.startswith("Bearer "):
         token = authorization.replace("Bearer ", "")
-        enriched_schedules = []
-        for schedule in schedules:
-            enriched_schedules.append(enrich_schedule_data(schedule, token))
-        return enriched_schedules
-    
-    return schedules
+        background_tasks.add_task(send_notifications, background_tasks, token)
+
+    return {"job_id": job.id, "status": job.status, "status_url": f"/schedule/import/{job.id}"}
+
+
+@app.get("/schedule/import/{job_id}", response_model=dict)
+def get_import_status(job_id: str, current_user: dict = Depends(get_admin_user)):
+    job = schedule_import.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Импорт {job_id} не найден")
+    return job
 
 
 @app.get("/schedule/{group_id}", response_model=ScheduleRead)
@@ -263,12 +352,14 @@ def get_schedule_by_id(
 async def create_schedule(
     schedule: ScheduleCreate,
     background_tasks: BackgroundTasks,
+    allow_conflicts: bool = False,
     current_user: dict = Depends(get_admin_or_teacher),
     authorization: str = Header(None)
 ):
+    check_allow_conflicts(allow_conflicts, current_user)
     try:
         schedule_data = schedule.dict()
-        schedule_id = database.create_schedule(schedule_data)
+        schedule_id = database.create_schedule(schedule_data, allow_conflicts)
         
         # Запуск отправки уведомлений в фоновом режиме
         if authorization and authorization.startswith("Bearer "):
@@ -276,6 +367,8 @@ async def create_schedule(
             background_tasks.add_task(send_notifications, background_tasks, token)
         
         return {"id": schedule_id, "message": "Расписание успешно создано"}
+    except ScheduleConflictError as e:
+        raise conflict_error(e)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -284,15 +377,17 @@ async def update_schedule(
     schedule_id: int,
     schedule: ScheduleUpdate,
     background_tasks: BackgroundTasks,
+    allow_conflicts: bool = False,
     current_user: dict = Depends(get_admin_or_teacher),
     authorization: str = Header(None)
 ):
+    check_allow_conflicts(allow_conflicts, current_user)
     try:
         schedule_data = {k: v for k, v in schedule.dict().items() if v is not None}
         if not schedule_data:
             raise HTTPException(status_code=400, detail="Нет данных для обновления")
         
-        database.update_schedule(schedule_id, schedule_data)
+        database.update_schedule(schedule_id, schedule_data, allow_conflicts)
         
         # Запуск отправки уведомлений в фоновом режиме
         if authorization and authorization.startswith("Bearer "):
@@ -300,6 +395,8 @@ async def update_schedule(
             background_tasks.add_task(send_notifications, background_tasks, token)
         
         return {"id": schedule_id, "message": "Расписание успешно обновлено"}
+    except ScheduleConflictError as e:
+        raise conflict_error(e)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -327,24 +424,25 @@ async def delete_schedule(
 @app.get("/schedule/teacher/{teacher_id}", response_model=List[ScheduleRead])
 def get_schedule_by_teacher(
     teacher_id: int,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
     current_user: dict = Depends(get_current_user),
-    authorization: str = Header(None)
+    authorization: str = Header(None),
+    if_none_match: Optional[str] = Header(None)
 ):
-    schedules = database.get_schedule_by_teacher(teacher_id)
-    
-    # Обогащаем данные расписания информацией о преподавателе и группе
-    if authorization and authorization.startswith("Bearer "):
-        token = authorization.replace("Bearer ", "")
-        enriched_schedules = []
-        for schedule in schedules:
-            enriched_schedules.append(enrich_schedule_data(schedule, token))
-        return enriched_schedules
-    
-    return schedules
+    def compute():
+        schedules = database.get_schedule_by_teacher(teacher_id, date_from, date_to)
+        return build_schedule_list(schedules, authorization), {}
+
+    return cached_schedule_response(
+        ("schedule_teacher", teacher_id, date_from, date_to), "teacher", teacher_id, if_none_match, compute
+    )
 
 @app.get("/schedule/user/{user_id}", response_model=List[ScheduleRead])
 def get_schedule_by_user_id(
     user_id: int,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
     current_user: dict = Depends(get_current_user),
     authorization: str = Header(None)
 ):
@@ -357,14 +455,14 @@ def get_schedule_by_user_id(
         if not group_id:
             raise HTTPException(status_code=404, detail="Группа студента не найдена")
         
-        return get_schedule_by_group(group_id)
+        return get_schedule_by_group(group_id, date_from, date_to)
     
     elif current_user["role"] == "teacher":
         teacher_info = get_teacher_info(user_id, authorization)
         if not teacher_info:
             raise HTTPException(status_code=404, detail="Преподаватель не найден")
         
-        return get_schedule_by_teacher(teacher_info.get("id"))
+        return get_schedule_by_teacher(teacher_info.get("id"), date_from, date_to)
     
     else:
         raise HTTPException(status_code=403, detail="Недостаточно прав доступа")
@@ -564,6 +662,9 @@ async def send_notifications(background_tasks: BackgroundTasks, token: str):
         # Отправляем уведомление
         send_schedule_notifications(notification, token)
 
+    # Сбрасываем кэш расписаний в сервисе QR
+    notify_qr_schedule_change(notifications, token)
+
     # Отмечаем уведомления как отправленные
     notification_ids = [n['id'] for n in notifications]
     database.mark_notifications_as_sent(notification_ids)
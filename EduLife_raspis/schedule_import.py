@@ -0,0 +1,278 @@
+"""
+Массовый импорт расписания из JSON или CSV.
+
+Файл разбирается и проверяется целиком (справочники - по картам в памяти,
+накладки - по ConflictIndex), затем все занятия добавляются одной
+транзакцией. Ход импорта доступен по id задания.
+
+Состояние заданий хранится в отдельном файле SQLite: его видят все воркеры,
+а запись прогресса не ждет блокировку базы расписания, которую держит импорт.
+"""
+import csv
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import database
+from conflicts import ScheduleConflictError
+
+# Размер порции для executemany и шаг обновления прогресса
+IMPORT_CHUNK_SIZE = int(os.getenv("RASPIS_IMPORT_CHUNK_SIZE", "500"))
+# Сколько ошибок и накладок сохранять в задании
+IMPORT_MAX_ERRORS = int(os.getenv("RASPIS_IMPORT_MAX_ERRORS", "200"))
+# Сколько последних заданий хранить
+IMPORT_MAX_JOBS = 100
+# Файл с состоянием заданий (по умолчанию - рядом с базой расписания)
+IMPORT_JOBS_DB = os.getenv("RASPIS_IMPORT_JOBS_DB")
+
+# Поле занятия -> (поле с названием, справочник), если вместо id указано название
+_DIMENSION_COLUMNS = {
+    "subject_id": ("subject_name", "subjects"),
+    "classroom_id": ("classroom_name", "classrooms"),
+    "lesson_type_id": ("lesson_type", "lesson_types"),
+}
+
+
+_JOB_FIELDS = (
+    "job_id", "filename", "size", "status", "stage", "total", "processed",
+    "inserted", "groups", "error_count", "errors", "created_at", "finished_at"
+)
+_jobs_schema_ready = set()
+_jobs_schema_lock = threading.Lock()
+
+
+def _jobs_connection() -> sqlite3.Connection:
+    path = IMPORT_JOBS_DB or os.path.join(os.path.dirname(database.db_path), "import_jobs.db")
+    conn = sqlite3.connect(path, timeout=5)
+    conn.row_factory = sqlite3.Row
+    if path not in _jobs_schema_ready:
+        with _jobs_schema_lock:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS import_jobs (
+                    job_id TEXT PRIMARY KEY,
+                    filename TEXT,
+                    size INTEGER,
+                    status TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    total INTEGER NOT NULL,
+                    processed INTEGER NOT NULL,
+                    inserted INTEGER NOT NULL,
+                    groups TEXT NOT NULL,
+                    error_count INTEGER NOT NULL,
+                    errors TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    finished_at REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_import_jobs_created_at ON import_jobs (created_at)")
+            conn.commit()
+            _jobs_schema_ready.add(path)
+    return conn
+
+
+class ImportJob:
+    """Состояние одного импорта: этап, прогресс, результат или ошибки. Каждое изменение сохраняется"""
+
+    def __init__(self, filename: str, size: int):
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.size = size
+        self.status = "pending"
+        self.stage = "queued"
+        self.total = 0
+        self.processed = 0
+        self.inserted = 0
+        self.groups: List[int] = []
+        self.errors: List[Dict[str, Any]] = []
+        self.error_count = 0
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def update(self, **fields):
+        with self._lock:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            row = (
+                self.id, self.filename, self.size, self.status, self.stage, self.total, self.processed,
+                self.inserted, json.dumps(self.groups), self.error_count,
+                json.dumps(self.errors, ensure_ascii=False), self.created_at, self.finished_at
+            )
+            conn = _jobs_connection()
+            try:
+                conn.execute(
+                    f"INSERT OR REPLACE INTO import_jobs ({', '.join(_JOB_FIELDS)}) "
+                    f"VALUES ({', '.join('?' * len(_JOB_FIELDS))})",
+                    row
+                )
+                conn.commit()
+            finally:
+                conn.close()
+
+    def progress(self, stage: str, processed: int):
+        self.update(stage=stage, processed=processed)
+
+    def fail(self, errors: List[Dict[str, Any]]):
+        self.update(status="failed", error_count=len(errors), errors=errors[:IMPORT_MAX_ERRORS], finished_at=time.time())
+
+
+def _job_to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+    job = dict(row)
+    job["groups"] = json.loads(job["groups"])
+    job["errors"] = json.loads(job["errors"])
+    job["percent"] = round(job["processed"] * 100 / job["total"], 1) if job["total"] else 0.0
+    return job
+
+
+def create_job(filename: str, size: int) -> ImportJob:
+    job = ImportJob(filename, size)
+    job.update()
+    conn = _jobs_connection()
+    try:
+        # Храним только последние IMPORT_MAX_JOBS заданий
+        conn.execute("""
+            DELETE FROM import_jobs WHERE created_at < (
+                SELECT created_at FROM import_jobs ORDER BY created_at DESC LIMIT 1 OFFSET ?
+            )
+        """, (IMPORT_MAX_JOBS - 1,))
+        conn.commit()
+    finally:
+        conn.close()
+    return job
+
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """Состояние задания из любого воркера"""
+    conn = _jobs_connection()
+    try:
+        row = conn.execute(
+            f"SELECT {', '.join(_JOB_FIELDS)} FROM import_jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+    finally:
+        conn.close()
+    return _job_to_dict(row) if row else None
+
+
+def parse_rows(content: bytes, filename: str = "", content_type: str = "") -> List[Dict[str, Any]]:
+    """Записи файла: CSV с заголовком или JSON - список занятий либо {"lessons": [...]}"""
+    text = content.decode("utf-8-sig")
+    if filename.lower().endswith(".csv") or "csv" in (content_type or ""):
+        return [
+            {key.strip(): value.strip() for key, value in row.items() if key and value not in (None, "")}
+            for row in csv.DictReader(io.StringIO(text))
+        ]
+
+    data = json.loads(text)
+    if isinstance(data, dict):
+        data = data.get("lessons")
+    if not isinstance(data, list) or not all(isinstance(row, dict) for row in data):
+        raise ValueError("Ожидается список занятий или объект {\"lessons\": [...]}")
+    return data
+
+
+def _parse_time(value: str):
+    """Время "H:MM" или "HH:MM:SS" - в таблицах ведущий ноль часто теряется"""
+    for fmt in ("%H:%M:%S", "%H:%M"):
+        try:
+            return datetime.strptime(value, fmt).time()
+        except ValueError:
+            pass
+    raise ValueError(f"Неверный формат времени: '{value}'")
+
+
+def _parse_int(row: Dict[str, Any], field: str) -> int:
+    try:
+        return int(row[field])
+    except (TypeError, ValueError):
+        raise ValueError(f"Поле {field} должно быть целым числом: '{row[field]}'")
+
+
+def _validate_row(row: Dict[str, Any], dimensions: Dict[str, Any]) -> Dict[str, Any]:
+    lesson = {}
+    for field in ("date", "time_start", "time_end", "teacher_id", "group_id"):
+        if row.get(field) in (None, ""):
+            raise ValueError(f"Не указано поле {field}")
+    try:
+        lesson["date"] = date.fromisoformat(str(row["date"])).isoformat()
+    except ValueError:
+        raise ValueError(f"Неверный формат даты: '{row['date']}'")
+    time_start = _parse_time(str(row["time_start"]))
+    time_end = _parse_time(str(row["time_end"]))
+    if time_end <= time_start:
+        raise ValueError("Время окончания должно быть позже времени начала")
+    lesson["time_start"] = time_start.strftime("%H:%M:%S")
+    lesson["time_end"] = time_end.strftime("%H:%M:%S")
+
+    for field in ("teacher_id", "group_id"):
+        lesson[field] = _parse_int(row, field)
+
+    for field, (name_field, table) in _DIMENSION_COLUMNS.items():
+        if row.get(field) not in (None, ""):
+            value = _parse_int(row, field)
+            if value not in dimensions[table]["by_id"]:
+                raise ValueError(f"{field} {value} не найден в справочнике")
+        elif row.get(name_field):
+            value = dimensions[table]["by_name"].get(row[name_field])
+            if value is None:
+                raise ValueError(f"{name_field} '{row[name_field]}' не найден в справочнике")
+        else:
+            raise ValueError(f"Не указано поле {field} или {name_field}")
+        lesson[field] = value
+    return lesson
+
+
+def validate_rows(rows: List[Dict[str, Any]], job: Optional[ImportJob] = None) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Проверяет записи: обязательные поля, дату и время, существование предмета,
+    аудитории и типа занятия по картам справочников в памяти (без запросов на строку).
+    Возвращает (занятия, ошибки); номер записи в файле сохраняется в поле row
+    """
+    # Справочники могли измениться в другом процессе - перечитываем один раз на импорт
+    database.invalidate_dimensions()
+    dimensions = database.get_dimensions()
+
+    lessons, errors = [], []
+    for number, row in enumerate(rows, 1):
+        try:
+            lesson = _validate_row(row, dimensions)
+            lesson["row"] = number
+            lessons.append(lesson)
+        except (ValueError, TypeError) as e:
+            errors.append({"row": number, "error": str(e)})
+        if job and (number % IMPORT_CHUNK_SIZE == 0 or number == len(rows)):
+            job.progress("validating", number)
+    return lessons, errors
+
+
+def run_import(job: ImportJob, content: bytes, content_type: str = "", allow_conflicts: bool = False):
+    """Выполняет задание импорта; ошибки не выбрасываются, а сохраняются в задании"""
+    job.update(status="running", stage="parsing")
+    try:
+        rows = parse_rows(content, job.filename, content_type)
+    except (ValueError, UnicodeDecodeError) as e:
+        job.fail([{"row": None, "error": f"Не удалось разобрать файл: {e}"}])
+        return
+
+    job.update(total=len(rows))
+    lessons, errors = validate_rows(rows, job)
+    if errors:
+        job.fail(errors)
+        return
+
+    try:
+        result = database.import_schedule(lessons, allow_conflicts, job.progress, IMPORT_CHUNK_SIZE)
+    except ScheduleConflictError as e:
+        job.fail([{"error": "conflict", **conflict} for conflict in e.conflicts])
+        return
+    except Exception as e:
+        job.fail([{"row": None, "error": f"Ошибка записи: {e}"}])
+        return
+
+    job.update(status="completed", stage="done", inserted=result["inserted"], groups=result["groups"], finished_at=time.time())
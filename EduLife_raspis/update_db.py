@@ -1,17 +1,7 @@
-import sqlite3
-import os
-import sys
+import database
 
-db_path = os.path.join(os.path.dirname(__file__), "seconddata.db")
+# Миграции схемы (столбец notifications.target_group_id, индексы расписания)
+# выполняются в create_tables и безопасны для повторного запуска
+database.create_tables()
 
-conn = sqlite3.connect(db_path)
-cursor = conn.cursor()
-cursor.execute("""
-    ALTER TABLE notifications 
-    ADD COLUMN target_group_id INTEGER DEFAULT NULL
-""")
-
-conn.commit()
-conn.close()
-
-print("Database updated successfully.")
\ No newline at end of file
+print("Database updated successfully.")
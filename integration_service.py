@@ -107,13 +107,30 @@ class ServiceIntegration:
             raise HTTPException(status_code=response.status_code, detail="Не удалось валидировать QR-код")
         return response.json()
     
-    def get_user_attendance(self, user_id: int) -> List[Dict[str, Any]]:
-        """Получает историю посещаемости пользователя"""
+    def get_user_attendance(
+        self,
+        user_id: int,
+        start_date: Optional[str] = None,
+        end_date: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """Получает историю посещаемости пользователя (опционально за период), постранично"""
         url = f"{QR_API_URL}/sessions/{user_id}"
-        response = requests.get(url, headers=self.headers)
-        if response.status_code != 200:
-            raise HTTPException(status_code=response.status_code, detail="Не удалось получить данные о посещаемости")
-        return response.json()["sessions"]
+        params = {"limit": 1000}
+        if start_date:
+            params["from"] = start_date
+        if end_date:
+            params["to"] = end_date
+
+        sessions = []
+        while True:
+            response = requests.get(url, headers=self.headers, params=params)
+            if response.status_code != 200:
+                raise HTTPException(status_code=response.status_code, detail="Не удалось получить данные о посещаемости")
+            page = response.json()
+            sessions.extend(page["sessions"])
+            if not page.get("next_cursor"):
+                return sessions
+            params["cursor"] = page["next_cursor"]
     
     # ================= Document Service API =================
     def get_documents(self, skip: int = 0, limit: int = 100) -> List[Dict[str, Any]]:
@@ -172,11 +189,11 @@ class ServiceIntegration:
         attendance_data = []
         for student in students:
             user_id = student["user_id"]
-            attendance = self.get_user_attendance(user_id)
+            attendance = self.get_user_attendance(user_id, start_date, end_date)
             
             # Вычисляем статистику посещаемости
             total_classes = len(schedule)
-            attended_classes = sum(1 for a in attendance if start_date <= a.get("session_time", "").split(" ")[0] <= end_date)
+            attended_classes = len(attendance)
             
             attendance_data.append({
                 "student_id": student["id"],